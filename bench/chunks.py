@@ -0,0 +1,109 @@
+'''Memory benchmark of the chunks read from a changegroup v1.
+
+Reads a large synthetic changegroup, keeping all its chunks in memory like
+ChunksCollection does, and reports the memory used with the delta nodes
+stored inline in the chunk buffers, and with the delta nodes stored in a
+WeakKeyDictionary on the side, as was done before.
+
+Usage: python -m bench.chunks [count]
+'''
+
+from __future__ import division
+import os
+import random
+import resource
+import struct
+import sys
+import time
+from cStringIO import StringIO
+from weakref import WeakKeyDictionary
+from cinnabar.git import NULL_NODE_ID
+from cinnabar.hg.changegroup import RawRevChunk01
+from cinnabar.hg.repo import (
+    chunks_in_changegroup,
+    getchunk,
+)
+
+
+class WeakRevChunk01(RawRevChunk01):
+    __slots__ = ('__weakref__',)
+
+    _delta_nodes = WeakKeyDictionary()
+
+    @property
+    def delta_node(self):
+        return self._delta_nodes.get(self, NULL_NODE_ID)
+
+    @delta_node.setter
+    def delta_node(self, value):
+        self._delta_nodes[self] = value
+
+
+def weak_chunks_in_changegroup(bundle):
+    previous_node = None
+    while True:
+        chunk = getchunk(bundle)
+        if not chunk:
+            return
+        chunk = WeakRevChunk01(chunk)
+        chunk.delta_node = previous_node or chunk.parent1
+        yield chunk
+        previous_node = chunk.node
+
+
+def synthetic_changegroup(count, seed=42):
+    '''Generate a changegroup v1 with `count` small chunks, like those of
+    manifests or files with many revisions.'''
+    rand = random.Random(seed)
+    result = StringIO()
+    parent = '\0' * 20
+    for _ in xrange(count):
+        node = os.urandom(20)
+        text = 'x' * rand.randint(20, 100)
+        start = rand.randint(0, 1000)
+        data = struct.pack('>lll', start, start + len(text), len(text)) + text
+        chunk = node + parent + '\0' * 20 + node + data
+        result.write(struct.pack('>l', len(chunk) + 4))
+        result.write(chunk)
+        parent = node
+    result.write(struct.pack('>l', 0))
+    result.seek(0)
+    return result
+
+
+def rss():
+    with open('/proc/self/statm') as fh:
+        return int(fh.read().split()[1]) * resource.getpagesize()
+
+
+def measure(label, func, cg):
+    # Measure in a child process, so that each layout starts from the same
+    # state, without memory left over from the other.
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        before = rss()
+        start = time.time()
+        chunks = list(func(cg))
+        elapsed = time.time() - start
+        used = rss() - before
+        # Access the delta nodes, to ensure they are all there.
+        assert all(c.delta_node for c in chunks)
+        print '%-10s %8.3fs %8.1f MiB %6d bytes/chunk' % (
+            label, elapsed, used / 1024 / 1024, used // len(chunks))
+    finally:
+        os._exit(0)
+
+
+def main(args):
+    count = int(args[0]) if args else 500000
+    cg = synthetic_changegroup(count)
+    print 'chunks: %d' % count
+    measure('inline', chunks_in_changegroup, cg)
+    measure('weakref', weak_chunks_in_changegroup, cg)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,55 @@
+'''Benchmark of gitdag operations on a large synthetic history.
+
+Usage: python -m bench.dag [size]
+'''
+
+from __future__ import division
+import resource
+import sys
+import time
+from cinnabar.dag import gitdag
+from bench.discovery import synthetic_dag
+
+
+def timed(label, func, *args):
+    start = time.time()
+    result = func(*args)
+    print '%-32s %8.3fs' % (label, time.time() - start)
+    return result
+
+
+def main(args):
+    size = int(args[0]) if args else 1000000
+    revs = synthetic_dag(size)
+    print 'nodes: %d' % size
+
+    dag = timed('build', gitdag, revs)
+    timed('heads', lambda: list(dag.heads()))
+    timed('roots', lambda: list(dag.roots()))
+    timed('all_heads', lambda: list(dag.all_heads()))
+
+    # Tag in small steps, as findcommon does, querying heads in between.
+    def tag_steps(steps):
+        step = size // steps
+        for n in xrange(step, size, step):
+            dag.tag_nodes_and_parents((n,), 'known')
+            list(dag.heads('known'))
+            list(dag.heads())
+    timed('tag_nodes_and_parents x100', tag_steps, 100)
+
+    def tag_children_steps(steps):
+        for n in xrange(size - 1, size - steps - 1, -1):
+            dag.tag_nodes_and_children((n,), 'unknown')
+            list(dag.roots('unknown'))
+            list(dag.roots())
+    timed('tag_nodes_and_children x100', tag_children_steps, 100)
+
+    timed('iternodes', lambda: list(dag.iternodes()))
+    timed('clear_tags', dag.clear_tags)
+
+    print 'peak rss: %.1f MiB' % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,116 @@
+'''Benchmark of the discovery algorithm used by findcommon.
+
+Runs discovery between synthetic local and remote dags, counting the
+number of round-trips to the remote and the time spent. The random
+sampling findcommon used before is measured for comparison.
+
+Usage: python -m bench.discovery [size...]
+'''
+
+from __future__ import division
+import random
+import sys
+import time
+from itertools import (
+    izip,
+    product,
+)
+from cinnabar.dag import gitdag
+from cinnabar.hg.repo import (
+    _sample,
+    discover,
+)
+
+SHAPES = (
+    # Branches are merged back quickly.
+    ('merged', 0.02, 0.05),
+    # Branches accumulate, leaving many heads.
+    ('branchy', 0.05, 0.02),
+)
+
+
+def synthetic_dag(size, seed=42, branchiness=0.02, merginess=0.05):
+    '''Generate a list of (node, parents) for a dag with `size` nodes,
+    mostly linear, with some branches and merges.'''
+    rand = random.Random(seed)
+    heads = [0]
+    revs = [(0, ())]
+    for node in xrange(1, size):
+        parent = rand.choice(heads)
+        if rand.random() < merginess and len(heads) > 1:
+            other = rand.choice(heads)
+            parents = (parent, other) if other != parent else (parent,)
+        else:
+            parents = (parent,)
+        if rand.random() >= branchiness:
+            for p in parents:
+                if p in heads:
+                    heads.remove(p)
+        heads.append(node)
+        revs.append((node, parents))
+    return revs
+
+
+class Remote(object):
+    def __init__(self, nodes):
+        self._nodes = nodes
+        self.round_trips = 0
+        self.queried = 0
+
+    def known(self, nodes):
+        self.round_trips += 1
+        self.queried += len(nodes)
+        return [n in self._nodes for n in nodes]
+
+
+def random_discover(dag, known, sample_size=100):
+    '''The discovery loop findcommon used before, for comparison.'''
+    while True:
+        unknown = set(dag.heads()) | set(dag.roots())
+        if not unknown:
+            break
+        sample = set(_sample(unknown, sample_size))
+        if len(sample) < sample_size:
+            sample |= set(_sample(set(dag.iternodes()),
+                                  sample_size - len(sample)))
+        sample = list(sample)
+        sample_known = known(sample)
+        dag.tag_nodes_and_parents(
+            [h for h, k in izip(sample, sample_known) if k], 'known')
+        dag.tag_nodes_and_children(
+            [h for h, k in izip(sample, sample_known) if not k], 'unknown')
+    return dag.heads('known')
+
+
+def run(func, revs, remote_nodes):
+    remote = Remote(remote_nodes)
+    dag = gitdag(revs)
+    start = time.time()
+    common = set(func(dag, remote.known))
+    elapsed = time.time() - start
+    expected = set(n for n in remote_nodes
+                   if not any(c in remote_nodes for c in dag.children(n)))
+    assert common == expected
+    return remote.round_trips, remote.queried, elapsed
+
+
+def main(args):
+    sizes = [int(a) for a in args] or [1000, 10000, 100000]
+    print '%-8s %8s %8s %-10s %7s %8s %9s' % (
+        'shape', 'nodes', 'behind', 'algorithm', 'trips', 'queried', 'time')
+    for (shape, branchiness, merginess), size in product(SHAPES, sizes):
+        revs = synthetic_dag(size, branchiness=branchiness,
+                             merginess=merginess)
+        # The remote has everything but the last changesets. Parents always
+        # come before their children, so that is a consistent dag.
+        for behind in (size // 100, size // 10, size // 2):
+            remote_nodes = set(xrange(size - behind))
+            for name, func in (('setdisc', discover),
+                               ('random', random_discover)):
+                trips, queried, elapsed = run(func, revs, remote_nodes)
+                print '%-8s %8d %8d %-10s %7d %8d %8.3fs' % (
+                    shape, size, behind, name, trips, queried, elapsed)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,260 @@
+'''Benchmark suite for the import and push hot paths.
+
+Runs benchmarks on a synthetic mercurial history, and outputs the results
+as JSON. When given the JSON output of a previous run, compares the results
+against it, and fails when some benchmark got slower by more than the given
+threshold.
+
+Usage: python -m bench.run [--scale N] [--output FILE]
+                           [--compare FILE [--threshold RATIO]] [name...]
+'''
+
+from __future__ import division
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from cinnabar.dag import gitdag
+from cinnabar.githg import (
+    ChangesetPatcher,
+    GitHgStore,
+    ManifestInfo,
+)
+from cinnabar.helper import NoHelperException
+from cinnabar.hg.bundle import create_changegroup
+from cinnabar.hg.changegroup import (
+    RawRevChunk01,
+    RawRevChunk02,
+)
+from cinnabar.hg.repo import (
+    BundleApplier,
+    iter_chunks,
+    iter_initialized,
+    unbundler,
+)
+from cinnabar.util import byte_diff
+from bench.discovery import synthetic_dag
+from bench.synthetic import SyntheticHistory
+
+
+class Skipped(Exception):
+    pass
+
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(func):
+    '''Register a benchmark. The function is given the synthetic history
+    and the scale, and returns a function running the benchmark and
+    returning the number of items it processed.'''
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+@benchmark
+def revdiff_apply(history, scale):
+    patches = [
+        (prev.raw_data if prev else '', f.to_chunk(RawRevChunk02, prev).patch)
+        for prev, f in history.file_pairs()
+    ]
+
+    def run():
+        for orig, patch in patches:
+            patch.apply(orig)
+        return len(patches)
+    return run
+
+
+@benchmark
+def manifest_patch(history, scale):
+    # The sections of the changegroup have to be read in stream order.
+    sections = unbundler(history.changegroup())
+    list(next(sections))
+    chunks = list(next(sections))
+    assert chunks[0].node == history.manifests[0].node
+
+    def run():
+        count = 0
+        for mn in iter_initialized(lambda node: None,
+                                   iter_chunks(chunks, ManifestInfo)):
+            count += 1
+        return count
+    return run
+
+
+@benchmark
+def changeset_patcher(history, scale):
+    pairs = zip(history.changesets, history.changesets[1:])
+
+    def run():
+        for cs1, cs2 in pairs:
+            ChangesetPatcher.from_diff(cs1, cs2).apply(cs1)
+        return len(pairs)
+    return run
+
+
+@benchmark
+def byte_diff_changesets(history, scale):
+    pairs = zip((cs.raw_data for cs in history.changesets),
+                (cs.raw_data for cs in history.changesets[1:]))
+
+    def run():
+        for a, b in pairs:
+            list(byte_diff(a, b))
+        return len(pairs)
+    return run
+
+
+@benchmark
+def dag_tagging(history, scale):
+    size = 100000 * scale
+    revs = synthetic_dag(size)
+
+    def run():
+        dag = gitdag(revs)
+        step = size // 100
+        for n in xrange(step, size, step):
+            dag.tag_nodes_and_parents((n,), 'known')
+            dag.heads('known')
+            dag.heads()
+        return size
+    return run
+
+
+@benchmark
+def create_changegroup_cg1(history, scale):
+    def run():
+        for data in create_changegroup(None, history.bundle_data(),
+                                       RawRevChunk01):
+            pass
+        return len(history)
+    return run
+
+
+@benchmark
+def create_changegroup_cg2(history, scale):
+    def run():
+        for data in create_changegroup(None, history.bundle_data(),
+                                       RawRevChunk02):
+            pass
+        return len(history)
+    return run
+
+
+@benchmark
+def bundle_apply(history, scale):
+    '''Import the synthetic changegroup in the scratch repository. This
+    requires the helper.'''
+    cg = history.changegroup()
+
+    def run():
+        try:
+            store = GitHgStore()
+            BundleApplier(unbundler(cg))(store)
+            store.close()
+        except NoHelperException:
+            raise Skipped('no helper')
+        return len(history)
+    return run
+
+
+def run_benchmarks(names, scale):
+    history = SyntheticHistory(changesets=1000 * scale, files=2000 * scale)
+    for name in names:
+        result = OrderedDict(name=name)
+        try:
+            func = BENCHMARKS[name](history, scale)
+            start = time.time()
+            items = func()
+            seconds = time.time() - start
+        except Skipped as e:
+            result['skipped'] = str(e)
+        else:
+            result['seconds'] = round(seconds, 4)
+            result['items'] = items
+            result['items_per_sec'] = \
+                round(items / seconds, 1) if seconds else None
+        sys.stderr.write('%-24s %s\n' % (
+            name, result.get('skipped') or '%.3fs' % result['seconds']))
+        yield result
+
+
+def compare(results, baseline, threshold):
+    '''Return the list of (name, baseline seconds, seconds) for benchmarks
+    that got slower than the baseline by more than the threshold.'''
+    before = {r['name']: r['seconds'] for r in baseline['results']
+              if 'seconds' in r}
+    return [
+        (r['name'], before[r['name']], r['seconds'])
+        for r in results
+        if r['name'] in before and 'seconds' in r and
+        r['seconds'] > before[r['name']] * (1 + threshold)
+    ]
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog='python -m bench.run',
+        description='Run benchmarks and output their results as JSON.')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='size multiplier of the synthetic history')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare',
+                        help='results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown ratio above which a benchmark is '
+                             'considered regressed')
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='benchmarks to run, amongst %s (default: all)'
+                             % ', '.join(BENCHMARKS))
+    args = parser.parse_args(args)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % name)
+
+    # Run everything in a scratch repository, so that the helper and the
+    # store don't touch the repository the benchmarks are run from.
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        subprocess.check_call(['git', 'init', '-q', tmpdir])
+        os.chdir(tmpdir)
+        results = list(run_benchmarks(args.names or BENCHMARKS.keys(),
+                                      args.scale))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+    report = OrderedDict((
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('scale', args.scale),
+        ('results', results),
+    ))
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(data + '\n')
+    else:
+        print data
+
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            sys.stderr.write('Regression: %s: %.3fs -> %.3fs\n'
+                             % (name, before, after))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
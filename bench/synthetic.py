@@ -0,0 +1,137 @@
+'''Synthetic mercurial histories and changegroups for benchmarks.'''
+
+from __future__ import division
+import random
+from collections import (
+    defaultdict,
+    OrderedDict,
+)
+from cStringIO import StringIO
+from itertools import chain
+from cinnabar.git import NULL_NODE_ID
+from cinnabar.githg import (
+    Changeset,
+    GeneratedManifestInfo,
+)
+from cinnabar.hg.bundle import create_changegroup
+from cinnabar.hg.changegroup import RawRevChunk01
+from cinnabar.hg.objects import File
+
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+         'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor')
+
+
+class SyntheticHistory(object):
+    '''A linear mercurial history, where the first changeset adds `files`
+    files, and each of the following changesets modifies `changes` of
+    them, renaming some of them with a probability of `renames`.
+
+    The changesets, manifests and file revisions are kept in the order
+    they would appear in a changegroup.'''
+
+    def __init__(self, changesets=1000, files=2000, changes=10,
+                 renames=0.05, seed=42):
+        self._rand = random.Random(seed)
+        self.changesets = []
+        self.manifests = []
+        self.files = defaultdict(list)
+        manifest = OrderedDict()
+        contents = {}
+
+        for n in xrange(changesets):
+            if n == 0:
+                changed = ['dir%d/sub%d/file%d' % (i % 50, i % 7, i)
+                           for i in xrange(files)]
+            else:
+                changed = self._rand.sample(manifest.keys(),
+                                            min(changes, len(manifest)))
+            file_revs = []
+            for path in changed:
+                f = File()
+                if path in manifest and self._rand.random() < renames:
+                    # Renamed files have no parent, and refer to their
+                    # origin in their metadata.
+                    f.metadata = {
+                        'copy': path,
+                        'copyrev': manifest.pop(path),
+                    }
+                    content = contents.pop(path)
+                    path = '%s.%d' % (path, n)
+                else:
+                    f.parent1 = manifest.get(path, NULL_NODE_ID)
+                    content = contents.get(path)
+                content = contents[path] = self._content(content)
+                f.content = ''.join(content)
+                f.node = f.sha1
+                manifest[path] = f.node
+                file_revs.append((path, f))
+
+            mn = GeneratedManifestInfo(NULL_NODE_ID)
+            mn.data = ''.join('%s\0%s\n' % (p, manifest[p])
+                              for p in sorted(manifest))
+            mn.set_parents(self.manifests[-1].node if self.manifests
+                           else NULL_NODE_ID)
+            mn.node = mn.sha1
+
+            cs = Changeset()
+            cs.manifest = mn.node
+            cs.author = 'Bench <bench@example.com>'
+            cs.timestamp = str(1500000000 + n * 60)
+            cs.utcoffset = '0'
+            cs.files = [p for p, _ in file_revs]
+            cs.body = 'Change %d\n\n%s' % (n, self._line())
+            if self.changesets:
+                cs.parent1 = self.changesets[-1].node
+            cs.node = cs.sha1
+
+            mn.changeset = cs.node
+            for path, f in file_revs:
+                f.changeset = cs.node
+                self.files[path].append(f)
+            self.changesets.append(cs)
+            self.manifests.append(mn)
+
+    def _line(self):
+        return ' '.join(self._rand.choice(WORDS)
+                        for _ in xrange(self._rand.randint(3, 12))) + '\n'
+
+    def _content(self, lines):
+        if lines is None:
+            return [self._line() for _ in xrange(self._rand.randint(5, 50))]
+        lines = list(lines)
+        lines[self._rand.randrange(len(lines))] = self._line()
+        lines.insert(self._rand.randint(0, len(lines)), self._line())
+        return lines
+
+    def bundle_data(self):
+        '''Yield the objects of the history in the form `bundle_data` in
+        cinnabar.hg.bundle does.'''
+        for cs in self.changesets:
+            yield cs
+        yield None
+        for mn in self.manifests:
+            yield mn
+        yield None
+        for path in sorted(self.files):
+            yield path
+            for f in self.files[path]:
+                yield f
+            yield None
+        yield None
+
+    def changegroup(self, chunk_type=RawRevChunk01):
+        '''Return a file-like object for the changegroup of the history.'''
+        # Each section of the changegroup starts with a root, so the store
+        # is never needed to find delta bases.
+        return StringIO(''.join(
+            create_changegroup(None, self.bundle_data(), chunk_type)))
+
+    def __len__(self):
+        return len(self.changesets) + len(self.manifests) + \
+            sum(len(f) for f in self.files.itervalues())
+
+    def file_pairs(self):
+        '''Yield (previous, current) pairs of consecutive file revisions.'''
+        for revs in self.files.itervalues():
+            for pair in zip(chain([None], revs), revs):
+                yield pair
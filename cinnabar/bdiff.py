@@ -1,4 +1,4 @@
-# The following two functions (bdiff, _normalizeblocks) were copied from the
+# The following two functions (_bdiff, _normalizeblocks) were copied from the
 # mercurial source code.
 # Copyright 2009 Matt Mackall <mpm@selenic.com> and others
 
@@ -36,7 +36,7 @@ def _normalizeblocks(a, b, blocks):
     return r
 
 
-def bdiff(a, b):
+def _bdiff(a, b):
     a = a.splitlines(True)
     b = b.splitlines(True)
 
@@ -61,3 +61,28 @@ def bdiff(a, b):
         lb = bm + size
 
     return "".join(bin)
+
+
+_helper_bdiff = True
+
+# Below this combined size, difflib is fast enough that a round-trip to the
+# helper is not worth it.
+HELPER_BDIFF_THRESHOLD = 16384
+
+
+def bdiff(a, b):
+    # Prefer the helper's implementation for large inputs. It uses a hash
+    # indexed line matching, and doesn't have the quadratic behavior of
+    # difflib.
+    global _helper_bdiff
+    if _helper_bdiff and len(a) + len(b) >= HELPER_BDIFF_THRESHOLD:
+        from .helper import (
+            GitHgHelper,
+            HelperClosedException,
+            NoHelperException,
+        )
+        try:
+            return GitHgHelper.bdiff(a, b)
+        except (NoHelperException, HelperClosedException):
+            _helper_bdiff = False
+    return _bdiff(a, b)
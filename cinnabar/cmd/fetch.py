@@ -1,23 +1,146 @@
+import logging
+import os
 import re
+import shutil
 import sys
+import tempfile
 from binascii import hexlify
+from multiprocessing import Pool
 from cinnabar.cmd.util import CLI
 from cinnabar.git import (
     Git,
     GitProcess,
 )
+from cinnabar.githg import GitHgStore
+from cinnabar.helper import (
+    GitHgHelper,
+    HgRepoHelper,
+)
 from cinnabar.hg.repo import (
+    BundleApplier,
+    bundlerepo,
+    findcommon,
+    get_remote_bundle,
     get_repo,
+    HelperRepo,
     Remote,
+    unbundle_fh,
+    unbundler,
+    write_bundle,
 )
 
 
+def hg_remotes():
+    '''Return the names and urls of the mercurial remotes that
+    `git remote update` would fetch.'''
+    for config, url in Git.iter_config():
+        if not (config.startswith('remote.') and config.endswith('.url')):
+            continue
+        name = config[len('remote.'):-len('.url')]
+        skip_pref = 'remote.%s.skipDefaultUpdate' % name
+        if (url.startswith(('hg::', 'hg://')) and
+                Git.config(skip_pref) != 'true'):
+            yield name, url
+
+
+def download_bundle(args):
+    '''Download a bundle of what the given remote has that the local
+    repository doesn't, to a file in the given directory.
+
+    This runs in a separate process, and only reads from the store. Returns
+    the path of the bundle, or None when there is nothing to download, or
+    when the remote is better handled by a plain `git fetch`.'''
+    name, url, directory = args
+    # Don't reuse the helper processes of the parent process.
+    GitHgHelper._helper = False
+    HgRepoHelper._helper = False
+    try:
+        if url.startswith('hg::'):
+            url = url[4:]
+        repo = get_repo(Remote(name, url))
+        if isinstance(repo, (bundlerepo, HelperRepo)):
+            return None
+        store = GitHgStore()
+        heads = [hexlify(h) for h in repo.heads()]
+        if all(store.changeset_ref_many(heads)):
+            return None
+        common = findcommon(repo, store, store.heads())
+        if not common:
+            # Initial clones go through `git fetch`, which knows about
+            # clone bundles.
+            return None
+        logging.info('%s: common: %s', name, common)
+        path = os.path.join(directory, '%s.hg' % name.replace('/', '_'))
+        with open(path, 'wb') as fh:
+            write_bundle(get_remote_bundle(repo, heads, common), fh)
+        return path
+    except Exception:
+        logging.exception('Failed to download from %s', name)
+        return None
+    finally:
+        GitHgHelper.close()
+        HgRepoHelper.close()
+
+
+def fetch_all_remotes(jobs):
+    remotes = list(hg_remotes())
+    directory = tempfile.mkdtemp(prefix='cinnabar-fetch-')
+    try:
+        pool = Pool(max(jobs, 1), maxtasksperchild=1)
+        try:
+            bundles = pool.map(download_bundle,
+                               [(name, url, directory)
+                                for name, url in remotes])
+        finally:
+            pool.terminate()
+            pool.join()
+
+        # Importing into the store can't happen concurrently, so apply the
+        # downloaded bundles one after the other, skipping what a previous
+        # bundle already brought.
+        store = GitHgStore()
+        try:
+            for path in bundles:
+                if not path:
+                    continue
+                with open(path, 'rb') as fh:
+                    apply_bundle = BundleApplier(
+                        unbundler(unbundle_fh(fh, path)), skip_known=True)
+                    apply_bundle(store)
+        finally:
+            store.close()
+
+        # Finally, let git fetch update the remote refs. Remotes that got a
+        # bundle above only need to check the remote heads.
+        ret = 0
+        for name, url in remotes:
+            ret = GitProcess('fetch', name, stdout=sys.stdout).wait() or ret
+        return ret
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
 @CLI.subcommand
-@CLI.argument('remote', help='mercurial remote name or url')
-@CLI.argument('rev', help='mercurial changeset to fetch')
+@CLI.argument('--all-remotes', action='store_true',
+              help='fetch from all mercurial remotes concurrently')
+@CLI.argument('--jobs', '-j', type=int, default=4,
+              help='number of concurrent downloads with --all-remotes')
+@CLI.argument('remote', nargs='?', help='mercurial remote name or url')
+@CLI.argument('rev', nargs='?', help='mercurial changeset to fetch')
 def fetch(args):
     '''fetch a changeset from a mercurial remote'''
 
+    if args.all_remotes:
+        if args.remote or args.rev:
+            print >>sys.stderr, (
+                '--all-remotes cannot be used with a remote or a changeset')
+            return 1
+        return fetch_all_remotes(args.jobs)
+
+    if not args.remote or not args.rev:
+        print >>sys.stderr, 'A remote and a changeset are required'
+        return 1
+
     remote = args.remote
     rev = args.rev
     if not re.match('[0-9a-f]{40}$', rev.lower()):
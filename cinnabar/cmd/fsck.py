@@ -1,5 +1,10 @@
 import logging
+import os
 import sys
+from functools import partial
+from itertools import imap
+from multiprocessing import Pool
+from cinnabar.cmd.rollback import metadata_history
 from cinnabar.cmd.util import CLI
 from cinnabar.githg import (
     Changeset,
@@ -18,6 +23,7 @@ from cinnabar.git import (
     NULL_NODE_ID,
 )
 from cinnabar.util import (
+    iter_batches,
     progress_iter,
 )
 from cinnabar.helper import GitHgHelper
@@ -27,7 +33,198 @@ from collections import (
 )
 
 
+# Number of manifests handed at once to each worker process with --jobs.
+CHECK_CHUNK_SIZE = 64
+
+
+class FsckCheckpoint(object):
+    '''Manifests that passed their checks during a previous, interrupted,
+    fsck, stored in .git/cinnabar/fsck-checkpoint.
+
+    The checkpoint is only valid for the metadata and options it was
+    recorded with, which `key` is derived from.'''
+
+    def __init__(self, key):
+        self._path = os.path.join(Git.git_dir(), 'cinnabar',
+                                  'fsck-checkpoint')
+        self._key = key
+        self.done = set()
+        try:
+            with open(self._path) as fh:
+                if fh.readline().rstrip('\n') == key:
+                    # The last line may be truncated if fsck was killed.
+                    self.done = set(l[:40] for l in fh if len(l) == 41)
+        except IOError:
+            pass
+        self._fh = None
+
+    def add(self, manifest):
+        if not self._fh:
+            directory = os.path.dirname(self._path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._fh = open(self._path, 'w')
+            self._fh.write('%s\n' % self._key)
+            self._fh.writelines('%s\n' % m for m in self.done)
+        self._fh.write('%s\n' % manifest)
+        self._fh.flush()
+
+    def remove(self):
+        if self._fh:
+            self._fh.close()
+            self._fh = None
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+
+def files_to_check(manifest_ref, git_parents):
+    '''Return the (path, hg_file, hg_fileparents) of the files changed in
+    the given manifest that need to be checked.
+
+    This relies on the helper tracking the files it saw, so this is always
+    called in the main process, in manifest order, which makes the same
+    files checked whatever the number of worker processes.'''
+    result = []
+    for path, hg_file, hg_fileparents in get_changes(manifest_ref,
+                                                     git_parents, 'hg'):
+        if hg_file != NULL_NODE_ID and (hg_file == HG_EMPTY_FILE or
+                                        GitHgHelper.seen('hg2git', hg_file)):
+            result.append((path, hg_file, hg_fileparents))
+    return result
+
+
+def manifest_tasks(manifests, done=(), files=False):
+    '''Yield the tasks for check_manifest for the given (manifest,
+    manifest_ref, git_parents, node, tree) tuples. Manifests in `done` are
+    not checked again.'''
+    for manifest, manifest_ref, git_parents, node, tree in manifests:
+        verify = manifest not in done
+        changes = files_to_check(manifest_ref, git_parents) if files else ()
+        yield (manifest, manifest_ref, git_parents, node, tree,
+               verify, changes if verify else ())
+
+
+def check_manifest(task, manifests=False, store=None):
+    '''Check a manifest, its git tree and the given files. Returns the
+    manifest and the list of problems found.
+
+    This is used both in the main process and in worker processes. In the
+    latter case, `store` is not available, and files are always checked by
+    the helper.'''
+    manifest, manifest_ref, git_parents, node, tree, verify, changes = task
+    problems = []
+    if not verify:
+        return manifest, problems
+
+    if manifests and not GitHgHelper.check_manifest(manifest):
+        problems.append('Sha1 mismatch for manifest %s' % manifest)
+
+    manifest_commit = GitCommit(manifest_ref)
+    if sorted(manifest_commit.parents) != sorted(git_parents):
+        # TODO: better error
+        problems.append('%s(%s) %s != %s' % (
+            manifest, manifest_ref, manifest_commit.parents, git_parents))
+
+    git_ls = one(Git.ls_tree(manifest_ref, 'git'))
+    if git_ls:
+        mode, typ, sha1, path = git_ls
+    else:
+        if manifest_commit.tree == EMPTY_TREE:
+            sha1 = EMPTY_TREE
+        else:
+            problems.append('Missing git tree in manifest commit %s'
+                            % manifest_ref)
+            sha1 = None
+    if sha1 and sha1 != tree:
+        problems.append(
+            'Tree mismatch between manifest commit %s and commit %s'
+            % (manifest_ref, node))
+
+    full_file_check = (store is not None and
+                       FileFindParents.logger.isEnabledFor(logging.DEBUG))
+    for path, hg_file, hg_fileparents in changes:
+        if full_file_check:
+            file = store.file(hg_file, hg_fileparents, git_parents, path)
+            valid = file.node == file.sha1
+        else:
+            valid = GitHgHelper.check_file(hg_file, *hg_fileparents)
+        if not valid:
+            problems.append('Sha1 mismatch for file %s in manifest %s'
+                            % (hg_file, manifest_ref))
+    return manifest, problems
+
+
+def init_worker():
+    # Don't reuse the helper process of the parent process.
+    GitHgHelper._helper = False
+
+
+def check_manifests(tasks, jobs=1, manifests=False, store=None):
+    '''Run check_manifest on the given tasks, in `jobs` worker processes,
+    or in the main process when `jobs` is 1, and yield the results in
+    order.
+
+    The tasks are pulled from the calling thread, because creating them
+    uses the helper. The next batch of tasks is created while the workers
+    process the current one.'''
+    if jobs <= 1:
+        for result in imap(partial(check_manifest, manifests=manifests,
+                                   store=store), tasks):
+            yield result
+        return
+
+    pool = Pool(jobs, initializer=init_worker)
+    try:
+        func = partial(check_manifest, manifests=manifests)
+        pending = None
+        for batch in iter_batches(tasks, CHECK_CHUNK_SIZE * jobs * 4):
+            result = pool.map_async(func, batch, CHECK_CHUNK_SIZE)
+            if pending:
+                for r in pending.get():
+                    yield r
+            pending = result
+        if pending:
+            for r in pending.get():
+                yield r
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def fsck_validated_path():
+    return os.path.join(Git.git_dir(), 'cinnabar', 'fsck-validated')
+
+
+def incremental_base(options):
+    '''Return the metadata commit last validated by fsck with at least the
+    given options, if it is in the history of the current metadata.'''
+    try:
+        with open(fsck_validated_path()) as fh:
+            validated = fh.read().split()
+    except IOError:
+        return None
+    if not validated or not set(options) <= set(validated[1:]):
+        return None
+    if validated[0] in metadata_history(
+            Git.resolve_ref('refs/cinnabar/metadata')):
+        return validated[0]
+
+
+def record_validated(metadata, options):
+    path = fsck_validated_path()
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as fh:
+        fh.write('%s\n' % ' '.join([metadata] + options))
+
+
 @CLI.subcommand
+@CLI.argument('--jobs', '-j', type=int, default=1,
+              help='number of processes checking manifests and files')
+@CLI.argument('--incremental', action='store_true',
+              help='Only check metadata added since the last successful '
+                   'check')
 @CLI.argument('--manifests', action='store_true',
               help='Validate manifests hashes')
 @CLI.argument('--files', action='store_true',
@@ -54,12 +251,19 @@ def fsck(args):
         status['broken'] = True
         info(message)
 
+    if args.incremental and args.commit:
+        info('--incremental cannot be used with specific commits')
+        return 1
+
     try:
         store = GitHgStore()
     except UpgradeException as e:
         print >>sys.stderr, e.message
         return 1
 
+    options = [o for o in ('manifests', 'files') if getattr(args, o)]
+    base = None
+
     if args.commit:
         commits = set()
         all_git_commits = {}
@@ -88,14 +292,36 @@ def fsck(args):
         else:
             assert False
 
+        exclude = ()
+        if args.incremental:
+            base = incremental_base(options)
+            if base:
+                info('Checking metadata added since %s' % base)
+                base_metadata = GitCommit(base)
+                exclude = ('--not', '%s^@' % base_metadata.parents[0])
+            else:
+                info('No previous check to start from, checking everything.')
+
         all_git_commits = GitHgHelper.rev_list(
-            '--topo-order', '--full-history', '--reverse', git_heads)
+            '--topo-order', '--full-history', '--reverse', git_heads,
+            *exclude)
 
     dag = gitdag()
 
     GitHgHelper.reset_heads('manifests')
 
-    full_file_check = FileFindParents.logger.isEnabledFor(logging.DEBUG)
+    if base:
+        # Start from the heads that were validated, so that the head
+        # references can be checked as if everything had been.
+        changesets_commit, manifests_commit = base_metadata.parents[:2]
+        for line in GitCommit(changesets_commit).body.splitlines():
+            hghead, branch = line.split(' ', 1)
+            dag.add(hghead, (), branch)
+        for manifest_ref in GitCommit(manifests_commit).parents:
+            GitHgHelper.set('manifest', store.hg_manifest(manifest_ref),
+                            manifest_ref)
+
+    manifests = []
 
     for node, tree, parents in progress_iter('Checking %d changesets',
                                              all_git_commits):
@@ -143,6 +369,7 @@ def fsck(args):
         manifest_ref = store.manifest_ref(manifest)
         if not manifest_ref:
             report('Missing manifest in hg2git branch: %s' % manifest)
+            continue
 
         parents = tuple(
             store.changeset(p).manifest
@@ -155,46 +382,29 @@ def fsck(args):
         # dag.
         GitHgHelper.set('manifest', manifest, manifest_ref)
 
-        if args.manifests:
-            if not GitHgHelper.check_manifest(manifest):
-                report('Sha1 mismatch for manifest %s' % manifest)
-
-        manifest_commit_parents = GitCommit(manifest_ref).parents
-        if sorted(manifest_commit_parents) != sorted(git_parents):
-            # TODO: better error
-            report('%s(%s) %s != %s' % (manifest, manifest_ref,
-                                        manifest_commit_parents,
-                                        git_parents))
+        manifests.append((manifest, manifest_ref, git_parents, node, tree))
 
-        git_ls = one(Git.ls_tree(manifest_ref, 'git'))
-        if git_ls:
-            mode, typ, sha1, path = git_ls
-        else:
-            if GitCommit(manifest_ref).tree == EMPTY_TREE:
-                sha1 = EMPTY_TREE
-            else:
-                report('Missing git tree in manifest commit %s' % manifest_ref)
-                sha1 = None
-        if sha1 and sha1 != tree:
-            report('Tree mismatch between manifest commit %s and commit %s'
-                   % (manifest_ref, node))
-
-        if args.files:
-            changes = get_changes(manifest_ref, git_parents, 'hg')
-            for path, hg_file, hg_fileparents in changes:
-                if hg_file != NULL_NODE_ID and (hg_file == HG_EMPTY_FILE or
-                                                GitHgHelper.seen('hg2git',
-                                                                 hg_file)):
-                    if full_file_check:
-                        file = store.file(hg_file, hg_fileparents, git_parents,
-                                          path)
-                        valid = file.node == file.sha1
-                    else:
-                        valid = GitHgHelper.check_file(hg_file,
-                                                       *hg_fileparents)
-                    if not valid:
-                        report('Sha1 mismatch for file %s in manifest %s'
-                               % (hg_file, manifest_ref))
+    # Manifests and files are checked once all changesets have been, which
+    # allows to spread the work over several processes. Manifests that were
+    # checked by an interrupted fsck with the same metadata and options are
+    # not checked again.
+    checkpoint = None
+    done = ()
+    if not args.commit:
+        checkpoint = FsckCheckpoint(' '.join(
+            [Git.resolve_ref('refs/cinnabar/metadata')] + options))
+        done = checkpoint.done
+    results = check_manifests(
+        manifest_tasks(manifests, done, args.files), args.jobs,
+        args.manifests, store)
+    for manifest, problems in progress_iter('Checking %d manifests',
+                                            results):
+        for problem in problems:
+            report(problem)
+        if checkpoint and not problems:
+            checkpoint.add(manifest)
+    if checkpoint:
+        checkpoint.remove()
 
     if not args.commit and not status['broken']:
         store_manifest_heads = set(store._manifest_heads_orig)
@@ -222,8 +432,10 @@ def fsck(args):
                 if GitHgHelper.seen('hg2git', store.hg_manifest(h)):
                     fix('Removing non-head reference to %s in manifests '
                         'metadata.' % h)
+    # Metadata that was validated by a previous fsck wasn't seen during an
+    # incremental check, so dangling metadata can't be detected then.
     dangling = ()
-    if not args.commit and not status['broken']:
+    if not args.commit and not base and not status['broken']:
         dangling = GitHgHelper.dangling(
             'hg2git' if args.files else 'hg2git-no-blobs')
     for obj in dangling:
@@ -235,7 +447,7 @@ def fsck(args):
         GitHgHelper.set('file', obj, NULL_NODE_ID)
         GitHgHelper.set('file-meta', obj, NULL_NODE_ID)
 
-    if not args.commit and not status['broken']:
+    if not args.commit and not base and not status['broken']:
         dangling = GitHgHelper.dangling('git2hg')
     for c in dangling:
         fix('Removing dangling note for commit ' + c)
@@ -270,6 +482,9 @@ def fsck(args):
 
     store.close()
 
+    if not args.commit and not status['broken']:
+        record_validated(Git.resolve_ref('refs/cinnabar/metadata'), options)
+
     if status['broken']:
         return 1
     if status['fixed']:
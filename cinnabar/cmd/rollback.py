@@ -1,6 +1,9 @@
 import logging
 from cinnabar.cmd.util import CLI
-from cinnabar.githg import GitCommit
+from cinnabar.githg import (
+    GitCommit,
+    ManifestCache,
+)
 from cinnabar.git import (
     Git,
     NULL_NODE_ID,
@@ -8,6 +11,19 @@ from cinnabar.git import (
 from cinnabar.util import VersionedDict
 
 
+def metadata_history(metadata):
+    '''Iterate over the given metadata commit and the metadata commits
+    that preceded it.'''
+    while metadata:
+        yield metadata
+        commit = GitCommit(metadata)
+        flags = commit.body.split(' ')
+        if len(commit.parents) == 5 + ('files-meta' in flags):
+            metadata = commit.parents[-1]
+        else:
+            metadata = None
+
+
 def do_rollback(ref):
     sha1 = Git.resolve_ref(ref)
     if not sha1:
@@ -15,17 +31,8 @@ def do_rollback(ref):
         return 1
     if sha1 != NULL_NODE_ID:
         # Validate that the sha1 is in the history of the current metadata
-        metadata = Git.resolve_ref('refs/cinnabar/metadata')
-        while metadata:
-            if sha1 == metadata:
-                break
-            commit = GitCommit(metadata)
-            flags = commit.body.split(' ')
-            if len(commit.parents) == 5 + ('files-meta' in flags):
-                metadata = commit.parents[-1]
-            else:
-                metadata = None
-        if not metadata:
+        if sha1 not in metadata_history(
+                Git.resolve_ref('refs/cinnabar/metadata')):
             logging.error('Cannot rollback to %s, it is not in the history of '
                           'the current metadata.', ref)
             return 1
@@ -50,6 +57,9 @@ def do_rollback(ref):
             Git.update_ref(ref, commit)
     Git._close_update_ref()
 
+    # Cached manifests may not match the restored metadata.
+    ManifestCache().clear()
+
     return 0
 
 
@@ -1,93 +1,245 @@
 #!/usr/bin/env python2.7
 
 from __future__ import division
-from collections import (
-    deque,
-    defaultdict
-)
-from .util import OrderedDefaultDict
+from array import array
+from collections import deque
+from itertools import izip
 
 
-# TODO: this class sucks and is probably wrong
 class gitdag(object):
-    __slots__ = "_parents", "_children", "_tags"
+    '''A dag of nodes, where each node may be tagged.
+
+    Nodes are given integer ids in the order they are first seen, either
+    as a node or as a parent, and the dag is stored in lists indexed by
+    those ids. Parents that were never added as nodes are not part of the
+    dag, but can still be tagged.
+
+    Heads and roots of each tag (including None, for untagged nodes) are
+    kept up-to-date as nodes are added and tagged, so that querying them
+    doesn't require going through the whole dag.'''
+    __slots__ = ("_ids", "_nodes", "_parents", "_children", "_position",
+                 "_order", "_tags", "_tag_names", "_tag_ids", "_tag_counts",
+                 "_heads", "_roots", "_childless")
 
     def __init__(self, revlist=[]):
-        self._parents = OrderedDefaultDict(set)
-        self._children = defaultdict(set)
+        self._ids = {}
+        self._nodes = []
+        self._parents = []
+        self._children = []
+        # Position of each node in insertion order, or -1 for nodes that
+        # were only seen as parents.
+        self._position = array('l')
+        self._order = array('l')
+        self._tags = array('l')
+        self._tag_names = [None]
+        self._tag_ids = {None: 0}
+        self._tag_counts = [0]
+        self._heads = [set()]
+        self._roots = [set()]
+        self._childless = set()
         for node, parents in revlist:
-            self._parents[node] |= set(parents)
-            for p in parents:
-                self._children[p].add(node)
-        self._tags = {}
+            self.add(node, parents)
+
+    def _id(self, node):
+        id = self._ids.get(node)
+        if id is None:
+            id = self._ids[node] = len(self._nodes)
+            self._nodes.append(node)
+            self._parents.append(())
+            self._children.append(None)
+            self._position.append(-1)
+            self._tags.append(0)
+            self._tag_counts[0] += 1
+        return id
+
+    def _tag_id(self, tag):
+        t = self._tag_ids.get(tag)
+        if t is None:
+            t = self._tag_ids[tag] = len(self._tag_names)
+            self._tag_names.append(tag)
+            self._tag_counts.append(0)
+            self._heads.append(set())
+            self._roots.append(set())
+        return t
+
+    def _is_head(self, id, t):
+        return not any(self._tags[c] == t for c in self._children[id] or ())
+
+    def _is_root(self, id, t):
+        return not any(self._position[p] >= 0 and self._tags[p] == t
+                       for p in self._parents[id])
 
     def add(self, node, parents, tag=None):
-        self._parents[node] |= set(parents)
+        id = self._id(node)
+        tags = self._tags
+        if self._position[id] < 0:
+            self._position[id] = len(self._order)
+            self._order.append(id)
+            t = tags[id]
+            children = self._children[id]
+            if not children:
+                self._childless.add(id)
+            if self._is_head(id, t):
+                self._heads[t].add(id)
+            self._roots[t].add(id)
+            for c in children or ():
+                if tags[c] == t:
+                    self._roots[t].discard(c)
+
         for p in parents:
-            self._children[p].add(node)
+            p = self._id(p)
+            if p in self._parents[id]:
+                continue
+            self._parents[id] += (p,)
+            if self._children[p] is None:
+                self._children[p] = [id]
+            else:
+                self._children[p].append(id)
+            if self._position[p] >= 0:
+                self._childless.discard(p)
+                t = tags[id]
+                if tags[p] == t:
+                    self._heads[t].discard(p)
+                    self._roots[t].discard(id)
+
         if tag:
-            self._tags[node] = tag
+            self._retag(id, self._tag_id(tag))
+
+    def _retag(self, id, new):
+        tags = self._tags
+        old = tags[id]
+        if old == new:
+            return
+        tags[id] = new
+        self._tag_counts[old] -= 1
+        self._tag_counts[new] += 1
+        if self._position[id] < 0:
+            # Heads and roots only concern nodes in the dag.
+            return
+
+        self._heads[old].discard(id)
+        self._roots[old].discard(id)
+        parents = [p for p in self._parents[id] if self._position[p] >= 0]
+        children = self._children[id] or ()
+        for p in parents:
+            if tags[p] == old and self._is_head(p, old):
+                self._heads[old].add(p)
+            elif tags[p] == new:
+                self._heads[new].discard(p)
+        for c in children:
+            if tags[c] == old and self._is_root(c, old):
+                self._roots[old].add(c)
+            elif tags[c] == new:
+                self._roots[new].discard(c)
+
+        if self._is_head(id, new):
+            self._heads[new].add(id)
+        if self._is_root(id, new):
+            self._roots[new].add(id)
+
+    def _sorted(self, ids):
+        position = self._position
+        return [self._nodes[i] for i in sorted(ids, key=position.__getitem__)]
 
     def roots(self, tag=None):
-        for node, parents in self._parents.iteritems():
-            if self._tags.get(node) == tag:
-                if all(p not in self._parents or self._tags.get(p) != tag
-                       for p in parents):
-                    yield node
+        t = self._tag_ids.get(tag)
+        if t is None:
+            return []
+        return self._sorted(self._roots[t])
 
     def heads(self, tag=None):
-        for node in self._parents:
-            if self._tags.get(node) == tag:
-                if (node not in self._children or
-                        all(self._tags.get(c) != tag
-                            for c in self._children[node])):
-                    yield node
+        t = self._tag_ids.get(tag)
+        if t is None:
+            return []
+        return self._sorted(self._heads[t])
 
     def all_heads(self, with_tags=True):
         if with_tags:
-            for node in self._parents:
-                tag = self._tags.get(node)
-                if (node not in self._children or
-                        all(self._tags.get(c) != tag
-                            for c in self._children[node])):
-                    yield tag, node
+            tags = self._tags
+            for node in self._sorted(i for h in self._heads for i in h):
+                yield self._tag_names[tags[self._ids[node]]], node
         else:
-            for node in self._parents:
-                if node not in self._children:
-                    yield node
+            for node in self._sorted(self._childless):
+                yield node
+
+    def parents(self, node):
+        id = self._ids.get(node)
+        if id is None:
+            return ()
+        return tuple(self._nodes[p] for p in self._parents[id])
+
+    def children(self, node):
+        id = self._ids.get(node)
+        if id is None:
+            return ()
+        return tuple(self._nodes[c] for c in self._children[id] or ())
+
+    def tag(self, node):
+        id = self._ids.get(node)
+        if id is None:
+            return None
+        return self._tag_names[self._tags[id]]
+
+    def clear_tags(self):
+        for t in xrange(1, len(self._tag_names)):
+            self._tag_counts[0] += self._tag_counts[t]
+            self._tag_counts[t] = 0
+            self._heads[t].clear()
+            self._roots[t].clear()
+        self._tags = array('l', [0]) * len(self._nodes)
+        self._heads[0] = set(i for i in self._order
+                             if not self._children[i])
+        self._roots[0] = set(i for i in self._order
+                             if not any(self._position[p] >= 0
+                                        for p in self._parents[i]))
 
     def tag_nodes_and_parents(self, nodes, tag):
-        self._tag_nodes_and_other(self._parents, nodes, tag)
+        '''Tag the given nodes and their untagged ancestors. Returns the
+        list of nodes that were tagged.'''
+        return self._tag_nodes_and_other(self._parents, nodes, tag)
 
     def tag_nodes_and_children(self, nodes, tag):
-        self._tag_nodes_and_other(self._children, nodes, tag)
+        '''Tag the given nodes and their untagged descendants. Returns the
+        list of nodes that were tagged.'''
+        return self._tag_nodes_and_other(self._children, nodes, tag)
 
     def _tag_nodes_and_other(self, other, nodes, tag):
         assert tag
-        queue = deque(nodes)
+        t = self._tag_id(tag)
+        tags = self._tags
+        tagged = []
+        queue = deque(self._id(n) for n in nodes)
         while queue:
-            node = queue.popleft()
-            if node in self._tags:
+            id = queue.popleft()
+            if tags[id]:
                 continue
-            self._tags[node] = tag
-            for o in other.get(node, ()):
-                queue.append(o)
+            self._retag(id, t)
+            tagged.append(self._nodes[id])
+            queue.extend(other[id] or ())
+        return tagged
 
     def iternodes(self, tag=None):
-        if tag is None:
-            for n in self._parents:
-                if n not in self._tags:
-                    yield n
+        t = self._tag_ids.get(tag)
+        if t is None:
+            return
+        tags = self._tags
+        if t == 0:
+            for i in self._order:
+                if tags[i] == 0:
+                    yield self._nodes[i]
         else:
-            for n, t in self._tags.iteritems():
-                if t == tag:
-                    yield n
+            for i, node in enumerate(self._nodes):
+                if tags[i] == t:
+                    yield node
 
     def __len__(self):
-        return len(self._parents)
+        return len(self._order)
 
     def __contains__(self, node):
-        return node in self._parents
+        id = self._ids.get(node)
+        return id is not None and self._position[id] >= 0
 
     def tags(self):
-        return set(self._tags.itervalues())
+        return set(tag for tag, count in izip(self._tag_names,
+                                              self._tag_counts)
+                   if count and tag is not None)
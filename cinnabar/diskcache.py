@@ -0,0 +1,148 @@
+import errno
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+
+class DiskCache(object):
+    '''Directory of files with a total size budget.
+
+    When adding a file makes the total size go over the budget, the least
+    recently used files are removed. Files are written to a temporary file
+    first, and renamed once complete, such that concurrent processes never
+    see partial files.'''
+
+    TMP_PREFIX = '.tmp-'
+
+    def __init__(self, path, max_bytes):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._size = None
+
+    def path(self, key):
+        return os.path.join(self._path, key)
+
+    def _entries(self):
+        try:
+            names = os.listdir(self._path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            if name.startswith(self.TMP_PREFIX):
+                continue
+            try:
+                st = os.stat(self.path(name))
+            except OSError:
+                continue
+            yield name, st.st_mtime, st.st_size
+
+    def size(self):
+        if self._size is None:
+            self._size = sum(size for _, _, size in self._entries())
+        return self._size
+
+    def open(self, key):
+        '''Return an open file for the given key, or None if it is not in
+        the cache.'''
+        path = self.path(key)
+        try:
+            fh = open(path, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        # Keep track of the last use through the file modification time.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return fh
+
+    def get(self, key):
+        fh = self.open(key)
+        if fh is None:
+            return None
+        with fh:
+            return fh.read()
+
+    def mkstemp(self):
+        '''Create a temporary file in the cache directory. Returns a file
+        opened for writing, and its path, to be given to commit() once
+        complete.'''
+        try:
+            os.makedirs(self._path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(prefix=self.TMP_PREFIX, dir=self._path)
+        return os.fdopen(fd, 'wb'), tmp
+
+    def commit(self, tmp, key):
+        '''Move the given temporary file in the cache for the given key.'''
+        path = self.path(key)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # On Windows, rename doesn't replace existing files.
+            os.unlink(path)
+            os.rename(tmp, path)
+        self._added(os.path.getsize(path))
+
+    @contextmanager
+    def writer(self, key):
+        '''Context manager giving a file to write the data for the given
+        key to. The data is only added to the cache if no exception was
+        raised.'''
+        fh, tmp = self.mkstemp()
+        try:
+            with fh:
+                yield fh
+            self.commit(tmp, key)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def put(self, key, data):
+        with self.writer(key) as fh:
+            fh.write(data)
+
+    def remove(self, key):
+        try:
+            size = os.path.getsize(self.path(key))
+            os.unlink(self.path(key))
+        except OSError:
+            return
+        if self._size is not None:
+            self._size -= size
+
+    def _added(self, size):
+        if self._size is not None:
+            self._size += size
+        if self.size() > self._max_bytes:
+            self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of the budget, so that eviction doesn't happen
+        # on every addition once the cache is full.
+        target = self._max_bytes * 9 // 10
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        size = sum(e[2] for e in entries)
+        for name, _, entry_size in entries:
+            if size <= target:
+                break
+            try:
+                os.unlink(self.path(name))
+            except OSError:
+                continue
+            size -= entry_size
+        self._size = size
+
+    def clear(self):
+        shutil.rmtree(self._path, ignore_errors=True)
+        self._size = 0
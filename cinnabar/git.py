@@ -54,6 +54,11 @@ class Git(object):
     _initial_refs = _refs._previous
     _config = None
     _replace = {}
+    _git_dir = None
+    # Whether all the refs were read with for-each-ref.
+    _refs_loaded = False
+    _cat_file_check = None
+    _cat_file_check_pid = None
 
     @classmethod
     def register_fast_import(self, fast_import):
@@ -95,27 +100,103 @@ class Git(object):
     def run(self, *args):
         return tuple(self.iter(*args, stdout=None))
 
+    @staticmethod
+    def _is_ref_name(name):
+        return (name.startswith('refs/') and '..' not in name and
+                '@{' not in name and
+                not any(c in name for c in ' ~^:?*[\\'))
+
+    @staticmethod
+    def _ref_matches(ref, pattern):
+        # Same as what for-each-ref does with patterns without wildcards.
+        return ref.startswith(pattern) and (
+            pattern.endswith('/') or ref[len(pattern):len(pattern) + 1]
+            in ('', '/'))
+
     @classmethod
-    def for_each_ref(self, *patterns):
-        if not patterns:
+    def _load_refs(self):
+        if self._refs_loaded:
             return
-        # Ideally, this would not actually call for-each-ref if all refs
-        # matching the given patterns are already known.
         for line in self.iter('for-each-ref', '--format',
-                              '%(objectname) %(refname)', *patterns):
+                              '%(objectname) %(refname)'):
             sha1, ref = line.split(' ', 1)
             self._initial_refs[ref] = sha1
-            # The ref might have been removed in self._refs
-            if ref in self._refs:
-                yield self._refs[ref], ref
+        self._refs_loaded = True
+
+    @classmethod
+    def for_each_ref(self, *patterns):
+        if not patterns:
+            return
+        if any(c in p for p in patterns for c in '*?['):
+            # Let for-each-ref deal with wildcards.
+            for line in self.iter('for-each-ref', '--format',
+                                  '%(objectname) %(refname)', *patterns):
+                sha1, ref = line.split(' ', 1)
+                self._initial_refs[ref] = sha1
+                # The ref might have been removed in self._refs
+                if ref in self._refs:
+                    yield self._refs[ref], ref
+            return
+        # All refs are read once, and kept up-to-date in self._refs, which
+        # also contains refs that were created since. Refs that failed to
+        # resolve, and other revisions resolve_ref was used on, are skipped.
+        self._load_refs()
+        for ref in sorted(
+                r for r in self._refs
+                if self._is_ref_name(r) and
+                any(self._ref_matches(r, p) for p in patterns)):
+            sha1 = self._refs[ref]
+            if sha1:
+                yield sha1, ref
+
+    @classmethod
+    def _rev_parse(self, rev):
+        # Like `git rev-parse`, full sha1s are returned as is, whether the
+        # object exists or not.
+        if len(rev) == 40 and not rev.strip('0123456789abcdef'):
+            return rev
+        # Don't reuse the process of a parent process.
+        if self._cat_file_check_pid != os.getpid():
+            self._cat_file_check = GitProcess(
+                'cat-file', '--batch-check', stdin=subprocess.PIPE)
+            self._cat_file_check_pid = os.getpid()
+            atexit.register(self._close_cat_file_check)
+        proc = self._cat_file_check
+        proc.stdin.write('%s\n' % rev)
+        proc.stdin.flush()
+        result = proc.stdout.readline().split()
+        # Missing or ambiguous revisions come back with their name and a
+        # single word, instead of a sha1, a type and a size.
+        if len(result) == 3:
+            return result[0]
+        return None
+
+    @classmethod
+    def _close_cat_file_check(self):
+        if self._cat_file_check_pid == os.getpid():
+            self._cat_file_check.stdin.close()
+            self._cat_file_check.wait()
+            self._cat_file_check = None
+            self._cat_file_check_pid = None
 
     @classmethod
     def resolve_ref(self, ref):
         if ref not in self._refs:
-            self._initial_refs[ref] = one(
-                Git.iter('rev-parse', '--revs-only', ref))
+            if (self._refs_loaded and ref not in self._initial_refs and
+                    self._is_ref_name(ref)):
+                # All refs are known, so this one doesn't exist.
+                self._initial_refs[ref] = None
+            else:
+                self._initial_refs[ref] = self._rev_parse(ref)
         return self._refs[ref]
 
+    @classmethod
+    def git_dir(self):
+        if self._git_dir is None:
+            self._git_dir = os.path.abspath(
+                one(Git.iter('rev-parse', '--git-dir')))
+        return self._git_dir
+
     @classmethod
     def cat_file(self, typ, sha1):
         from githg import GitHgHelper
@@ -206,8 +287,7 @@ class Git(object):
         self.update_ref(ref, '0' * 40, oldvalue)
 
     @classmethod
-    def config(self, name, remote=None, values={}, multiple=False):
-        assert not (values and multiple)
+    def _load_config(self):
         if self._config is None:
             proc = GitProcess('config', '-l', '-z')
             data = proc.stdout.read()
@@ -220,6 +300,20 @@ class Git(object):
                         self._config[k] += '\0' + v
                     else:
                         self._config[k] = v
+
+    @classmethod
+    def iter_config(self):
+        '''Iterate over the (name, value) pairs of the git configuration,
+        like `git config -l` does.'''
+        self._load_config()
+        for name, values in sorted(self._config.iteritems()):
+            for value in values.split('\0'):
+                yield name, value
+
+    @classmethod
+    def config(self, name, remote=None, values={}, multiple=False):
+        assert not (values and multiple)
+        self._load_config()
         var = name
         value = None
         if name.startswith('cinnabar.'):
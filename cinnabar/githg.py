@@ -4,7 +4,10 @@ from __future__ import division
 from binascii import hexlify, unhexlify
 from itertools import izip
 import hashlib
+import os
+import struct
 import urllib
+import zlib
 from collections import (
     Sequence,
     defaultdict,
@@ -13,13 +16,17 @@ from .util import (
     byte_diff,
     check_enabled,
     one,
+    parse_size,
+    PieceTable,
     VersionedDict,
 )
+from .diskcache import DiskCache
 from .git import (
     EMPTY_BLOB,
     EMPTY_TREE,
     FastImport,
     Git,
+    InvalidConfig,
     NULL_NODE_ID,
 )
 from .hg.changegroup import (
@@ -91,20 +98,18 @@ class RevChunk(object):
                                     else '', self._rev_data)
 
     def patch_data(self, data, rev_patch):
-        return RevDiff(rev_patch).apply(data)
+        return RevDiff(rev_patch).apply_buffer(data)
 
     @property
     def sha1(self):
         p1 = unhexlify(self.parent1)
         p2 = unhexlify(self.parent2)
-        return hashlib.sha1(
-            min(p1, p2) +
-            max(p1, p2) +
-            self.data
-        ).hexdigest()
+        h = hashlib.sha1(min(p1, p2) + max(p1, p2))
+        h.update(self.data)
+        return h.hexdigest()
 
     def diff(self, other):
-        return textdiff(other.data if other else '', self.data)
+        return textdiff(str(other.data) if other else '', str(self.data))
 
     def serialize(self, other, type):
         result = type()
@@ -206,12 +211,12 @@ class FileFindParents(object):
                                              if p in mapping))
 
                 file_dag.tag_nodes_and_parents((parents[0],), 'a')
-                if file_dag._tags.get(parents[1]) == 'a':
+                if file_dag.tag(parents[1]) == 'a':
                     parents = parents[:1]
                 else:
-                    file_dag._tags.clear()
+                    file_dag.clear_tags()
                     file_dag.tag_nodes_and_parents((parents[1],), 'b')
-                    if file_dag._tags.get(parents[0]) == 'b':
+                    if file_dag.tag(parents[0]) == 'b':
                         parents = parents[1:]
 
         file.parents = parents
@@ -283,39 +288,53 @@ def isplitmanifest(data):
 
 
 class ManifestInfo(RevChunk):
-    __slots__ = ('removed', 'modified')
+    __slots__ = ('removed', 'modified', 'text')
 
-    def patch_data(self, raw_data, rev_patch):
-        new = bytearray()
-        data = memoryview(raw_data)
-        end = 0
+    # The manifest text is kept as a PieceTable, such that patching doesn't
+    # need to copy the whole text for each revision, and the full text is
+    # only materialized when really needed.
+    def init(self, previous_chunk):
+        assert self.delta_node == NULL_NODE_ID or previous_chunk
+        self.text = self.patch_text(previous_chunk.text if previous_chunk
+                                    else PieceTable(), self._rev_data)
+
+    @property
+    def data(self):
+        return str(self.text)
+
+    @property
+    def sha1(self):
+        p1 = unhexlify(self.parent1)
+        p2 = unhexlify(self.parent2)
+        h = hashlib.sha1(min(p1, p2) + max(p1, p2))
+        for buf in self.text:
+            h.update(buf)
+        return h.hexdigest()
+
+    def patch_text(self, text, rev_patch):
+        diffs = list(RevDiff(rev_patch))
         before_list = {}
         after_list = {}
-        for diff in RevDiff(rev_patch):
-            new += data[end:diff.start]
-            new += diff.text_data
-            end = diff.end
-
-            start = raw_data.rfind('\n', 0, diff.start) + 1
-            if diff.end == 0 or data[diff.end - 1] == '\n':
+        for diff in diffs:
+            start = text.rfind('\n', 0, diff.start) + 1
+            if diff.end == 0 or text[diff.end - 1] == '\n':
                 finish = diff.end
             else:
-                finish = raw_data.find('\n', diff.end)
+                finish = text.find('\n', diff.end)
             if finish != -1:
-                before = data[start:finish]
+                before = text[start:finish]
             else:
-                before = data[start:]
-            after = before[:diff.start - start].tobytes() + \
+                before = text[start:]
+            after = before[:diff.start - start] + \
                 diff.text_data.tobytes() + \
-                before[diff.end - start:].tobytes()
+                before[diff.end - start:]
             before_list.update({f.name: (f.node, f.attr)
-                                for f in isplitmanifest(before.tobytes())})
+                                for f in isplitmanifest(before)})
             after_list.update({f.name: (f.node, f.attr)
                                for f in isplitmanifest(after)})
-        new += data[end:]
         self.removed = set(before_list.keys()) - set(after_list.keys())
         self.modified = after_list
-        return new
+        return text.patch(diffs)
 
 
 class ChangesetPatcher(str):
@@ -478,6 +497,10 @@ class GeneratedManifestInfo(GeneratedRevChunk, ManifestInfo):
         self._data = value
         self.__lines = None
 
+    @property
+    def text(self):
+        return PieceTable(str(self.data))
+
     @property
     def _lines(self):
         if self.__lines is None:
@@ -534,6 +557,70 @@ class TagSet(object):
     def hist(self, key):
         return set(self._taghist[key])
 
+    def copy(self):
+        result = TagSet()
+        result._tags = dict(self._tags)
+        for key, hist in self._taghist.iteritems():
+            result._taghist[key] = set(hist)
+        return result
+
+    # Tag sets are stored in refs/cinnabar/tag-sets in a binary form,
+    # starting with this magic. Older versions of git-cinnabar stored them
+    # in a text form in refs/cinnabar/tag-cache, where they would choke on
+    # the binary form. The header that follows gives the length
+    # and sha1 of the .hgtags content the tag set was computed from, so
+    # that the tag set of a .hgtags file extending it can be computed
+    # incrementally. Then, for each tag, come the length of its name, the
+    # number of nodes in its history, the name, its node and the nodes in
+    # its history.
+    CACHE_MAGIC = '\0tags\1\n'
+    NO_DIGEST = '\0' * 20
+
+    def to_cache(self, length=0, digest=NO_DIGEST):
+        result = [self.CACHE_MAGIC, struct.pack('>I', length), digest]
+        for tag, node in sorted(self._tags.iteritems()):
+            hist = sorted(self._taghist[tag])
+            result.append(struct.pack('>HH', len(tag), len(hist)))
+            result.append(tag)
+            result.append(unhexlify(node))
+            result.extend(unhexlify(h) for h in hist)
+        return ''.join(result)
+
+    @classmethod
+    def from_cache(cls, data):
+        '''Return the tag set stored in the given tag cache data, along
+        with the length and sha1 of the .hgtags content it was computed
+        from. The length is 0 when the tag set can't be used as a base for
+        incremental computation.'''
+        tags = cls()
+        if not data.startswith(cls.CACHE_MAGIC):
+            # Old text format.
+            for line in data.splitlines():
+                tag, nodes = line.split('\0', 1)
+                nodes = nodes.split(' ')
+                for node in reversed(nodes):
+                    tags[tag] = node
+            return tags, 0, cls.NO_DIGEST
+
+        offset = len(cls.CACHE_MAGIC)
+        length, = struct.unpack_from('>I', data, offset)
+        offset += 4
+        digest = data[offset:offset + 20]
+        offset += 20
+        while offset < len(data):
+            tag_len, hist_len = struct.unpack_from('>HH', data, offset)
+            offset += 4
+            tag = data[offset:offset + tag_len]
+            offset += tag_len
+            tags._tags[tag] = hexlify(data[offset:offset + 20])
+            offset += 20
+            if hist_len:
+                tags._taghist[tag] = set(
+                    hexlify(data[o:o + 20])
+                    for o in xrange(offset, offset + hist_len * 20, 20))
+                offset += hist_len * 20
+        return tags, length, digest
+
 
 class GitCommit(object):
     __slots__ = ('sha1', 'body', 'parents', 'tree', 'author', 'committer')
@@ -583,6 +670,10 @@ class BranchMap(object):
         self._tips = {}
         self._git_sha1s = {}
         self._unknown_heads = set()
+        all_heads = list(set(autohexlify(h)
+                             for heads in remote_branchmap.itervalues()
+                             for h in heads))
+        refs = dict(izip(all_heads, store.changeset_ref_many(all_heads)))
         for branch, heads in remote_branchmap.iteritems():
             # We can't keep track of tips if the list of heads is not sequenced
             sequenced = isinstance(heads, Sequence) or len(heads) == 1
@@ -590,7 +681,7 @@ class BranchMap(object):
             for head in heads:
                 head = autohexlify(head)
                 branch_heads.append(head)
-                sha1 = store.changeset_ref(head)
+                sha1 = refs[head]
                 if not sha1:
                     self._unknown_heads.add(head)
                     continue
@@ -631,22 +722,148 @@ class AmbiguousGraftException(Exception):
     pass
 
 
+class GraftIndex(object):
+    '''Persistent index of graft candidates, stored in
+    refs/cinnabar/graft-index. For each git tree, it holds the list of
+    (author timestamp, subject hash, commit) for the commits with that tree.
+
+    The index also records the tips of the refs it was computed from, so
+    that it can be updated with only the commits added or removed since.'''
+    __slots__ = "_trees", "tips", "changed"
+
+    REF = 'refs/cinnabar/graft-index'
+    MAGIC = '\0graft\1\n'
+    ENTRY = struct.Struct('>20s20sqI')
+
+    def __init__(self):
+        self._trees = defaultdict(list)
+        self.tips = set()
+        self.changed = False
+
+    @staticmethod
+    def subject_hash(body):
+        return zlib.crc32(body.split('\n', 1)[0]) & 0xffffffff
+
+    def add(self, tree, timestamp, subject_hash, commit):
+        self._trees[tree].append((timestamp, subject_hash, commit))
+        self.changed = True
+
+    def remove(self, commits):
+        for tree, candidates in self._trees.items():
+            kept = [c for c in candidates if c[2] not in commits]
+            if len(kept) != len(candidates):
+                self.changed = True
+                if kept:
+                    self._trees[tree] = kept
+                else:
+                    del self._trees[tree]
+
+    def get(self, tree):
+        return self._trees.get(tree, ())
+
+    def __len__(self):
+        return len(self._trees)
+
+    def to_data(self):
+        entry = self.ENTRY.pack
+        return self.MAGIC + ''.join(
+            entry(unhexlify(tree), unhexlify(commit), timestamp,
+                  subject_hash)
+            for tree, candidates in sorted(self._trees.iteritems())
+            for timestamp, subject_hash, commit in candidates
+        )
+
+    @classmethod
+    def from_data(cls, data):
+        index = cls()
+        if not data.startswith(cls.MAGIC):
+            return index
+        trees = index._trees
+        size = cls.ENTRY.size
+        unpack = cls.ENTRY.unpack_from
+        for off in xrange(len(cls.MAGIC), len(data), size):
+            tree, commit, timestamp, subject_hash = unpack(data, off)
+            trees[hexlify(tree)].append(
+                (timestamp, subject_hash, hexlify(commit)))
+        return index
+
+    @classmethod
+    def load(cls):
+        '''Return the index stored in refs/cinnabar/graft-index, or an
+        empty index.'''
+        if not Git.resolve_ref(cls.REF):
+            return cls()
+        blobs = dict((path, sha1) for mode, typ, sha1, path
+                     in Git.ls_tree(cls.REF))
+        if 'index' not in blobs or 'tips' not in blobs:
+            return cls()
+        index = cls.from_data(GitHgHelper.cat_file('blob', blobs['index']))
+        index.tips = set(
+            GitHgHelper.cat_file('blob', blobs['tips']).split())
+        return index
+
+    def save(self, fast_import):
+        with fast_import.commit(ref=self.REF) as commit:
+            commit.filemodify('index', content=self.to_data())
+            commit.filemodify('tips', content=''.join(
+                '%s\n' % t for t in sorted(self.tips)))
+        self.changed = False
+
+    def update(self, tips, exclude=()):
+        '''Update the index for the given ref tips. Commits reachable from
+        `exclude` are not added to the index.'''
+        tips = set(tips)
+        old_tips = self.tips
+        if old_tips and any(typ == 'missing' for sha1, typ, data in
+                            GitHgHelper.cat_file_many('auto', old_tips)):
+            # Some previous tip is gone, so we can't know what commits
+            # are gone with it. Start over.
+            self._trees.clear()
+            old_tips = set()
+        if old_tips - tips:
+            args = ['--full-history'] + sorted(old_tips - tips)
+            args += ['--not'] + sorted(tips)
+            removed = set(node for node, tree, parents in
+                          GitHgHelper.rev_list(*args))
+            if removed:
+                self.remove(removed)
+        if tips - old_tips:
+            args = ['--full-history'] + sorted(tips - old_tips)
+            args += ['--not'] + sorted(old_tips) + list(exclude)
+            new = {}
+            for node, tree, parents in progress_iter(
+                    'Reading %d graft candidates',
+                    GitHgHelper.rev_list(*args)):
+                new[node] = tree
+            for node, typ, data in progress_iter(
+                    'Indexing %d graft candidates',
+                    GitHgHelper.cat_file_many('commit', new)):
+                commit = GitCommit(node)
+                self.add(new[node],
+                         Authorship.from_git_str(commit.author).timestamp,
+                         self.subject_hash(commit.body), node)
+        if tips != self.tips:
+            self.tips = tips
+            self.changed = True
+
+
 class Grafter(object):
-    __slots__ = "_store", "_early_history", "_graft_trees", "_grafted"
+    __slots__ = "_store", "_early_history", "_index", "_used", "_grafted"
 
     def __init__(self, store):
         self._store = store
         self._early_history = set()
-        self._graft_trees = defaultdict(list)
+        self._used = set()
         self._grafted = False
-        refs = ['--exclude=refs/cinnabar/*', '--all']
-        if store._has_metadata:
-            refs += ['--not', 'refs/cinnabar/metadata^']
-        for node, tree, parents in progress_iter(
-                'Reading %d graft candidates',
-                GitHgHelper.rev_list('--full-history', *refs)):
-            self._graft_trees[tree].append(node)
-        if not self._graft_trees:
+        tips = set(sha1 for sha1, ref in Git.for_each_ref('refs/')
+                   if not ref.startswith('refs/cinnabar/'))
+        head = Git.resolve_ref('HEAD')
+        if head:
+            tips.add(head)
+        self._index = GraftIndex.load()
+        self._index.update(tips, exclude=['refs/cinnabar/metadata^']
+                           if store._has_metadata else ())
+        if not self._index:
             raise NothingToGraftException()
 
     def _is_cinnabar_commit(self, commit):
@@ -656,20 +873,22 @@ class Grafter(object):
     def _graft(self, changeset, parents):
         store = self._store
         tree = store.git_tree(changeset.manifest)
-        do_graft = tree in self._graft_trees
-        if not do_graft:
+        timestamp = int(changeset.timestamp)
+        # Only commits with the right timestamp are loaded, and commits that
+        # were grafted, either during this run or a previous one, are
+        # skipped.
+        candidates = tuple(
+            (c, subject_hash) for t, subject_hash, c in self._index.get(tree)
+            if t == timestamp and c not in self._used and
+            not store.read_changeset_data(c))
+        if not candidates:
             return None
 
         commits = {}
+        subjects = dict(candidates)
 
         def graftable(c):
-            commit = commits.get(c)
-            if not commit:
-                commit = commits[c] = GitCommit(c)
-            if (Authorship.from_git_str(commit.author).timestamp !=
-                    int(changeset.timestamp)):
-                return False
-
+            commit = commits[c] = GitCommit(c)
             if all(store._replace.get(p1, p1) == store._replace.get(p2, p2)
                    for p1, p2 in zip(commit.parents, parents)):
                 return True
@@ -677,7 +896,7 @@ class Grafter(object):
             # Allow to graft if one of the parents is from early history
             return any(p in self._early_history for p in parents)
 
-        nodes = tuple(c for c in self._graft_trees[tree] if graftable(c))
+        nodes = tuple(c for c, subject_hash in candidates if graftable(c))
 
         if len(nodes) > 1:
             # Ideally, this should all be tried with fuzziness, and
@@ -686,9 +905,11 @@ class Grafter(object):
             # to mozilla-central and related repositories.
             # Try with commits with the same subject line
             subject = changeset.body.split('\n', 1)[0]
+            subject_hash = GraftIndex.subject_hash(subject)
             possible_nodes = tuple(
                 n for n in nodes
-                if commits[n].body.split('\n', 1)[0] == subject
+                if subjects[n] == subject_hash and
+                commits[n].body.split('\n', 1)[0] == subject
             )
             if len(possible_nodes) > 1:
                 # Try with commits with the same author ; this is attempted
@@ -723,7 +944,7 @@ class Grafter(object):
 
         if nodes:
             node = nodes[0]
-            self._graft_trees[tree].remove(node)
+            self._used.add(node)
             return commits[node]
         return None
 
@@ -759,10 +980,42 @@ class Grafter(object):
             self._grafted = True
 
     def close(self):
+        if self._index.changed:
+            self._index.save(self._store._fast_import)
         if not self._grafted and self._early_history:
             raise NothingToGraftException()
 
 
+class ManifestCache(DiskCache):
+    '''Compressed manifest texts, keyed by mercurial manifest node.'''
+
+    def __init__(self, max_bytes=0):
+        super(ManifestCache, self).__init__(
+            os.path.join(Git.git_dir(), 'cinnabar', 'manifests'), max_bytes)
+
+    @classmethod
+    def from_config(self):
+        '''Return a ManifestCache with the size configured with
+        cinnabar.manifest-cache-size, or None when it is not set.'''
+        size = Git.config('cinnabar.manifest-cache-size')
+        if not size:
+            return None
+        try:
+            size = parse_size(size)
+        except ValueError:
+            raise InvalidConfig(
+                'Invalid value for cinnabar.manifest-cache-size: %s' % size)
+        return self(size) if size else None
+
+    def get(self, node):
+        data = super(ManifestCache, self).get(node)
+        if data is not None:
+            return zlib.decompress(data)
+
+    def put(self, node, data):
+        super(ManifestCache, self).put(node, zlib.compress(data, 1))
+
+
 class GitHgStore(object):
     FLAGS = [
         'files-meta',
@@ -822,7 +1075,14 @@ class GitHgStore(object):
 
         self._tagcache = {}
         self._tagfiles = {}
-        self._tags = {NULL_NODE_ID: {}}
+        self._tags = {NULL_NODE_ID: TagSet()}
+        self._tagbases = {}
+        self._tagsets = {}
+        self._tagsets_ref = Git.resolve_ref('refs/cinnabar/tag-sets')
+        if self._tagsets_ref:
+            for line in Git.ls_tree(self._tagsets_ref):
+                mode, typ, sha1, path = line
+                self._tagsets[path] = sha1
         self._tagcache_ref = Git.resolve_ref('refs/cinnabar/tag-cache')
         self._tagcache_items = set()
         if self._tagcache_ref:
@@ -852,6 +1112,7 @@ class GitHgStore(object):
                     self._hgheads._previous[hghead] = branch
 
         self._manifest_heads_orig = set(GitHgHelper.heads('manifests'))
+        self._manifest_cache = ManifestCache.from_config()
 
         if metadata:
             replace = {}
@@ -872,50 +1133,119 @@ class GitHgStore(object):
         # revision number, such that the last is the one where
         # tags are the most relevant.
         tags = TagSet()
-        for h in heads:
-            h = self.changeset_ref(h)
-            tags.update(self._get_hgtags(h))
+        tagfiles = [self._hgtags_file(h)
+                    for h in self.changeset_ref_many(heads)]
+        self._load_hgtags(tagfiles)
+        for tagfile in tagfiles:
+            tags.update(self._tags[tagfile])
         for tag, node in tags:
             if node != NULL_NODE_ID:
                 yield tag, node
 
-    def _get_hgtags(self, head):
-        tags = TagSet()
+    def _hgtags_file(self, head):
         if not self._tagcache.get(head):
             ls = one(Git.ls_tree(head, '.hgtags'))
             if not ls:
                 self._tagcache[head] = NULL_NODE_ID
-                return tags
-            mode, typ, self._tagcache[head], path = ls
-        tagfile = self._tagcache[head]
-        if tagfile not in self._tags:
-            if tagfile in self._tagfiles:
-                data = GitHgHelper.cat_file('blob', self._tagfiles[tagfile])
-                for line in data.splitlines():
-                    tag, nodes = line.split('\0', 1)
-                    nodes = nodes.split(' ')
-                    for node in reversed(nodes):
-                        tags[tag] = node
             else:
-                data = GitHgHelper.cat_file('blob', tagfile) or ''
-                for line in data.splitlines():
-                    if not line:
-                        continue
-                    try:
-                        node, tag = line.split(' ', 1)
-                    except ValueError:
-                        continue
-                    tag = tag.strip()
-                    try:
-                        unhexlify(node)
-                    except TypeError:
-                        continue
-                    if node != NULL_NODE_ID:
-                        node = self.changeset_ref(node)
-                    if node:
-                        tags[tag] = node
-        self._tags[tagfile] = tags
-        return tags
+                mode, typ, self._tagcache[head], path = ls
+        return self._tagcache[head]
+
+    # Maximum number of known tag sets tried as bases for a new .hgtags
+    # file.
+    MAX_TAG_BASES = 4
+
+    def _cached_tagset(self, tagfile):
+        return self._tagsets.get(tagfile) or self._tagfiles.get(tagfile)
+
+    def _load_hgtags(self, tagfiles):
+        missing = set(f for f in tagfiles if f not in self._tags)
+        new = [f for f in missing if not self._cached_tagset(f)]
+        if new:
+            # The tag sets of the .hgtags files of the heads in the tag
+            # cache may be used as bases for the new ones.
+            missing.update(f for f in self._tagcache.itervalues()
+                           if f and f not in self._tags and
+                           self._cached_tagset(f))
+        cached = [f for f in missing if self._cached_tagset(f)]
+        blobs = GitHgHelper.cat_file_many(
+            'blob', (self._cached_tagset(f) for f in cached))
+        for tagfile, (sha1, typ, data) in izip(cached, blobs):
+            tags, length, digest = TagSet.from_cache(data)
+            self._tags[tagfile] = tags
+            if length:
+                self._tagbases[tagfile] = (length, digest)
+
+        if not new:
+            return
+        heads_tagfiles = set(self._tagcache.itervalues())
+        bases = sorted(
+            ((length, digest, f)
+             for f, (length, digest) in self._tagbases.iteritems()
+             if f in heads_tagfiles),
+            reverse=True)[:self.MAX_TAG_BASES]
+        blobs = GitHgHelper.cat_file_many('blob', new)
+        for tagfile, (sha1, typ, data) in izip(new, blobs):
+            data = data or ''
+            base, start = self._find_hgtags_base(data, bases)
+            tags = self._tags[base].copy() if base else TagSet()
+            complete = self._parse_hgtags(tags, data, start)
+            self._tags[tagfile] = tags
+            # Tag sets with tags that couldn't be resolved are not used as
+            # bases, so that those tags can appear in the tag sets of later
+            # .hgtags files, once their changesets are known.
+            if complete and data.endswith('\n'):
+                self._tagbases[tagfile] = (len(data),
+                                           hashlib.sha1(data).digest())
+
+    @staticmethod
+    def _find_hgtags_base(data, bases):
+        '''Find the largest .hgtags file amongst the given (length, sha1,
+        file) bases, sorted by decreasing length, that the given .hgtags
+        content starts with. .hgtags files are mostly appended to, so the
+        tag set for the content can be derived from that tag set and the
+        lines that were added.'''
+        digests = {}
+        for length, digest, tagfile in bases:
+            if length > len(data):
+                continue
+            if length not in digests:
+                digests[length] = hashlib.sha1(buffer(data, 0, length)) \
+                    .digest()
+            if digests[length] == digest:
+                return tagfile, length
+        return None, 0
+
+    def _parse_hgtags(self, tags, data, start=0):
+        '''Apply the lines of the given .hgtags content, from the given
+        offset, to the tag set. Returns whether all the tags could be
+        resolved.'''
+        entries = []
+        for line in data[start:].splitlines():
+            if not line:
+                continue
+            try:
+                node, tag = line.split(' ', 1)
+            except ValueError:
+                continue
+            tag = tag.strip()
+            try:
+                unhexlify(node)
+            except TypeError:
+                continue
+            entries.append((node, tag))
+
+        complete = True
+        refs = iter(self.changeset_ref_many(
+            node for node, tag in entries if node != NULL_NODE_ID))
+        for node, tag in entries:
+            if node != NULL_NODE_ID:
+                node = next(refs)
+            if node:
+                tags[tag] = node
+            else:
+                complete = False
+        return complete
 
     def heads(self, branches={}):
         if not isinstance(branches, (dict, set)):
@@ -960,6 +1290,14 @@ class GitHgStore(object):
             return data[10:50]
         return None
 
+    def hg_changeset_many(self, sha1s):
+        for data in GitHgHelper.git2hg_many(str(s) for s in sha1s):
+            if data:
+                assert data.startswith('changeset ')
+                yield data[10:50]
+            else:
+                yield None
+
     def hg_manifest(self, sha1):
         git_commit = GitCommit(sha1)
         assert len(git_commit.body) == 40
@@ -1006,7 +1344,14 @@ class GitHgStore(object):
 
     def manifest(self, sha1, include_parents=False):
         manifest = GeneratedManifestInfo(sha1)
-        manifest.data = GitHgHelper.manifest(sha1)
+        data = None
+        if self._manifest_cache:
+            data = self._manifest_cache.get(sha1)
+        if data is None:
+            data = GitHgHelper.manifest(sha1)
+            if self._manifest_cache and data is not None:
+                self._manifest_cache.put(sha1, data)
+        manifest.data = data
         if include_parents:
             git_sha1 = self.manifest_ref(sha1)
             commit = GitCommit(git_sha1)
@@ -1020,6 +1365,12 @@ class GitHgStore(object):
     def changeset_ref(self, sha1):
         return self._hg2git(sha1)
 
+    def changeset_ref_many(self, sha1s):
+        for gitsha1 in GitHgHelper.hg2git_many(sha1s):
+            if gitsha1 == NULL_NODE_ID:
+                gitsha1 = None
+            yield gitsha1
+
     def file_meta(self, sha1):
         return GitHgHelper.file_meta(sha1)
 
@@ -1221,8 +1572,7 @@ class GitHgStore(object):
                 update_metadata.append('refs/notes/cinnabar')
 
         hg_changeset_heads = list(self._hgheads)
-        changeset_heads = sorted(self.changeset_ref(h)
-                                 for h in hg_changeset_heads)
+        changeset_heads = sorted(self.changeset_ref_many(hg_changeset_heads))
         if any(self._hgheads.iterchanges()):
             with self._fast_import.commit(
                 ref='refs/cinnabar/changesets',
@@ -1277,32 +1627,41 @@ class GitHgStore(object):
             if c not in changeset_heads:
                 self._tagcache[c] = False
 
-        for c in changeset_heads:
-            if c not in self._tagcache:
-                tags = self._get_hgtags(c)
+        self._load_hgtags([self._hgtags_file(c) for c in changeset_heads
+                           if c not in self._tagcache])
 
         files = set(self._tagcache.itervalues())
         deleted = set()
         created = {}
+        # Tag sets in the text form that older versions of git-cinnabar
+        # stored in the tag cache are kept as long as they are used.
         for f in self._tagcache_items:
             if (f not in self._tagcache and f not in self._tagfiles or
                     f not in files and f in self._tagfiles):
                 deleted.add(f)
 
-        def tagset_lines(tags):
-            for tag, value in tags:
-                yield '%s\0%s %s\n' % (tag, value,
-                                       ' '.join(sorted(tags.hist(tag))))
-
+        tagsets_deleted = set(f for f in self._tagsets if f not in files)
+        tagsets_created = {}
         for f, tags in self._tags.iteritems():
-            if f not in self._tagfiles and f != NULL_NODE_ID:
-                data = ''.join(tagset_lines(tags))
-                mark = self._fast_import.put_blob(data=data)
-                created[f] = (mark, 'exec')
+            if f in files and f not in self._tagsets and f != NULL_NODE_ID:
+                data = tags.to_cache(*self._tagbases.get(f, ()))
+                tagsets_created[f] = self._fast_import.put_blob(data=data)
 
-        if created or deleted:
+        if (deleted or tagsets_deleted or
+                any(f not in self._tagfiles for f in tagsets_created)):
             self.tag_changes = True
 
+        if tagsets_created or tagsets_deleted:
+            with self._fast_import.commit(
+                ref='refs/cinnabar/tag-sets',
+                from_commit=self._tagsets_ref,
+            ) as commit:
+                for f in tagsets_deleted:
+                    commit.filedelete(f)
+
+                for f, mark in tagsets_created.iteritems():
+                    commit.filemodify(f, mark)
+
         for c, f in self._tagcache.iteritems():
             if (f and c not in self._tagcache_items):
                 if f == NULL_NODE_ID:
@@ -14,10 +14,15 @@ from .hg.changegroup import (
 )
 from .util import (
     IOLogger,
+    iter_batches,
     lrucache,
     Process,
 )
 from contextlib import contextmanager
+from itertools import (
+    chain,
+    izip,
+)
 
 
 class NoHelperException(Exception):
@@ -36,8 +41,7 @@ class BaseHelper(object):
         self._helper = self
 
     @classmethod
-    @contextmanager
-    def query(self, name, *args):
+    def _ensure_helper(self):
         if self._helper is False:
             helper_path = Git.config('cinnabar.helper')
             if helper_path == '':
@@ -79,6 +83,11 @@ class BaseHelper(object):
         if self._helper is self:
             raise HelperClosedException
 
+    @classmethod
+    @contextmanager
+    def query(self, name, *args):
+        self._ensure_helper()
+
         if name == 'version':
             yield StringIO(self._version)
             return
@@ -131,7 +140,18 @@ class BaseHelper(object):
 
 
 class GitHgHelper(BaseHelper):
-    VERSION = 24
+    VERSION = 25
+    # Maximum number of sha1s sent in a single hg2git or git2hg query.
+    LOOKUP_BATCH_SIZE = 1000
+    # Maximum number of objects requested in a single cat-file query.
+    CAT_FILE_BATCH_SIZE = 100
+
+    @classmethod
+    def close(self):
+        if self._helper and self._helper is not self:
+            for func in (self._cat_commit, self.git2hg, self.hg2git):
+                func.cache.log_stats()
+        super(GitHgHelper, self).close()
     _helper = False
 
     @classmethod
@@ -140,7 +160,7 @@ class GitHgHelper(BaseHelper):
             return self._read_file(typ, stdout)
 
     @classmethod
-    @lrucache(16)
+    @lrucache(name='commit')
     def _cat_commit(self, sha1):
         return self._cat_file('commit', sha1)
 
@@ -151,25 +171,72 @@ class GitHgHelper(BaseHelper):
         return self._cat_file(typ, sha1)
 
     @classmethod
-    @lrucache(16)
+    def cat_file_many(self, typ, sha1s):
+        '''Like cat_file, for an iterable of sha1s, yielding (sha1, type,
+        data) tuples in the same order as the given sha1s. The type is
+        'missing' and the data None for objects that don't exist. With typ
+        'auto', objects of any type are accepted.
+
+        Objects are requested in batches, one query for many objects, like
+        `git cat-file --batch` does. A batch is entirely read before its
+        objects are yielded, so that consumers can do other queries.'''
+        for batch in iter_batches(sha1s, self.CAT_FILE_BATCH_SIZE):
+            with self.query('cat-file', *batch) as stdout:
+                result = [self._read_file('auto', stdout) for _ in batch]
+            for sha1, (obj_typ, data) in izip(batch, result):
+                assert typ in ('auto', obj_typ) or obj_typ == 'missing'
+                if obj_typ == 'commit' and len(sha1) == 40:
+                    self._cat_commit.cache[self, sha1] = data
+                yield sha1, obj_typ, data
+
+    @classmethod
+    @lrucache(name='git2hg')
     def git2hg(self, sha1):
         assert sha1 != 'changeset'
         with self.query('git2hg', sha1) as stdout:
             return self._read_file('blob', stdout)
 
+    @classmethod
+    def git2hg_many(self, sha1s):
+        '''Like git2hg, for an iterable of sha1s. Results are yielded in the
+        same order as the given sha1s.'''
+        for batch in iter_batches(sha1s, self.LOOKUP_BATCH_SIZE):
+            # All the responses need to be read before yielding anything,
+            # otherwise, a consumer stopping early would leave them unread.
+            with self.query('git2hg', *batch) as stdout:
+                result = [self._read_file('blob', stdout) for _ in batch]
+            for sha1, data in izip(batch, result):
+                if len(sha1) == 40:
+                    self.git2hg.cache[self, sha1] = data
+                yield data
+
     @classmethod
     def file_meta(self, sha1):
         with self.query('file-meta', sha1) as stdout:
             return self._read_file('blob', stdout)
 
     @classmethod
-    @lrucache(16)
+    @lrucache(name='hg2git')
     def hg2git(self, hg_sha1):
         with self.query('hg2git', hg_sha1) as stdout:
             sha1 = stdout.read(41)
             assert sha1[-1] == '\n'
             return sha1[:40]
 
+    @classmethod
+    def hg2git_many(self, hg_sha1s):
+        '''Like hg2git, for an iterable of sha1s. Results are yielded in the
+        same order as the given sha1s.'''
+        for batch in iter_batches(hg_sha1s, self.LOOKUP_BATCH_SIZE):
+            with self.query('hg2git', *batch) as stdout:
+                result = stdout.read(41 * len(batch))
+            for hg_sha1, pos in izip(batch, xrange(0, len(result), 41)):
+                assert result[pos + 40] == '\n'
+                sha1 = result[pos:pos + 40]
+                if len(hg_sha1) == 40:
+                    self.hg2git.cache[self, hg_sha1] = sha1
+                yield sha1
+
     @classmethod
     def manifest(self, hg_sha1):
         with self.query('manifest', hg_sha1) as stdout:
@@ -224,6 +291,13 @@ class GitHgHelper(BaseHelper):
                 yield (mode_before, mode_after, sha1_before, sha1_after,
                        status, path)
 
+    @classmethod
+    def bdiff(self, a, b):
+        with self.query('bdiff', str(len(a)), str(len(b))) as stdout:
+            self._helper.stdin.write(a)
+            self._helper.stdin.write(b)
+            return self._read_data(stdout)
+
     @classmethod
     def set(self, *args):
         if args[0] == 'changeset-metadata':
@@ -233,6 +307,31 @@ class GitHgHelper(BaseHelper):
         with self.query('set', *args):
             pass
 
+    @classmethod
+    def file_node_many(self, items):
+        '''Return the mercurial nodes of files without metadata, for an
+        iterable of (blob sha1, parent1, parent2). The null node is returned
+        for blobs that can't be handled this way.'''
+        for batch in iter_batches(items, self.LOOKUP_BATCH_SIZE):
+            with self.query('file-node', *chain(*batch)) as stdout:
+                result = stdout.read(41 * len(batch))
+            for pos in xrange(0, len(result), 41):
+                assert result[pos + 40] == '\n'
+                yield result[pos:pos + 40]
+
+    @classmethod
+    def set_many(self, what, items):
+        '''Like set, for an iterable of (hg_sha1, git_sha1) pairs, all sent
+        to the helper in one write.'''
+        assert what not in ('changeset-metadata', 'file-meta')
+        lines = []
+        for hg_sha1, sha1 in items:
+            self.hg2git.invalidate(self, hg_sha1)
+            lines.append('set %s %s %s\n' % (what, hg_sha1, sha1))
+        if lines:
+            self._ensure_helper()
+            self._helper.stdin.write(''.join(lines))
+
     @classmethod
     def store(self, what, *args):
         if what == 'metadata':
@@ -242,17 +341,45 @@ class GitHgHelper(BaseHelper):
                 return sha1[:40]
         elif what == 'file':
             obj = args[0]
-            if isinstance(obj, RawRevChunk01):
-                delta_node = obj.delta_node
-            elif isinstance(obj, RawRevChunk02):
-                delta_node = 'cg2'
-            else:
-                assert False
-            with self.query('store', what, delta_node, str(len(obj))):
+            with self.query('store', what, self._delta_node(obj),
+                            str(len(obj))):
                 self._helper.stdin.write(obj)
         else:
             assert False
 
+    @staticmethod
+    def _delta_node(obj):
+        if isinstance(obj, RawRevChunk01):
+            return obj.delta_node
+        elif isinstance(obj, RawRevChunk02):
+            return 'cg2'
+        assert False
+
+    # Size above which pending store commands are sent to the helper.
+    STORE_BATCH_SIZE = 1024 * 1024
+
+    @classmethod
+    def store_files(self, chunks):
+        '''Store the given file chunks.
+
+        Instead of doing one write per command and per chunk like
+        `store('file', chunk)`, the store commands are accumulated and sent
+        to the helper in batches.'''
+        self._ensure_helper()
+        logger = logging.getLogger('store')
+        batch = bytearray()
+        for obj in chunks:
+            command = 'store file %s %d\n' % (self._delta_node(obj), len(obj))
+            if logger.isEnabledFor(logging.INFO):
+                logger.info('[%d] => %r', self._helper.pid, command)
+            batch += command
+            batch += obj
+            if len(batch) >= self.STORE_BATCH_SIZE:
+                self._helper.stdin.write(batch)
+                del batch[:]
+        if batch:
+            self._helper.stdin.write(batch)
+
     @classmethod
     def heads(self, what):
         with self.query('heads', what) as stdout:
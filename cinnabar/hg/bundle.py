@@ -18,6 +18,7 @@ from cinnabar.git import (
 from cinnabar.util import (
     check_enabled,
     experiment,
+    iter_batches,
     progress_iter,
     sorted_merge,
 )
@@ -33,10 +34,18 @@ from collections import (
     OrderedDict,
     defaultdict,
 )
+from itertools import izip
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from operator import attrgetter
 import logging
 import struct
 
 
+# Number of threads used to compute the sha1 of new file revisions.
+SHA1_THREADS = min(cpu_count(), 4)
+
+
 # We used to have a pseudo string class that didn't derive from str, and
 # that was used to distinguish between mercurial sha1s that were already
 # known or not. git-mozreview relies on previously unknown mercurial sha1s
@@ -90,6 +99,12 @@ def get_changes(tree, parents, base_path=''):
 
 
 class PushStore(GitHgStore):
+    # Number of file revisions created at once by create_files.
+    CREATE_FILES_BATCH_SIZE = 1000
+    # Minimum number of file revisions for their sha1s to be computed in a
+    # thread pool.
+    CREATE_FILES_POOL_THRESHOLD = 64
+
     @classmethod
     def adopt(cls, store, graft):
         assert isinstance(store, GitHgStore)
@@ -126,10 +141,10 @@ class PushStore(GitHgStore):
                 parents = parents[:1]
 
         if not parents:
-            for line in Git.ls_tree(commit, recursive=True):
-                mode, typ, sha1, path = line
-                node = self.create_file(sha1, git_manifest_parents=(),
-                                        path=path)
+            files = list(Git.ls_tree(commit, recursive=True))
+            nodes = self.create_files(
+                (sha1, (), (), path) for mode, typ, sha1, path in files)
+            for (mode, typ, sha1, path), node in izip(files, nodes):
                 manifest.append_line(ManifestLine(path, node, self.ATTR[mode]),
                                      modified=True)
                 changeset_files.append(path)
@@ -228,11 +243,16 @@ class PushStore(GitHgStore):
 
         parent_lines = OrderedDict((l.name, l)
                                    for l in parent_manifest._lines)
+        git_manifest_parents = (self.manifest_ref(parent_node),)
+        # Manifest lines are gathered first, with a None node for new file
+        # revisions, so that those can be created in one batch.
+        entries = []
+        new_files = []
         for line in sorted_merge(parent_lines.iteritems(), git_diff,
                                  non_key=lambda i: i[1]):
             path, manifest_line, change = line
             if not change:
-                manifest.append_line(manifest_line)
+                entries.append(manifest_line)
                 continue
             mode_after, sha1_before, sha1_after, status = change
             path2 = status[1:]
@@ -242,38 +262,37 @@ class PushStore(GitHgStore):
                 manifest.removed.add(path)
                 changeset_files.append(path)
                 continue
+            node = None
             if status in 'MT':
                 if sha1_before == sha1_after:
                     node = manifest_line.node
                 else:
-                    node = self.create_file(
-                        sha1_after, str(manifest_line.node),
-                        git_manifest_parents=(
-                            self.manifest_ref(parent_node),),
-                        path=path)
+                    new_files.append((sha1_after, (str(manifest_line.node),),
+                                      git_manifest_parents, path))
             elif status in 'RC':
                 if sha1_after != EMPTY_BLOB:
                     node = self.create_copy(
                         (path2, parent_lines[path2].node), sha1_after,
-                        git_manifest_parents=(
-                            self.manifest_ref(parent_node),),
+                        git_manifest_parents=git_manifest_parents,
                         path=path)
                 else:
-                    node = self.create_file(
-                        sha1_after,
-                        git_manifest_parents=(
-                            self.manifest_ref(parent_node),),
-                        path=path)
+                    new_files.append(
+                        (sha1_after, (), git_manifest_parents, path))
             else:
                 assert status == 'A'
-                node = self.create_file(
-                    sha1_after,
-                    git_manifest_parents=(
-                        self.manifest_ref(parent_node),),
-                    path=path)
-            manifest.append_line(ManifestLine(path, node, attr),
-                                 modified=True)
+                new_files.append((sha1_after, (), git_manifest_parents, path))
+            entries.append((path, node, attr))
             changeset_files.append(path)
+
+        new_nodes = iter(self.create_files(new_files))
+        for entry in entries:
+            if isinstance(entry, ManifestLine):
+                manifest.append_line(entry)
+            else:
+                path, node, attr = entry
+                manifest.append_line(
+                    ManifestLine(path, node or next(new_nodes), attr),
+                    modified=True)
         manifest.set_parents(parent_node)
         manifest.delta_node = parent_node
         return manifest, changeset_files
@@ -357,6 +376,67 @@ class PushStore(GitHgStore):
                                              git_manifest_parents, path)
         return self._store_file_internal(hg_file)
 
+    def create_files(self, files):
+        '''Create file revisions for an iterable of (sha1, parents,
+        git_manifest_parents, path) tuples. Returns the list of their
+        nodes.
+
+        This is equivalent to calling create_file for each of them, but
+        the helper computes the nodes of files that don't need metadata or
+        parent adjustments without sending their content over, and is told
+        about all the new files in one go. Other files have their blobs
+        requested in batches, and their sha1s computed in a thread pool.'''
+        nodes = []
+        pool = None
+        try:
+            for batch in iter_batches(files, self.CREATE_FILES_BATCH_SIZE):
+                batch_nodes = [None] * len(batch)
+                simple = []
+                for n, (sha1, parents, _, _) in enumerate(batch):
+                    parents = tuple(p for p in parents if p != NULL_NODE_ID)
+                    if len(parents) <= 1:
+                        simple.append(
+                            (n, (sha1,) + (parents + (NULL_NODE_ID,) * 2)[:2]))
+                file_nodes = GitHgHelper.file_node_many(
+                    args for _, args in simple)
+                for (n, _), node in izip(simple, file_nodes):
+                    if node != NULL_NODE_ID:
+                        batch_nodes[n] = node
+
+                others = [n for n, node in enumerate(batch_nodes)
+                          if node is None]
+                contents = GitHgHelper.cat_file_many(
+                    'blob', (batch[n][0] for n in others))
+                hg_files = []
+                for n, (_, _, content) in izip(others, contents):
+                    sha1, parents, git_manifest_parents, path = batch[n]
+                    hg_file = File()
+                    hg_file.content = content
+                    FileFindParents.set_parents(
+                        hg_file, *parents,
+                        git_manifest_parents=git_manifest_parents, path=path)
+                    hg_files.append(hg_file)
+
+                if len(hg_files) >= self.CREATE_FILES_POOL_THRESHOLD:
+                    if pool is None:
+                        pool = ThreadPool(SHA1_THREADS)
+                    sha1s = pool.map(attrgetter('sha1'), hg_files,
+                                     chunksize=16)
+                else:
+                    sha1s = [f.sha1 for f in hg_files]
+                for n, node in izip(others, sha1s):
+                    batch_nodes[n] = node
+
+                GitHgHelper.set_many('file', izip(
+                    batch_nodes, (sha1 for sha1, _, _, _ in batch)))
+                for node in batch_nodes:
+                    self._pushed.add(node)
+                nodes.extend(batch_nodes)
+        finally:
+            if pool:
+                pool.terminate()
+        return nodes
+
     def create_copy(self, hg_source, sha1, git_manifest_parents=None,
                     path=None):
         path, rev = hg_source
@@ -398,6 +478,15 @@ class PushStore(GitHgStore):
             return PseudoString(result)
         return result
 
+    def changeset_ref_many(self, sha1s):
+        sha1s = list(sha1s)
+        results = super(PushStore, self).changeset_ref_many(sha1s)
+        for sha1, result in izip(sha1s, results):
+            if sha1 in self._pushed:
+                yield PseudoString(result)
+            else:
+                yield result
+
     def close(self, rollback=False):
         if rollback:
             self._fast_import.close(rollback)
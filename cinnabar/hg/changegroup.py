@@ -3,7 +3,6 @@ from binascii import (
     unhexlify,
 )
 import struct
-from weakref import WeakKeyDictionary
 from cinnabar.git import NULL_NODE_ID
 
 
@@ -56,17 +55,38 @@ class RevDiff(object):
             yield part
             start += len(part)
 
-    def apply(self, raw_orig):
-        new = bytearray()
+    def apply_buffer(self, raw_orig):
+        '''Apply the diff to `raw_orig`. The size of the result is computed
+        from the diff headers, so that it can be filled in a single
+        preallocated bytearray. Returns `raw_orig` itself when the diff
+        doesn't change anything.'''
+        parts = list(self)
+        size = len(raw_orig)
+        changed = False
+        for diff in parts:
+            length = len(diff.text_data)
+            size += length - (diff.end - diff.start)
+            changed = changed or length or diff.end != diff.start
+        if not changed:
+            return raw_orig
+        new = bytearray(size)
         orig = memoryview(raw_orig)
-        end = 0
-        for diff in self:
-            new += orig[end:diff.start]
-            new += diff.text_data
+        pos = end = 0
+        for diff in parts:
+            length = diff.start - end
+            new[pos:pos + length] = orig[end:diff.start]
+            pos += length
+            length = len(diff.text_data)
+            new[pos:pos + length] = diff.text_data
+            pos += length
             end = diff.end
-        if new == '' and end == 0:
+        new[pos:] = orig[end:]
+        return new
+
+    def apply(self, raw_orig):
+        new = self.apply_buffer(raw_orig)
+        if new is raw_orig:
             return raw_orig
-        new += orig[end:]
         return str(new)
 
 
@@ -96,7 +116,7 @@ class RawRevChunk(bytearray, ParentsTrait):
 
 
 class RawRevChunk01(RawRevChunk):
-    __slots__ = ('__weakref__',)
+    __slots__ = ('_delta_node',)
 
     node = RawRevChunk._field(0, 20, hexlify)
     parent1 = RawRevChunk._field(20, 20, hexlify)
@@ -105,17 +125,16 @@ class RawRevChunk01(RawRevChunk):
     data = RawRevChunk._field(80)
     patch = RawRevChunk._field(80, filter=RevDiff)
 
-    # Because we keep so many instances of this class on hold, the overhead
-    # of having a __dict__ per instance is a deal breaker.
-    _delta_nodes = WeakKeyDictionary()
-
+    # The delta node is not part of the chunk data, it is implied by the
+    # chunk order. Chunks read from changegroups are converted to
+    # RawRevChunk01Inline, so this is only used for chunks we create.
     @property
     def delta_node(self):
-        return self._delta_nodes.get(self, NULL_NODE_ID)
+        return getattr(self, '_delta_node', NULL_NODE_ID)
 
     @delta_node.setter
     def delta_node(self, value):
-        self._delta_nodes[self] = value
+        self._delta_node = value
 
 
 class RawRevChunk02(RawRevChunk):
@@ -128,3 +147,20 @@ class RawRevChunk02(RawRevChunk):
     changeset = RawRevChunk._field(80, 20, hexlify)
     data = RawRevChunk._field(100)
     patch = RawRevChunk._field(100, filter=RevDiff)
+
+
+class RawRevChunk01Inline(RawRevChunk02):
+    '''A changegroup v1 chunk, with its delta node stored inline, at the
+    same place as in a changegroup v2 chunk.
+
+    Because we keep so many instances of chunks on hold, storing the delta
+    node in the buffer is cheaper than storing it anywhere else.'''
+    __slots__ = ()
+
+    @classmethod
+    def from_cg1(cls, data, raw_delta_node):
+        '''Create a chunk from changegroup v1 chunk data and the binary
+        form of its delta node.'''
+        chunk = cls(data)
+        chunk[60:60] = raw_delta_node
+        return chunk
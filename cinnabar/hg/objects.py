@@ -185,11 +185,16 @@ class File(HgObject):
     @classmethod
     def from_chunk(cls, raw_chunk, delta_file=None):
         this = super(File, cls).from_chunk(raw_chunk, delta_file)
-        data = raw_chunk.patch.apply(delta_file.raw_data if delta_file else '')
+        data = raw_chunk.patch.apply_buffer(
+            delta_file.raw_data if delta_file else '')
+        # Slice through a memoryview so that each part is only copied once.
         if data.startswith('\1\n'):
-            _, this.metadata, this.content = data.split('\1\n', 2)
+            end = data.index('\1\n', 2)
+            view = memoryview(data)
+            this.metadata = view[2:end].tobytes()
+            this.content = view[end + 2:].tobytes()
         else:
-            this.content = data
+            this.content = str(data)
         return this
 
     class Metadata(OrderedDict):
@@ -243,8 +248,12 @@ class Changeset(HgObject):
     @classmethod
     def from_chunk(cls, raw_chunk, delta_cs=None):
         this = super(Changeset, cls).from_chunk(raw_chunk, delta_cs)
-        data = raw_chunk.patch.apply(delta_cs.raw_data if delta_cs else '')
-        metadata, this.body = data.split('\n\n', 1)
+        data = raw_chunk.patch.apply_buffer(
+            delta_cs.raw_data if delta_cs else '')
+        end = data.index('\n\n')
+        view = memoryview(data)
+        metadata = view[:end].tobytes()
+        this.body = view[end + 2:].tobytes()
         lines = metadata.splitlines()
         this.manifest, this.author, date = lines[:3]
         date = date.split(' ', 2)
@@ -1,6 +1,10 @@
 from __future__ import division
+import hashlib
+import httplib
 import os
+import socket
 import sys
+import tempfile
 import urllib
 import urllib2
 from cinnabar.githg import (
@@ -12,6 +16,7 @@ from cinnabar.helper import (
     GitHgHelper,
     HgRepoHelper,
 )
+from array import array
 from binascii import (
     hexlify,
     unhexlify,
@@ -28,23 +33,36 @@ from urlparse import (
 import logging
 import struct
 import random
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from cinnabar.dag import gitdag
+from cinnabar.diskcache import DiskCache
 from cinnabar.git import (
     Git,
+    InvalidConfig,
     NULL_NODE_ID,
 )
 from cinnabar.util import (
     check_enabled,
     experiment,
+    HTTPReader,
+    iter_batches,
+    parse_size,
+    PerfReport,
+    Prefetcher,
     progress_iter,
 )
 from collections import (
     defaultdict,
     deque,
 )
-from .bundle import create_bundle
+from .bundle import (
+    bundlepart,
+    create_bundle,
+)
 from .changegroup import (
     RawRevChunk01,
+    RawRevChunk01Inline,
     RawRevChunk02,
 )
 from cStringIO import StringIO
@@ -153,11 +171,14 @@ def chunks_in_changegroup(bundle):
         chunk = getchunk(bundle)
         if not chunk:
             return
-        chunk = chunk_type(chunk)
-        if isinstance(chunk, RawRevChunk01):
-            chunk.delta_node = previous_node or chunk.parent1
-        yield chunk
-        previous_node = chunk.node
+        if chunk_type is RawRevChunk01:
+            # Changegroup v1 chunks are deltas against the previous chunk,
+            # or the first parent for the first chunk.
+            delta_node = previous_node or chunk[20:40]
+            previous_node = chunk[:20]
+            yield RawRevChunk01Inline.from_cg1(chunk, delta_node)
+        else:
+            yield chunk_type(chunk)
 
 
 def iter_chunks(chunks, cls):
@@ -174,42 +195,156 @@ def iterate_files(bundle):
             yield chunk
 
 
+def _check_sha1(instance):
+    if instance.node != instance.sha1:
+        raise Exception(
+            'sha1 mismatch for node %s with parents %s %s and '
+            'previous %s' %
+            (instance.node, instance.parent1, instance.parent2,
+             instance.delta_node)
+        )
+
+
+# Number of threads computing sha1s when all nodes are checked, and number
+# of instances that can be waiting for their sha1 to be verified.
+VERIFY_THREADS = min(cpu_count(), 4)
+VERIFY_WINDOW = 32
+
+
 def iter_initialized(get_missing, iterable, init=None):
     previous = None
     always_check = check_enabled('nodeid')
-    for instance in iterable:
-        check = always_check
-        if instance.delta_node != NULL_NODE_ID:
-            if not previous or instance.delta_node != previous.node:
-                previous = get_missing(instance.delta_node)
-                check = True
-            if init:
-                instance = init(instance, previous)
+    # When all nodes are checked, the sha1s are computed in a pool of
+    # threads, while the following instances are being initialized. hashlib
+    # releases the GIL while hashing, so this overlaps with patching.
+    # Instances are only yielded once verified, in their original order.
+    pool = ThreadPool(VERIFY_THREADS) if always_check else None
+    window = VERIFY_WINDOW if pool else 0
+    pending = deque()
+
+    def flush(size=0):
+        while len(pending) > size:
+            instance, result = pending.popleft()
+            if result:
+                result.get()
+            yield instance
+
+    try:
+        for instance in iterable:
+            check = always_check
+            if instance.delta_node != NULL_NODE_ID:
+                if not previous or instance.delta_node != previous.node:
+                    # The delta base may be one of the pending instances,
+                    # which needs to be consumed before get_missing can
+                    # find it.
+                    for i in flush():
+                        yield i
+                    previous = get_missing(instance.delta_node)
+                    check = True
+                if init:
+                    instance = init(instance, previous)
+                else:
+                    instance.init(previous)
+            elif init:
+                instance = init(instance)
             else:
-                instance.init(previous)
-        elif init:
-            instance = init(instance)
-        else:
-            instance.init(())
-        if check and instance.node != instance.sha1:
-            raise Exception(
-                'sha1 mismatch for node %s with parents %s %s and '
-                'previous %s' %
-                (instance.node, instance.parent1, instance.parent2,
-                 instance.delta_node)
-            )
-        yield instance
-        previous = instance
+                instance.init(())
+            result = None
+            if check:
+                if pool:
+                    result = pool.apply_async(_check_sha1, (instance,))
+                else:
+                    _check_sha1(instance)
+            pending.append((instance, result))
+            for i in flush(window):
+                yield i
+            previous = instance
+        for i in flush():
+            yield i
+    finally:
+        if pool:
+            pool.terminate()
+
+
+class ChunksSpool(object):
+    '''Temporary on-disk storage for raw chunks.
+
+    Chunks are appended to an anonymous temporary file, and the index of
+    their lengths is the only thing kept in memory. Iterating the spool
+    reads the chunks back, in order, one at a time.'''
+
+    def __init__(self, chunk_type):
+        self._chunk_type = chunk_type
+        self._file = tempfile.TemporaryFile(prefix='cinnabar-chunks-')
+        self._lengths = array('L')
+
+    def append(self, chunk):
+        assert type(chunk) is self._chunk_type
+        if isinstance(chunk, RawRevChunk01):
+            # The delta node is not part of the RawRevChunk01 data.
+            self._file.write(unhexlify(chunk.delta_node))
+        self._file.write(chunk)
+        self._lengths.append(len(chunk))
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def __iter__(self):
+        self._file.seek(0)
+        for length in self._lengths:
+            if self._chunk_type == RawRevChunk01:
+                delta_node = hexlify(readexactly(self._file, 20))
+            chunk = self._chunk_type(length)
+            if self._file.readinto(chunk) != length:
+                raise Exception('Chunks spool is truncated')
+            if self._chunk_type == RawRevChunk01:
+                chunk.delta_node = delta_node
+            yield chunk
+        self.close()
+
+    def close(self):
+        self._file.close()
+        self._lengths = array('L')
+
+
+def spool_threshold():
+    threshold = Git.config('cinnabar.spool-threshold')
+    if threshold is None:
+        return 256 * 1024 * 1024
+    try:
+        return parse_size(threshold)
+    except ValueError:
+        raise InvalidConfig(
+            'Invalid value for cinnabar.spool-threshold: %s' % threshold)
 
 
 class ChunksCollection(object):
-    def __init__(self, iterator):
+    def __init__(self, iterator, spool_threshold=spool_threshold):
+        # Chunks are kept in memory, unless their cumulated size goes over
+        # the spool threshold, in which case they are all moved to a
+        # ChunksSpool.
         self._chunks = deque()
+        size = 0
+        if callable(spool_threshold):
+            spool_threshold = spool_threshold()
 
         for chunk in iterator:
+            if isinstance(self._chunks, deque):
+                size += len(chunk)
+                if size > spool_threshold:
+                    chunks = self._chunks
+                    self._chunks = ChunksSpool(type(chunk))
+                    while chunks:
+                        self._chunks.append(chunks.popleft())
             self._chunks.append(chunk)
 
     def __iter__(self):
+        if isinstance(self._chunks, ChunksSpool):
+            spool = self._chunks
+            self._chunks = deque()
+            for chunk in spool:
+                yield chunk
+            return
         while True:
             try:
                 yield self._chunks.popleft()
@@ -227,7 +362,70 @@ def _sample(l, size):
     return random.sample(l, size)
 
 
-# TODO: this algorithm is not very smart and might as well be completely wrong
+def _exponential_sample(dag, undecided, size):
+    '''Pick up to `size` nodes from the undecided set, walking from its
+    heads towards its roots, and from its roots towards its heads, taking
+    nodes at exponentially increasing distances from where the walk
+    started. Random undecided nodes complete the sample when the walks
+    don't yield enough.'''
+    sample = set()
+    for edges, reverse_edges in ((dag.parents, dag.children),
+                                 (dag.children, dag.parents)):
+        starts = [n for n in undecided
+                  if not any(r in undecided for r in reverse_edges(n))]
+        distance = dict.fromkeys(starts, 1)
+        queue = deque(starts)
+        factor = 1
+        while queue:
+            node = queue.popleft()
+            d = distance[node]
+            if d > factor:
+                factor *= 2
+            if d == factor:
+                sample.add(node)
+            for n in edges(node):
+                if n in undecided and n not in distance:
+                    distance[n] = d + 1
+                    queue.append(n)
+
+    if len(sample) > size:
+        return _sample(sample, size)
+    if len(sample) < size:
+        sample.update(_sample(undecided - sample, size - len(sample)))
+    return sample
+
+
+def discover(dag, known, sample_size=100):
+    '''Find the heads of the common part of a local dag and a remote.
+
+    Nodes in the dag that are already known to the remote must be tagged
+    'known', and nodes known not to be there, 'unknown'. `known` is a
+    function returning, for a list of nodes, whether the remote has them.
+    '''
+    logger = logging.getLogger('findcommon')
+    undecided = set(dag.iternodes())
+
+    while undecided:
+        sample = list(_exponential_sample(dag, undecided, sample_size))
+        sample_known = known(sample)
+        known_nodes = [h for h, k in izip(sample, sample_known) if k]
+        unknown_nodes = [h for h, k in izip(sample, sample_known) if not k]
+        logger.info('next sample size: %d', len(sample))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('known (sub)set: (%d) %s', len(known_nodes),
+                         sorted(known_nodes))
+            logger.debug('unknown (sub)set: (%d) %s', len(unknown_nodes),
+                         sorted(unknown_nodes))
+
+        undecided.difference_update(
+            dag.tag_nodes_and_parents(known_nodes, 'known'))
+        undecided.difference_update(
+            dag.tag_nodes_and_children(unknown_nodes, 'unknown'))
+        logger.debug('undecided: %d', len(undecided))
+
+    return dag.heads('known')
+
+
 def findcommon(repo, store, hgheads):
     logger = logging.getLogger('findcommon')
     logger.debug(hgheads)
@@ -246,8 +444,8 @@ def findcommon(repo, store, hgheads):
         logger.info('all heads known')
         return hgheads
 
-    git_heads = set(store.changeset_ref(h) for h in hgheads)
-    git_known = set(store.changeset_ref(h) for h in known)
+    git_heads = set(store.changeset_ref_many(hgheads))
+    git_known = set(store.changeset_ref_many(known))
 
     if logger.isEnabledFor(logging.DEBUG):
         logger.debug('known (sub)set: (%d) %s', len(known), sorted(git_known))
@@ -266,46 +464,11 @@ def findcommon(repo, store, hgheads):
     dag = gitdag(chain(revs, ((k, ()) for k in git_known)))
     dag.tag_nodes_and_parents(git_known, 'known')
 
-    def log_dag(tag):
-        if not logger.isEnabledFor(logging.DEBUG):
-            return
-        logger.debug('%s dag size: %d', tag,
-                     sum(1 for n in dag.iternodes(tag)))
-        heads = sorted(dag.heads(tag))
-        logger.debug('%s dag heads: (%d) %s', tag, len(heads), heads)
-        roots = sorted(dag.roots(tag))
-        logger.debug('%s dag roots: (%d) %s', tag, len(roots), roots)
-
-    log_dag('unknown')
-    log_dag('known')
-
-    while True:
-        unknown = set(chain(dag.heads(), dag.roots()))
-        if not unknown:
-            break
-
-        sample = set(_sample(unknown, sample_size))
-        if len(sample) < sample_size:
-            sample |= set(_sample(set(dag.iternodes()),
-                                  sample_size - len(sample)))
-
-        sample = list(sample)
-        hg_sample = [store.hg_changeset(h) for h in sample]
-        known = repo.known(unhexlify(h) for h in hg_sample)
-        unknown = set(h for h, k in izip(sample, known) if not k)
-        known = set(h for h, k in izip(sample, known) if k)
-        logger.info('next sample size: %d', len(sample))
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug('known (sub)set: (%d) %s', len(known), sorted(known))
-            logger.debug('unknown (sub)set: (%d) %s', len(unknown),
-                         sorted(unknown))
-
-        dag.tag_nodes_and_parents(known, 'known')
-        dag.tag_nodes_and_children(unknown, 'unknown')
-        log_dag('unknown')
-        log_dag('known')
+    def known(nodes):
+        return repo.known(unhexlify(h)
+                          for h in store.hg_changeset_many(nodes))
 
-    return [store.hg_changeset(h) for h in dag.heads('known')]
+    return list(store.hg_changeset_many(discover(dag, known, sample_size)))
 
 
 class HelperRepo(object):
@@ -507,7 +670,9 @@ class bundlerepo(object):
         return [h in self._dag for h in heads]
 
 
-def unbundler(bundle):
+def find_changegroup(bundle):
+    '''Return the changegroup from the given bundle, its version, and an
+    iterator over the bundle2 parts following it, if any.'''
     if unbundle20 and isinstance(bundle, unbundle20):
         parts = iter(bundle.iterparts())
         for part in parts:
@@ -524,20 +689,63 @@ def unbundler(bundle):
                 cg = cg2unpacker(part, 'UN')
             else:
                 raise Exception('Unknown changegroup version %s' % version)
-            break
-        else:
-            raise Exception('No changegroups in the bundle')
-    else:
-        cg = bundle
+            return cg, version, parts
+        raise Exception('No changegroups in the bundle')
+    return bundle, '01', ()
+
+
+def unbundler(bundle):
+    cg, version, parts = find_changegroup(bundle)
 
     yield chunks_in_changegroup(cg)
     yield chunks_in_changegroup(cg)
     yield iterate_files(cg)
 
-    if unbundle20 and isinstance(bundle, unbundle20):
-        for part in parts:
-            logging.getLogger('bundle2').warning(
-                'ignoring bundle2 part: %s', part.type)
+    for part in parts:
+        logging.getLogger('bundle2').warning(
+            'ignoring bundle2 part: %s', part.type)
+
+
+def raw_changegroup(cg):
+    '''Yield the raw data of the given changegroup, chunk by chunk.'''
+    def section():
+        while True:
+            chunk = getchunk(cg)
+            yield struct.pack('>l', len(chunk) + 4 if chunk else 0)
+            if not chunk:
+                return
+            yield chunk
+
+    for data in chain(section(), section()):
+        yield data
+    while True:
+        name = getchunk(cg)
+        yield struct.pack('>l', len(name) + 4 if name else 0)
+        if not name:
+            return
+        yield name
+        for data in section():
+            yield data
+
+
+def write_bundle(bundle, fh):
+    '''Write the changegroup from the given bundle as a bundle file.'''
+    cg, version, parts = find_changegroup(bundle)
+    if version == '01':
+        fh.write('HG10UN')
+        for data in raw_changegroup(cg):
+            fh.write(data)
+    else:
+        fh.write('HG20')
+        fh.write('\0' * 4)  # bundle parameters length: no params
+        for data in bundlepart('CHANGEGROUP',
+                               advisoryparams=(('version', version),),
+                               data=util.chunkbuffer(raw_changegroup(cg))):
+            fh.write(data)
+        fh.write('\0' * 4)  # End of bundle
+    for part in parts:
+        logging.getLogger('bundle2').warning(
+            'ignoring bundle2 part: %s', part.type)
 
 
 def get_clonebundle(repo):
@@ -572,51 +780,227 @@ def get_clonebundle(repo):
         return None
 
     sys.stderr.write('Getting clone bundle from %s\n' % url)
-    return unbundle_fh(urllib2.urlopen(url), url)
+    return unbundle_fh(open_clonebundle(url), url)
+
+
+def http_validator(headers):
+    '''Return the ETag or Last-Modified header from the given headers.'''
+    return headers.getheader('ETag') or headers.getheader('Last-Modified')
+
+
+def open_clonebundle(url, cache=None):
+    '''Return a file-like for the clone bundle at the given url, from the
+    clone bundle cache if it has it, or from the network, in which case it
+    is added to the cache as it is read.'''
+    cache = cache or ClonebundleCache.from_config()
+    if cache:
+        # Only start downloading the bundle if the cache doesn't have it.
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+        try:
+            response = urllib2.urlopen(request)
+            validator = http_validator(response.info())
+            response.close()
+        except (IOError, httplib.HTTPException, socket.error):
+            validator = None
+        fh = cache.open_bundle(cache.key(url, validator)) \
+            if validator else None
+        if fh:
+            sys.stderr.write('Using cached clone bundle\n')
+            return fh
+    reader = HTTPReader(url, 'Receiving clone bundle')
+    validator = http_validator(reader.info())
+    # Without a length, there's no way to tell whether the download was
+    # complete, so the bundle isn't cached.
+    if cache and validator and reader.length is not None:
+        reader = CachingReader(cache, cache.key(url, validator), reader,
+                               reader.length)
+    return reader
+
+
+class ClonebundleCache(DiskCache):
+    '''Clone bundles, keyed by their url and the ETag or Last-Modified
+    header the server sent for them. Each bundle comes with a sidecar file
+    containing the sha1 of its content, to verify it before use.'''
+    DEFAULT_SIZE = '10g'
+
+    @classmethod
+    def from_config(self):
+        '''Return a ClonebundleCache for the directory configured with
+        cinnabar.clonebundle-cache, with the size configured with
+        cinnabar.clonebundle-cache-size, or None when no directory is
+        set.'''
+        path = Git.config('cinnabar.clonebundle-cache')
+        if not path:
+            return None
+        size = (Git.config('cinnabar.clonebundle-cache-size') or
+                self.DEFAULT_SIZE)
+        try:
+            size = parse_size(size)
+        except ValueError:
+            raise InvalidConfig(
+                'Invalid value for cinnabar.clonebundle-cache-size: %s'
+                % size)
+        return self(os.path.expanduser(path), size)
+
+    @staticmethod
+    def key(url, validator):
+        return hashlib.sha1('%s\0%s' % (url, validator)).hexdigest()
+
+    def open_bundle(self, key):
+        '''Return an open file for the bundle with the given key, or None
+        if it is not in the cache or doesn't match its sha1.'''
+        sha1 = self.get(key + '.sha1')
+        fh = self.open(key) if sha1 else None
+        if fh is None:
+            return None
+        h = hashlib.sha1()
+        for buf in iter(lambda: fh.read(1048576), ''):
+            h.update(buf)
+        if h.hexdigest() != sha1:
+            logging.getLogger('clonebundle').warning(
+                'Removing corrupted cached clone bundle %s', key)
+            fh.close()
+            self.remove(key)
+            self.remove(key + '.sha1')
+            return None
+        fh.seek(0)
+        return fh
+
+
+class CachingReader(object):
+    '''Wrapper around a file-like reader that stores what is read in a
+    ClonebundleCache. The data is only added to the cache once the given
+    length is reached, so a truncated download is never cached.'''
+    def __init__(self, cache, key, reader, length):
+        self._cache = cache
+        self._key = key
+        self._reader = reader
+        self._length = length
+        self._fh, self._tmp = cache.mkstemp()
+        self._sha1 = hashlib.sha1()
+        self._offset = 0
+
+    def read(self, size):
+        buf = self._reader.read(size)
+        if self._fh:
+            self._fh.write(buf)
+            self._sha1.update(buf)
+            self._offset += len(buf)
+            if self._offset == self._length:
+                self._fh.close()
+                self._fh = None
+                self._cache.commit(self._tmp, self._key)
+                self._cache.put(self._key + '.sha1', self._sha1.hexdigest())
+        return buf
+
+    def close(self):
+        if self._fh:
+            self._fh.close()
+            self._fh = None
+            try:
+                os.unlink(self._tmp)
+            except OSError:
+                pass
+        self._reader.close()
+
+    def __del__(self):
+        if self._fh:
+            self.close()
+
+
+def unknown_chunks(chunks):
+    '''Filter out the chunks for nodes that are already in the store.
+
+    This queries the helper, so it must be iterated from the thread that
+    otherwise talks to the helper.'''
+    for batch in iter_batches(chunks, GitHgHelper.LOOKUP_BATCH_SIZE):
+        known = GitHgHelper.hg2git_many(chunk.node for chunk in batch)
+        for chunk, sha1 in izip(batch, known):
+            if sha1 == NULL_NODE_ID:
+                # The node is about to be stored, don't keep its lookup
+                # result around.
+                GitHgHelper.hg2git.invalidate(GitHgHelper, chunk.node)
+                yield chunk
 
 
 class BundleApplier(object):
-    def __init__(self, bundle):
+    def __init__(self, bundle, skip_known=False):
         self._bundle = bundle
+        self._skip_known = skip_known
 
-    def __call__(self, store):
-        changeset_chunks = ChunksCollection(progress_iter(
-            'Reading %d changesets', next(self._bundle, None)))
-
-        manifest_chunks = ChunksCollection(progress_iter(
-            'Reading %d manifests', next(self._bundle, None)))
+    def _next(self):
+        chunks = next(self._bundle, None)
+        if self._skip_known and chunks is not None:
+            return unknown_chunks(chunks)
+        return chunks
 
-        for rev_chunk in progress_iter(
-                'Reading and importing %d files', next(self._bundle, None)):
-            GitHgHelper.store('file', rev_chunk)
+    def __call__(self, store):
+        with PerfReport.phase('download changesets'):
+            changeset_chunks = ChunksCollection(progress_iter(
+                'Reading %d changesets', self._next()))
+
+        with PerfReport.phase('download manifests'):
+            manifest_chunks = ChunksCollection(progress_iter(
+                'Reading %d manifests', self._next()))
+
+        # Decode the file chunks from the bundle in a separate thread, so
+        # that reading from the network doesn't wait for the helper to
+        # import the files, and vice versa. Only this thread talks to the
+        # helper, so known files are filtered out here rather than in the
+        # prefetching thread.
+        with PerfReport.phase('import files'):
+            file_chunks = Prefetcher(next(self._bundle, None))
+            if self._skip_known:
+                file_chunks = unknown_chunks(file_chunks)
+            GitHgHelper.store_files(progress_iter(
+                'Reading and importing %d files', file_chunks))
 
         if next(self._bundle, None) is not None:
             assert False
         del self._bundle
 
-        for mn in progress_iter(
-                'Importing %d manifests',
-                manifest_chunks.iter_initialized(ManifestInfo,
-                                                 store.manifest)):
-            store.store_manifest(mn)
+        with PerfReport.phase('import manifests'):
+            for mn in progress_iter(
+                    'Importing %d manifests',
+                    manifest_chunks.iter_initialized(ManifestInfo,
+                                                     store.manifest)):
+                store.store_manifest(mn)
 
         del manifest_chunks
 
-        for cs in progress_iter(
-                'Importing %d changesets',
-                changeset_chunks.iter_initialized(lambda x: x, store.changeset,
-                                                  Changeset.from_chunk)):
-            try:
-                store.store_changeset(cs)
-            except NothingToGraftException:
-                logging.warn('Cannot graft %s, not importing.', cs.node)
+        with PerfReport.phase('import changesets'):
+            for cs in progress_iter(
+                    'Importing %d changesets',
+                    changeset_chunks.iter_initialized(
+                        lambda x: x, store.changeset, Changeset.from_chunk)):
+                try:
+                    store.store_changeset(cs)
+                except NothingToGraftException:
+                    logging.warn('Cannot graft %s, not importing.', cs.node)
+
+
+def get_remote_bundle(repo, heads, common):
+    kwargs = {}
+    if unbundle20 and repo.capable('bundle2'):
+        bundle2caps = {
+            'HG20': (),
+            'changegroup': ('01', '02'),
+        }
+        kwargs['bundlecaps'] = set((
+            'HG20', 'bundle2=%s' % urllib.quote(encodecaps(bundle2caps))))
+
+    return repo.getbundle('bundle', heads=[unhexlify(h) for h in heads],
+                          common=[unhexlify(h) for h in common],
+                          **kwargs)
 
 
 def getbundle(repo, store, heads, branch_names):
     if isinstance(repo, bundlerepo):
         bundle = repo._unbundler
     else:
-        common = findcommon(repo, store, store.heads(branch_names))
+        with PerfReport.phase('discovery'):
+            common = findcommon(repo, store, store.heads(branch_names))
         logging.info('common: %s', common)
         bundle = None
         if not common and repo.capable('clonebundles'):
@@ -626,55 +1010,45 @@ def getbundle(repo, store, heads, branch_names):
             # Manual move semantics
             apply_bundle = BundleApplier(bundle)
             del bundle
-            apply_bundle(store)
-            common = findcommon(repo, store, store.heads(branch_names))
+            with PerfReport.phase('clone bundle'):
+                apply_bundle(store)
+            with PerfReport.phase('discovery'):
+                common = findcommon(repo, store, store.heads(branch_names))
             logging.info('common: %s', common)
 
-        kwargs = {}
-        if unbundle20 and repo.capable('bundle2'):
-            bundle2caps = {
-                'HG20': (),
-                'changegroup': ('01', '02'),
-            }
-            kwargs['bundlecaps'] = set((
-                'HG20', 'bundle2=%s' % urllib.quote(encodecaps(bundle2caps))))
-
-        bundle = repo.getbundle('bundle', heads=[unhexlify(h) for h in heads],
-                                common=[unhexlify(h) for h in common],
-                                **kwargs)
-
-        bundle = unbundler(bundle)
+        bundle = unbundler(get_remote_bundle(repo, heads, common))
 
     # Manual move semantics
     apply_bundle = BundleApplier(bundle)
     del bundle
-    apply_bundle(store)
+    with PerfReport.phase('bundle'):
+        apply_bundle(store)
 
 
 def push(repo, store, what, repo_heads, repo_branches, dry_run=False):
     def heads():
-        for sha1 in store.heads(repo_branches):
-            yield '^%s' % store.changeset_ref(sha1)
+        for ref in store.changeset_ref_many(store.heads(repo_branches)):
+            yield '^%s' % ref
 
     def local_bases():
         h = chain(heads(), (w for w in what if w))
-        for c, t, p in GitHgHelper.rev_list('--topo-order', '--full-history',
-                                            '--boundary', *h):
-            if c[0] != '-':
-                continue
-            yield store.hg_changeset(c[1:])
+        boundary = [c[1:] for c, t, p in GitHgHelper.rev_list(
+            '--topo-order', '--full-history', '--boundary', *h)
+            if c[0] == '-']
+        for rev in store.hg_changeset_many(boundary):
+            yield rev
 
-        for w in what:
-            rev = store.hg_changeset(w)
+        for rev in store.hg_changeset_many(w for w in what if w):
             if rev:
                 yield rev
 
-    common = findcommon(repo, store, set(local_bases()))
+    with PerfReport.phase('discovery'):
+        common = findcommon(repo, store, set(local_bases()))
     logging.info('common: %s', common)
 
     def revs():
-        for sha1 in common:
-            yield '^%s' % store.changeset_ref(sha1)
+        for ref in store.changeset_ref_many(common):
+            yield '^%s' % ref
 
     revs = chain(revs(), (w for w in what if w))
     push_commits = list((c, p) for c, t, p in GitHgHelper.rev_list(
@@ -707,7 +1081,8 @@ def push(repo, store, what, repo_heads, repo_branches, dry_run=False):
             cg = util.chunkbuffer(cg)
             if not b2caps:
                 cg = cg1unpacker(cg, 'UN')
-        reply = repo.unbundle(cg, repo_heads, '')
+        with PerfReport.phase('push bundle'):
+            reply = repo.unbundle(cg, repo_heads, '')
         if unbundle20 and isinstance(reply, unbundle20):
             parts = iter(reply.iterparts())
             for part in parts:
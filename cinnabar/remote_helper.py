@@ -26,6 +26,7 @@ from cinnabar.git import (
 )
 from cinnabar.util import (
     IOLogger,
+    PerfReport,
     VersionedDict,
 )
 import cinnabar.util
@@ -217,8 +218,8 @@ class GitRemoteHelper(BaseRemoteHelper):
             # each branch, we won't expose the tips. This means we don't
             # need to care about the order of the heads for the new
             # branchmap.
-            self._has_unknown_heads = any(not(self._store.changeset_ref(h))
-                                          for h in get_heads)
+            self._has_unknown_heads = not all(
+                self._store.changeset_ref_many(get_heads))
             if self._has_unknown_heads:
                 new_branchmap = {
                     branch: set(h for h in branchmap.heads(branch))
@@ -278,11 +279,14 @@ class GitRemoteHelper(BaseRemoteHelper):
         self._refs = {sanitize_branch_name(k): v
                       for k, v in refs.iteritems()}
 
-        for k, v in sorted(self._refs.iteritems()):
+        refs = sorted(self._refs.iteritems())
+        git_refs = self._store.changeset_ref_many(
+            v for k, v in refs if not v.startswith('@'))
+        for k, v in refs:
             if k.startswith('refs/heads/branches/'):
-                v = self._store.changeset_ref(v) or self._branchmap.git_sha1(v)
+                v = next(git_refs) or self._branchmap.git_sha1(v)
             elif not v.startswith('@'):
-                v = self._store.changeset_ref(v) or '?'
+                v = next(git_refs) or '?'
             self._helper.write('%s %s\n' % (v, k))
 
         self._helper.write('\n')
@@ -334,7 +338,8 @@ class GitRemoteHelper(BaseRemoteHelper):
                 ref = 'refs/cinnabar/' + ref
                 Git.update_ref(ref, self._store.changeset_ref(value))
 
-        self._store.close()
+        with PerfReport.phase('close metadata'):
+            self._store.close()
 
         self._helper.write('done\n')
         self._helper.flush()
@@ -457,4 +462,5 @@ class GitRemoteHelper(BaseRemoteHelper):
             elif data == 'never':
                 data = False
 
-            self._store.close(rollback=not data)
+            with PerfReport.phase('close metadata'):
+                self._store.close(rollback=not data)
@@ -1,12 +1,19 @@
+import atexit
+import httplib
+import json
 import logging
 import os
+import socket
 import subprocess
 import sys
 import time
+import urllib2
+from bisect import bisect_right
 from collections import (
     Iterable,
     OrderedDict,
 )
+from contextlib import contextmanager
 from difflib import (
     Match,
     SequenceMatcher,
@@ -14,6 +21,7 @@ from difflib import (
 from functools import wraps
 from itertools import (
     chain,
+    islice,
     izip,
 )
 from Queue import (
@@ -151,6 +159,7 @@ def progress_enum(fmt, enum_iter):
                     t0 = t1
             yield item
     finally:
+        PerfReport.add_items(count)
         if progress and count:
             sys.stderr.write(('\r' + fmt + '\n') % count)
             sys.stderr.flush()
@@ -191,6 +200,143 @@ class IOLogger(object):
             yield l
 
 
+def format_size(size):
+    for unit in ('bytes', 'KiB', 'MiB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'GiB'
+    if unit == 'bytes':
+        return '%d %s' % (size, unit)
+    return '%.1f %s' % (size, unit)
+
+
+class HTTPReader(object):
+    '''A file-like reader for the content at an HTTP url, that resumes
+    the download with a Range request when the connection is interrupted,
+    and displays the download progress.'''
+    RETRIES = 5
+    RETRY_DELAY = 1
+
+    def __init__(self, url, label='Downloading'):
+        self._url = url
+        self._label = label
+        self._offset = 0
+        self._retries = 0
+        self._t0 = 0
+        self._fh = urllib2.urlopen(url)
+        self._info = self._fh.info()
+        length = self._info.getheader('Content-Length')
+        self._length = int(length) if length else None
+        self._can_resume = self._info.getheader('Accept-Ranges') == 'bytes'
+
+    def info(self):
+        '''Return the headers of the initial response.'''
+        return self._info
+
+    @property
+    def length(self):
+        return self._length
+
+    def _progress(self, done=False):
+        if not progress:
+            return
+        t1 = time.time()
+        if not done and t1 - self._t0 <= 0.1:
+            return
+        self._t0 = t1
+        if self._length:
+            sys.stderr.write('\r%s: %s/%s (%d%%)' % (
+                self._label, format_size(self._offset),
+                format_size(self._length),
+                self._offset * 100 // self._length))
+        else:
+            sys.stderr.write('\r%s: %s' % (self._label,
+                                           format_size(self._offset)))
+        if done:
+            sys.stderr.write('\n')
+        sys.stderr.flush()
+
+    def _resume(self, error):
+        if (not self._can_resume or self._length is None or
+                self._retries >= self.RETRIES):
+            raise error
+        self._retries += 1
+        logging.getLogger('http').warning(
+            'Connection interrupted after %s (%s). Resuming.',
+            format_size(self._offset), error)
+        time.sleep(self.RETRY_DELAY * self._retries)
+        request = urllib2.Request(self._url)
+        request.add_header('Range', 'bytes=%d-' % self._offset)
+        try:
+            fh = urllib2.urlopen(request)
+        except (IOError, httplib.HTTPException, socket.error):
+            return
+        content_range = fh.info().getheader('Content-Range') or ''
+        if (fh.getcode() != 206 or not content_range.startswith(
+                'bytes %d-' % self._offset)):
+            fh.close()
+            raise error
+        self._fh.close()
+        self._fh = fh
+
+    def read(self, size):
+        result = []
+        while size > 0:
+            try:
+                buf = self._fh.read(size)
+                error = None
+            except (IOError, httplib.HTTPException, socket.error) as e:
+                buf = None
+                error = e
+            if buf:
+                # Only give up after too many consecutive interruptions
+                # without any progress.
+                self._retries = 0
+                result.append(buf)
+                self._offset += len(buf)
+                size -= len(buf)
+                self._progress()
+                continue
+            if self._length is None or self._offset >= self._length:
+                if self._t0:
+                    self._progress(done=True)
+                    self._t0 = 0
+                break
+            self._resume(error or IOError(
+                'Connection closed after %d bytes, expected %d' % (
+                    self._offset, self._length)))
+        return ''.join(result)
+
+    def close(self):
+        self._fh.close()
+
+
+def parse_size(value):
+    '''Parse a size with an optional k, m or g suffix, like git does for
+    its size configuration values.'''
+    value = value.strip()
+    factor = 1
+    if value and value[-1].lower() in 'kmg':
+        factor = 1024 ** ('kmg'.index(value[-1].lower()) + 1)
+        value = value[:-1]
+    result = int(value) * factor
+    if result < 0:
+        raise ValueError('Negative size: %s' % value)
+    return result
+
+
+def iter_batches(iterable, size):
+    '''Yield lists of up to `size` consecutive items from `iterable`.'''
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
 def one(l):
     l = list(l)
     if l:
@@ -405,23 +551,59 @@ class lrucache(object):
             self.next.prev = self.prev
             self.next = self.prev = None
 
-    def __init__(self, size):
-        self._size = max(size, 2)
+    # Limits for caches created without an explicit size. They can be
+    # overridden with the cinnabar.cache-size configuration, in the form
+    # <entries>[,<bytes>].
+    DEFAULT_SIZE = 4096
+    DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+    def __init__(self, size=None, max_bytes=None, name=None):
+        self._size = size if size is None else max(size, 2)
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self.name = name
+        self.hits = 0
+        self.misses = 0
         self._cache = {}
         self._top = self.node()
         self._top.next = self._top
         self._top.prev = self._top
 
+    def _configure(self):
+        size = self.DEFAULT_SIZE
+        max_bytes = self.DEFAULT_MAX_BYTES
+        from .git import Git
+        config = Git.config('cinnabar.cache-size')
+        if config:
+            try:
+                entries, _, max_bytes_config = config.partition(',')
+                size = int(entries)
+                if max_bytes_config:
+                    max_bytes = parse_size(max_bytes_config)
+            except ValueError:
+                logging.getLogger('config').warn(
+                    'cinnabar.cache-size: invalid value: %s', config)
+        self._size = max(size, 2)
+        if self._max_bytes is None:
+            self._max_bytes = max_bytes
+
     def __call__(self, func):
+        if self.name is None:
+            self.name = func.__name__
+
         @wraps(func)
         def wrapper(*args):
             try:
-                return self[args]
+                result = self[args]
+                self.hits += 1
+                return result
             except KeyError:
+                self.misses += 1
                 result = func(*args)
                 self[args] = result
                 return result
         wrapper.invalidate = self.invalidate
+        wrapper.cache = self
         return wrapper
 
     def invalidate(self, *args):
@@ -430,30 +612,49 @@ class lrucache(object):
         except KeyError:
             pass
 
+    def log_stats(self):
+        logger = logging.getLogger('cache')
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('%s: %d hits, %d misses, %d entries, %d bytes',
+                        self.name, self.hits, self.misses, len(self._cache),
+                        self._bytes)
+
+    @staticmethod
+    def _sizeof(value):
+        if isinstance(value, str):
+            return len(value)
+        return 0
+
     def __getitem__(self, key):
         node = self._cache[key]
         node.insert(self._top)
         return node.value
 
     def __setitem__(self, key, value):
+        if self._size is None:
+            self._configure()
         if key in self._cache:
             node = self._cache[key]
+            self._bytes -= self._sizeof(node.value)
         else:
             node = self.node()
             node.key = key
 
         node.value = value
         node.insert(self._top)
+        self._bytes += self._sizeof(value)
 
         self._cache[key] = node
-        while len(self._cache) > self._size:
+        while len(self._cache) > self._size or (
+                self._max_bytes and self._bytes > self._max_bytes and
+                len(self._cache) > 1):
             node = self._top.prev
-            node.detach()
-            del self._cache[node.key]
+            del self[node.key]
 
     def __delitem__(self, key):
         node = self._cache.pop(key)
         node.detach()
+        self._bytes -= self._sizeof(node.value)
 
     def __len__(self):
         node = self._top.next
@@ -464,6 +665,10 @@ class lrucache(object):
         assert count == len(self._cache)
         return len(self._cache)
 
+    @property
+    def bytes(self):
+        return self._bytes
+
 
 class Process(object):
     KWARGS = set(['stdin', 'stdout', 'stderr', 'env', 'logger'])
@@ -487,17 +692,22 @@ class Process(object):
         self._proc = self._popen(args, stdin=proc_stdin, stdout=stdout,
                                  stderr=stderr, env=full_env)
 
+        pipe_stdin, pipe_stdout = self._proc.stdin, self._proc.stdout
+        if PerfReport.enabled():
+            pipe_stdin, pipe_stdout = PerfReport.track_process(
+                self, logger, pipe_stdin, pipe_stdout)
+
         logger = logging.getLogger(logger)
         if logger.isEnabledFor(logging.INFO):
-            self._stdin = IOLogger(logger, self._proc.stdout, self._proc.stdin,
+            self._stdin = IOLogger(logger, pipe_stdout, pipe_stdin,
                                    prefix='[%d]' % self.pid)
         else:
-            self._stdin = self._proc.stdin
+            self._stdin = pipe_stdin
 
         if logger.isEnabledFor(logging.DEBUG):
             self._stdout = self._stdin
         else:
-            self._stdout = self._proc.stdout
+            self._stdout = pipe_stdout
 
         if proc_stdin == subprocess.PIPE:
             if isinstance(stdin, StringType):
@@ -523,6 +733,8 @@ class Process(object):
         return proc
 
     def wait(self):
+        if PerfReport.enabled():
+            PerfReport.untrack_process(self)
         for fh in (self._proc.stdin, self._proc.stdout, self._proc.stderr):
             if fh:
                 fh.close()
@@ -559,6 +771,182 @@ class TypedProperty(object):
         self.values[obj] = getattr(self.cls, 'from_obj', self.cls)(value)
 
 
+class PieceTable(object):
+    '''Immutable text made of slices of other strings.
+
+    Patching a PieceTable creates a new one sharing the unmodified parts of
+    the original text, instead of copying the whole text. The full text is
+    only materialized when converting to str.'''
+    __slots__ = ('_pieces', '_offsets', '_len')
+
+    # Number of pieces above which patching consolidates the text in a
+    # single string, to keep lookups and patching cheap.
+    MAX_PIECES = 1024
+
+    def __init__(self, data=''):
+        self._pieces = []
+        self._offsets = []
+        self._len = 0
+        if data:
+            self._append(data, 0, len(data))
+
+    def _append(self, buf, start, end):
+        if start == end:
+            return
+        if self._pieces:
+            last_buf, last_start, last_end = self._pieces[-1]
+            if last_buf is buf and last_end == start:
+                self._pieces[-1] = (buf, last_start, end)
+                self._len += end - start
+                return
+        self._pieces.append((buf, start, end))
+        self._offsets.append(self._len)
+        self._len += end - start
+
+    def _iter_range(self, start, end):
+        '''Yield (offset, buf, buf_start, buf_end) for the pieces covering
+        the [start, end) range of the text, offset being the position of
+        buf_start in the text.'''
+        if start >= end:
+            return
+        i = bisect_right(self._offsets, start) - 1
+        while i < len(self._pieces) and self._offsets[i] < end:
+            buf, buf_start, buf_end = self._pieces[i]
+            offset = self._offsets[i]
+            piece_start = buf_start + max(start - offset, 0)
+            piece_end = buf_start + min(end - offset, buf_end - buf_start)
+            yield offset + piece_start - buf_start, buf, piece_start, \
+                piece_end
+            i += 1
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for buf, start, end in self._pieces:
+            yield buffer(buf, start, end - start)
+
+    def __str__(self):
+        if len(self._pieces) == 1:
+            buf, start, end = self._pieces[0]
+            if start == 0 and end == len(buf):
+                return buf
+        result = bytearray()
+        for buf in self:
+            result += buf
+        return str(result)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, step = key.indices(self._len)
+            assert step == 1
+            return ''.join(buf[s:e]
+                           for _, buf, s, e in self._iter_range(start, end))
+        if key < 0:
+            key += self._len
+        if not 0 <= key < self._len:
+            raise IndexError('PieceTable index out of range')
+        for _, buf, s, e in self._iter_range(key, key + 1):
+            return buf[s]
+
+    def find(self, sub, start=0, end=None):
+        assert len(sub) == 1
+        end = self._len if end is None else min(end, self._len)
+        for offset, buf, s, e in self._iter_range(start, end):
+            pos = buf.find(sub, s, e)
+            if pos != -1:
+                return offset + pos - s
+        return -1
+
+    def rfind(self, sub, start=0, end=None):
+        assert len(sub) == 1
+        end = self._len if end is None else min(end, self._len)
+        if start >= end:
+            return -1
+        i = bisect_right(self._offsets, end - 1) - 1
+        while i >= 0:
+            buf, buf_start, buf_end = self._pieces[i]
+            offset = self._offsets[i]
+            if offset + buf_end - buf_start <= start:
+                break
+            s = buf_start + max(start - offset, 0)
+            e = buf_start + min(end - offset, buf_end - buf_start)
+            pos = buf.rfind(sub, s, e)
+            if pos != -1:
+                return offset + pos - buf_start
+            i -= 1
+        return -1
+
+    def patch(self, diffs):
+        '''Return a new PieceTable with the given diffs applied. Each diff
+        has start, end and text_data attributes, like RevDiff parts, and the
+        diffs are sorted.'''
+        result = PieceTable()
+        end = 0
+        for diff in diffs:
+            for _, buf, s, e in self._iter_range(end, diff.start):
+                result._append(buf, s, e)
+            data = diff.text_data
+            data = data.tobytes() if isinstance(data, memoryview) \
+                else str(data)
+            result._append(data, 0, len(data))
+            end = diff.end
+        for _, buf, s, e in self._iter_range(end, self._len):
+            result._append(buf, s, e)
+        if len(result._pieces) > self.MAX_PIECES:
+            result = PieceTable(str(result))
+        return result
+
+
+class Prefetcher(Thread):
+    '''Iterate over `iterable` in a separate thread.
+
+    Up to `size` items are kept ready for the consumer, which allows e.g.
+    decoding data from the network to overlap with processing the items
+    that were already decoded. Exceptions raised in the thread are
+    re-raised to the consumer.'''
+
+    _DONE = object()
+
+    def __init__(self, iterable, size=1000):
+        super(Prefetcher, self).__init__()
+        self.daemon = True
+        self._iterable = iterable
+        self._queue = Queue(size)
+        self._exc_info = None
+        self._stopped = False
+        self.start()
+
+    def run(self):
+        try:
+            for item in self._iterable:
+                if self._stopped:
+                    break
+                self._queue.put(item)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._queue.put(self._DONE)
+
+    def __iter__(self):
+        item = None
+        try:
+            while True:
+                item = self._queue.get()
+                if item is self._DONE:
+                    break
+                yield item
+        finally:
+            if item is not self._DONE:
+                # The consumer stopped early. Unblock the thread.
+                self._stopped = True
+                while self._queue.get() is not self._DONE:
+                    pass
+            self.join()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+
 class MemoryReporter(Thread):
     def __init__(self):
         super(MemoryReporter, self).__init__()
@@ -593,8 +981,171 @@ class MemoryReporter(Thread):
         self.join()
 
 
+class PipeCounter(object):
+    '''Wrapper for a pipe, counting the bytes going through it in
+    `counts[index]`.'''
+    def __init__(self, fh, counts, index):
+        self._fh = fh
+        self._counts = counts
+        self._index = index
+
+    def read(self, *args):
+        data = self._fh.read(*args)
+        self._counts[self._index] += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self._fh.readline(*args)
+        self._counts[self._index] += len(data)
+        return data
+
+    def write(self, data):
+        self._counts[self._index] += len(data)
+        return self._fh.write(data)
+
+    def __iter__(self):
+        for line in self._fh:
+            self._counts[self._index] += len(line)
+            yield line
+
+    def __getattr__(self, name):
+        return getattr(self._fh, name)
+
+
+class PerfReport(object):
+    '''Performance report, enabled by setting cinnabar.perf-report, or the
+    GIT_CINNABAR_PERF_REPORT environment variable, to the path of a file
+    where the report is appended, as a line of JSON, at exit.
+
+    The report contains the wall time and the number of items processed
+    for each phase, the peak RSS of python and of the processes it spawned,
+    and the number of bytes that went in and out of their pipes.'''
+    _path = None
+    _start = None
+    _phases = []
+    _current = []
+    _pipes = {}
+    _peak_rss = {}
+    _processes = {}
+
+    @classmethod
+    def init(self):
+        from .git import Git
+        # Git.config would look for GIT_CINNABAR_PERF-REPORT, which can't be
+        # set from a shell.
+        self._path = (os.environ.get('GIT_CINNABAR_PERF_REPORT') or
+                      Git.config('cinnabar.perf-report') or None)
+        if self._path:
+            self._start = time.time()
+            atexit.register(self.write)
+
+    @classmethod
+    def enabled(self):
+        return self._path is not None
+
+    @classmethod
+    @contextmanager
+    def phase(self, name):
+        if not self._path:
+            yield
+            return
+        phase = OrderedDict((('name', name), ('items', 0)))
+        self._phases.append(phase)
+        self._current.append(phase)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._current.pop()
+            wall_time = time.time() - start
+            phase['wall_time'] = round(wall_time, 3)
+            phase['items_per_sec'] = \
+                round(phase['items'] / wall_time, 1) if wall_time else None
+            phase['peak_rss'] = self._sample_rss()
+
+    @classmethod
+    def add_items(self, count):
+        if self._current:
+            self._current[-1]['items'] += count
+
+    @classmethod
+    def track_process(self, proc, name, stdin, stdout):
+        '''Register a process, and return wrappers for its stdin and stdout
+        counting the bytes going through them.'''
+        self._processes[proc] = name
+        counts = self._pipes.setdefault(name, [0, 0])
+        if stdin:
+            stdin = PipeCounter(stdin, counts, 1)
+        if stdout:
+            stdout = PipeCounter(stdout, counts, 0)
+        return stdin, stdout
+
+    @classmethod
+    def untrack_process(self, proc):
+        name = self._processes.pop(proc, None)
+        if name:
+            self._update_peak_rss(name, self._process_peak_rss(proc.pid))
+
+    @staticmethod
+    def _process_peak_rss(pid):
+        try:
+            with open('/proc/%s/status' % pid) as fh:
+                for line in fh:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, ValueError):
+            pass
+        return None
+
+    @classmethod
+    def _update_peak_rss(self, name, rss):
+        if rss is not None and rss > self._peak_rss.get(name, 0):
+            self._peak_rss[name] = rss
+
+    @classmethod
+    def _sample_rss(self):
+        rss = self._process_peak_rss('self')
+        if rss is None:
+            try:
+                import resource
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                # ru_maxrss is in bytes on OSX, and kilobytes elsewhere.
+                if sys.platform != 'darwin':
+                    rss *= 1024
+            except ImportError:
+                pass
+        self._update_peak_rss('python', rss)
+        for proc, name in self._processes.items():
+            self._update_peak_rss(name, self._process_peak_rss(proc.pid))
+        return dict(self._peak_rss)
+
+    @classmethod
+    def report(self):
+        return OrderedDict((
+            ('command', [os.path.basename(sys.argv[0])] + sys.argv[1:2]),
+            ('start', round(self._start, 3)),
+            ('wall_time', round(time.time() - self._start, 3)),
+            ('phases', self._phases),
+            ('peak_rss', self._sample_rss()),
+            ('pipes', {
+                name: {'in': counts[0], 'out': counts[1]}
+                for name, counts in self._pipes.iteritems()
+            }),
+        ))
+
+    @classmethod
+    def write(self):
+        try:
+            with open(self._path, 'a') as fh:
+                fh.write(json.dumps(self.report()) + '\n')
+        except IOError as e:
+            logging.getLogger('perf').warning(
+                'Cannot write performance report: %s', e)
+
+
 def run(func):
     init_logging()
+    PerfReport.init()
     if check_enabled('memory'):
         reporter = MemoryReporter()
     try:
@@ -18,6 +18,9 @@
  * - cat-file <object>
  *     Returns the contents of the given git object, in a `cat-file
  *     --batch`-like format.
+ * - file-node (<blob> <parent1> <parent2>)+
+ *     Returns the mercurial node of a file with the given blob content and
+ *     parents, without metadata, or a null node when it can't be computed.
  *  - connect <url>
  *     Connects to the mercurial repository at the given url. The helper then
  *     expects one of the following commands:
@@ -66,6 +69,7 @@
 #include "revision.h"
 #include "tree.h"
 #include "tree-walk.h"
+#include "hg-bdiff.h"
 #include "hg-connect.h"
 #include "hg-data.h"
 #include "cinnabar-helper.h"
@@ -78,7 +82,7 @@
 #define HELPER_HASH unknown
 #endif
 
-#define CMD_VERSION 2400
+#define CMD_VERSION 2500
 
 static const char NULL_NODE[] = "0000000000000000000000000000000000000000";
 
@@ -205,22 +209,31 @@ static void send_object(unsigned const char *sha1)
 	close_istream(st);
 }
 
-static void do_cat_file(struct string_list *args)
+static void cat_one_file(const char *name)
 {
 	unsigned char sha1[20];
 
-	if (args->nr != 1)
-		goto not_found;
-
-	if (get_sha1(args->items[0].string, sha1))
-		goto not_found;
+	if (get_sha1(name, sha1)) {
+		write_or_die(1, NULL_NODE, 40);
+		write_or_die(1, "\n", 1);
+		return;
+	}
 
 	send_object(sha1);
-	return;
+}
 
-not_found:
-	write_or_die(1, NULL_NODE, 40);
-	write_or_die(1, "\n", 1);
+static void do_cat_file(struct string_list *args)
+{
+	struct string_list_item *item;
+
+	if (!args->nr) {
+		write_or_die(1, NULL_NODE, 40);
+		write_or_die(1, "\n", 1);
+		return;
+	}
+
+	for_each_string_list_item(item, args)
+		cat_one_file(item->string);
 }
 
 struct ls_tree_context {
@@ -411,17 +424,12 @@ static void do_diff_tree(struct string_list *args)
 	rev_info_release(&revs);
 }
 
-static void do_get_note(struct notes_tree *t, struct string_list *args)
+static void get_one_note(struct notes_tree *t, const char *committish)
 {
 	unsigned char sha1[20];
 	const unsigned char *note;
 
-	if (args->nr != 1)
-		goto not_found;
-
-	ensure_notes(t);
-
-	if (get_sha1_committish(args->items[0].string, sha1))
+	if (get_sha1_committish(committish, sha1))
 		goto not_found;
 
 	note = get_note(t, lookup_replace_object(sha1));
@@ -436,6 +444,23 @@ not_found:
 	write_or_die(1, "\n", 1);
 }
 
+/* Send the note for each of the given committishes, in order. */
+static void do_get_note(struct notes_tree *t, struct string_list *args)
+{
+	struct string_list_item *item;
+
+	if (!args->nr) {
+		write_or_die(1, NULL_NODE, 40);
+		write_or_die(1, "\n", 1);
+		return;
+	}
+
+	ensure_notes(t);
+
+	for_each_string_list_item(item, args)
+		get_one_note(t, item->string);
+}
+
 static size_t get_abbrev_sha1_hex(const char *hex, unsigned char *sha1)
 {
 	const char *hex_start = hex;
@@ -568,16 +593,13 @@ static const unsigned char *resolve_hg2git(const unsigned char *sha1,
 	return get_abbrev_note(&hg2git, sha1, len);
 }
 
-static void do_hg2git(struct string_list *args)
+static void hg2git_one(const char *hex)
 {
 	unsigned char sha1[20];
 	const unsigned char *note;
 	size_t sha1_len;
 
-	if (args->nr != 1)
-		goto not_found;
-
-	sha1_len =  get_abbrev_sha1_hex(args->items[0].string, sha1);
+	sha1_len =  get_abbrev_sha1_hex(hex, sha1);
 	if (!sha1_len)
 		goto not_found;
 
@@ -593,6 +615,21 @@ not_found:
 	write_or_die(1, "\n", 1);
 }
 
+/* Send the git sha1 for each of the given mercurial sha1s, in order. */
+static void do_hg2git(struct string_list *args)
+{
+	struct string_list_item *item;
+
+	if (!args->nr) {
+		write_or_die(1, NULL_NODE, 40);
+		write_or_die(1, "\n", 1);
+		return;
+	}
+
+	for_each_string_list_item(item, args)
+		hg2git_one(item->string);
+}
+
 /* Return the mercurial manifest character corresponding to the given
  * git file mode. */
 static const char *hgattr(unsigned int mode)
@@ -1031,28 +1068,32 @@ static void get_manifest_sha1(const struct commit *commit, unsigned char *sha1)
 	unuse_commit_buffer(commit, msg);
 }
 
-static void hg_sha1(struct strbuf *data, const unsigned char *parent1,
-                    const unsigned char *parent2, unsigned char *result)
+static void hg_sha1_init(git_SHA_CTX *ctx, const unsigned char *parent1,
+                         const unsigned char *parent2)
 {
-	git_SHA_CTX ctx;
-
 	if (!parent1)
 		parent1 = null_sha1;
 	if (!parent2)
 		parent2 = null_sha1;
 
-	git_SHA1_Init(&ctx);
+	git_SHA1_Init(ctx);
 
 	if (hashcmp(parent1, parent2) < 0) {
-		git_SHA1_Update(&ctx, parent1, 20);
-		git_SHA1_Update(&ctx, parent2, 20);
+		git_SHA1_Update(ctx, parent1, 20);
+		git_SHA1_Update(ctx, parent2, 20);
 	} else {
-		git_SHA1_Update(&ctx, parent2, 20);
-		git_SHA1_Update(&ctx, parent1, 20);
+		git_SHA1_Update(ctx, parent2, 20);
+		git_SHA1_Update(ctx, parent1, 20);
 	}
+}
 
-	git_SHA1_Update(&ctx, data->buf, data->len);
+static void hg_sha1(struct strbuf *data, const unsigned char *parent1,
+                    const unsigned char *parent2, unsigned char *result)
+{
+	git_SHA_CTX ctx;
 
+	hg_sha1_init(&ctx, parent1, parent2);
+	git_SHA1_Update(&ctx, data->buf, data->len);
 	git_SHA1_Final(result, &ctx);
 }
 
@@ -1173,6 +1214,97 @@ error:
 	hg_file_release(&file);
 }
 
+/* Computes the mercurial node of a file without metadata, with the given
+ * blob content and parents. The blob is streamed, so that large files are
+ * never entirely loaded in memory. Returns 0 on success, and -1 when the
+ * blob can't be read, or when its content would need metadata escaping. */
+static int file_node(const unsigned char *sha1, const unsigned char *parent1,
+                     const unsigned char *parent2, unsigned char *result)
+{
+	git_SHA_CTX ctx;
+	struct git_istream *st;
+	enum object_type type;
+	unsigned long size;
+	char buf[16384], prefix[2];
+	size_t prefix_len = 0;
+	ssize_t len;
+
+	st = open_istream(sha1, &type, &size, NULL);
+	if (!st)
+		return -1;
+	if (type != OBJ_BLOB) {
+		close_istream(st);
+		return -1;
+	}
+
+	hg_sha1_init(&ctx, parent1, parent2);
+	while ((len = read_istream(st, buf, sizeof(buf))) > 0) {
+		ssize_t i;
+		for (i = 0; prefix_len < 2 && i < len; i++)
+			prefix[prefix_len++] = buf[i];
+		git_SHA1_Update(&ctx, buf, len);
+	}
+	close_istream(st);
+	if (len < 0)
+		return -1;
+	if (prefix_len == 2 && prefix[0] == '\1' && prefix[1] == '\n')
+		return -1;
+
+	git_SHA1_Final(result, &ctx);
+	return 0;
+}
+
+/* Takes triples of <blob> <parent1> <parent2> and sends back, for each,
+ * the mercurial node of a file with that content and those parents, or
+ * the null node if it can't be computed. */
+static void do_file_node(struct string_list *args)
+{
+	unsigned char sha1[20], parent1[20], parent2[20], result[20];
+	size_t i;
+
+	if (!args->nr || args->nr % 3)
+		die("file-node needs triples of arguments");
+
+	for (i = 0; i < args->nr; i += 3) {
+		if (get_sha1_hex(args->items[i].string, sha1) ||
+		    get_sha1_hex(args->items[i + 1].string, parent1) ||
+		    get_sha1_hex(args->items[i + 2].string, parent2) ||
+		    file_node(sha1, parent1, parent2, result)) {
+			write_or_die(1, NULL_NODE, 40);
+		} else {
+			write_or_die(1, sha1_to_hex(result), 40);
+		}
+		write_or_die(1, "\n", 1);
+	}
+}
+
+/* Reads two buffers of the given sizes from stdin, and sends back a binary
+ * diff between them. */
+static void do_bdiff(struct string_list *args)
+{
+	struct strbuf a = STRBUF_INIT;
+	struct strbuf b = STRBUF_INIT;
+	struct strbuf result = STRBUF_INIT;
+	size_t a_len, b_len;
+
+	if (args->nr != 2)
+		exit(1);
+
+	a_len = strtoul(args->items[0].string, NULL, 10);
+	b_len = strtoul(args->items[1].string, NULL, 10);
+
+	if (strbuf_fread(&a, a_len, stdin) != a_len ||
+	    strbuf_fread(&b, b_len, stdin) != b_len)
+		die("Failed to read bdiff input");
+
+	hg_bdiff(a.buf, a.len, b.buf, b.len, &result);
+	send_buffer(&result);
+
+	strbuf_release(&a);
+	strbuf_release(&b);
+	strbuf_release(&result);
+}
+
 static void do_version(struct string_list *args)
 {
 	long int version;
@@ -1749,6 +1881,10 @@ int cmd_main(int argc, const char *argv[])
 			do_seen(&args);
 		else if (!strcmp("dangling", command))
 			do_dangling(&args);
+		else if (!strcmp("bdiff", command))
+			do_bdiff(&args);
+		else if (!strcmp("file-node", command))
+			do_file_node(&args);
 		else if (!maybe_handle_command(command, &args))
 			die("Unknown command: \"%s\"", command);
 
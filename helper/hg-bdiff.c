@@ -0,0 +1,294 @@
+/* Line-based binary diff, producing deltas in the format mercurial uses for
+ * its revlogs and changegroups.
+ *
+ * The algorithm is the one from mercurial's bdiff.c:
+ * Copyright 2005, 2006 Matt Mackall <mpm@selenic.com>
+ *
+ * Lines are hashed and grouped in equivalence classes through a hash table,
+ * then the longest matching block between both sides is found, and the
+ * process recurses on what is left on either side of that block. */
+
+#include "git-compat-util.h"
+#include "hg-bdiff.h"
+
+struct bdiff_line {
+	unsigned int hash;
+	int n, e;
+	size_t len;
+	const char *l;
+};
+
+struct bdiff_pos {
+	int pos, len;
+};
+
+struct bdiff_hunk {
+	int a1, a2, b1, b2;
+	struct bdiff_hunk *next;
+};
+
+#define ROL32(x, n) ((x) << (n) | (x) >> (32 - (n)))
+#define HASH(h, c) ((unsigned char)(c) + ROL32((h), 7))
+
+/* Split the given buffer in lines, with an extra sentinel line at the end.
+ * Returns the number of lines, not counting the sentinel. */
+static int split_lines(const char *a, size_t len, struct bdiff_line **result)
+{
+	unsigned int hash = 0;
+	int count = 1;
+	const char *p, *b = a;
+	const char *end = a + len;
+	struct bdiff_line *l;
+
+	for (p = a; p < end; p++)
+		if (*p == '\n')
+			count++;
+	if (len && end[-1] != '\n')
+		count++;
+
+	*result = l = xcalloc(count, sizeof(struct bdiff_line));
+
+	for (p = a; p < end; p++) {
+		hash = HASH(hash, *p);
+		if (*p == '\n' || p == end - 1) {
+			l->hash = hash;
+			l->len = p - b + 1;
+			l->l = b;
+			l->n = INT_MAX;
+			l++;
+			b = p + 1;
+			hash = 0;
+		}
+	}
+
+	/* sentinel */
+	l->hash = 0;
+	l->len = 0;
+	l->l = end;
+	return count - 1;
+}
+
+static inline int line_cmp(struct bdiff_line *a, struct bdiff_line *b)
+{
+	return a->hash != b->hash || a->len != b->len ||
+	       memcmp(a->l, b->l, a->len);
+}
+
+/* Assign each line an equivalence class, and chain the lines of `b` that are
+ * in the same class together. Lines of `a` get pointed to the head of the
+ * chain for their class, unless that class is too popular. */
+static void equate_lines(struct bdiff_line *a, int an,
+                         struct bdiff_line *b, int bn)
+{
+	int i, j, threshold;
+	unsigned int buckets = 1;
+	struct bdiff_pos *h;
+
+	/* Use a hash table four times as large as the next power of 2, to
+	 * avoid collisions. */
+	while (buckets < bn + 1)
+		buckets *= 2;
+	buckets *= 4;
+	ALLOC_ARRAY(h, buckets);
+	buckets--;
+
+	for (i = 0; i <= buckets; i++) {
+		h[i].pos = -1;
+		h[i].len = 0;
+	}
+
+	for (i = 0; i < bn; i++) {
+		for (j = b[i].hash & buckets; h[j].pos != -1;
+		     j = (j + 1) & buckets)
+			if (!line_cmp(b + i, b + h[j].pos))
+				break;
+		b[i].n = h[j].pos;
+		b[i].e = j;
+		h[j].pos = i;
+		h[j].len++;
+	}
+
+	threshold = (bn >= 31000) ? bn / 1000 : 1000000 / (bn + 1);
+
+	for (i = 0; i < an; i++) {
+		for (j = a[i].hash & buckets; h[j].pos != -1;
+		     j = (j + 1) & buckets)
+			if (!line_cmp(a + i, b + h[j].pos))
+				break;
+		a[i].e = j;
+		if (h[j].len <= threshold)
+			a[i].n = h[j].pos;
+		else
+			a[i].n = -1;
+	}
+
+	free(h);
+}
+
+static int longest_match(struct bdiff_line *a, struct bdiff_line *b,
+                         struct bdiff_pos *pos, int a1, int a2, int b1, int b2,
+                         int *omi, int *omj)
+{
+	int mi = a1, mj = b1, mk = 0, i, j, k, half, bhalf;
+
+	/* Window the search on large regions to bound worst-case
+	 * performance. */
+	if (a2 - a1 > 30000)
+		a1 = a2 - 30000;
+
+	half = (a1 + a2 - 1) / 2;
+	bhalf = (b1 + b2 - 1) / 2;
+
+	for (i = a1; i < a2; i++) {
+		/* Skip all lines in b after the current block. */
+		for (j = a[i].n; j >= b2; j = b[j].n)
+			;
+
+		for (; j >= b1; j = b[j].n) {
+			/* Does this extend an earlier match? */
+			for (k = 1; j - k >= b1 && i - k >= a1; k++) {
+				if (pos[j - k].pos == i - k) {
+					k += pos[j - k].len;
+					break;
+				}
+				if (a[i - k].e != b[j - k].e)
+					break;
+			}
+
+			pos[j].pos = i;
+			pos[j].len = k;
+
+			/* Prefer matches closer to the middle, to balance
+			 * recursion. */
+			if (k > mk) {
+				mi = i;
+				mj = j;
+				mk = k;
+			} else if (k == mk) {
+				if (i > mi && i <= half && j > b1) {
+					mi = i;
+					mj = j;
+				} else if (i == mi && (mj > bhalf || i == a1)) {
+					mj = j;
+				}
+			}
+		}
+	}
+
+	if (mk) {
+		mi = mi - mk + 1;
+		mj = mj - mk + 1;
+	}
+
+	/* Expand the match to include subsequent popular lines. */
+	while (mi + mk < a2 && mj + mk < b2 &&
+	       a[mi + mk].e == b[mj + mk].e)
+		mk++;
+
+	*omi = mi;
+	*omj = mj;
+	return mk;
+}
+
+static struct bdiff_hunk *recurse(struct bdiff_line *a, struct bdiff_line *b,
+                                  struct bdiff_pos *pos, int a1, int a2,
+                                  int b1, int b2, struct bdiff_hunk *l)
+{
+	int i, j, k;
+
+	for (;;) {
+		k = longest_match(a, b, pos, a1, a2, b1, b2, &i, &j);
+		if (!k)
+			return l;
+
+		l = recurse(a, b, pos, a1, i, b1, j, l);
+
+		l->next = xmalloc(sizeof(struct bdiff_hunk));
+		l = l->next;
+		l->a1 = i;
+		l->a2 = i + k;
+		l->b1 = j;
+		l->b2 = j + k;
+		l->next = NULL;
+
+		a1 = i + k;
+		b1 = j + k;
+	}
+}
+
+/* Fill the list after `base` with the matching blocks between `a` and `b`,
+ * ending with an empty block at the end of both. */
+static void diff_lines(struct bdiff_line *a, int an, struct bdiff_line *b,
+                       int bn, struct bdiff_hunk *base)
+{
+	struct bdiff_hunk *curr;
+	struct bdiff_pos *pos;
+
+	equate_lines(a, an, b, bn);
+	pos = xcalloc(bn ? bn : 1, sizeof(struct bdiff_pos));
+
+	curr = recurse(a, b, pos, 0, an, 0, bn, base);
+	curr->next = xmalloc(sizeof(struct bdiff_hunk));
+	curr = curr->next;
+	curr->a1 = curr->a2 = an;
+	curr->b1 = curr->b2 = bn;
+	curr->next = NULL;
+
+	free(pos);
+
+	/* Normalize the hunk list, pushing each hunk towards the end. */
+	for (curr = base->next; curr && curr->next; curr = curr->next) {
+		struct bdiff_hunk *next = curr->next;
+
+		if (curr->a2 == next->a1 || curr->b2 == next->b1)
+			while (curr->a2 < an && curr->b2 < bn &&
+			       next->a1 < next->a2 && next->b1 < next->b2 &&
+			       !line_cmp(a + curr->a2, b + curr->b2)) {
+				curr->a2++;
+				next->a1++;
+				curr->b2++;
+				next->b1++;
+			}
+	}
+}
+
+static void add_be32(struct strbuf *out, uint32_t value)
+{
+	value = htonl(value);
+	strbuf_add(out, &value, sizeof(value));
+}
+
+void hg_bdiff(const char *a, size_t a_len, const char *b, size_t b_len,
+              struct strbuf *out)
+{
+	struct bdiff_line *al, *bl;
+	struct bdiff_hunk base, *h;
+	int an, bn, la = 0, lb = 0;
+
+	an = split_lines(a, a_len, &al);
+	bn = split_lines(b, b_len, &bl);
+
+	base.next = NULL;
+	diff_lines(al, an, bl, bn, &base);
+
+	for (h = base.next; h; h = h->next) {
+		if (h->a1 != la || h->b1 != lb) {
+			size_t len = bl[h->b1].l - bl[lb].l;
+			add_be32(out, al[la].l - a);
+			add_be32(out, al[h->a1].l - a);
+			add_be32(out, len);
+			strbuf_add(out, bl[lb].l, len);
+		}
+		la = h->a2;
+		lb = h->b2;
+	}
+
+	h = base.next;
+	while (h) {
+		struct bdiff_hunk *next = h->next;
+		free(h);
+		h = next;
+	}
+	free(al);
+	free(bl);
+}
@@ -0,0 +1,11 @@
+#ifndef HG_BDIFF_H
+#define HG_BDIFF_H
+
+#include "strbuf.h"
+
+/* Append to `out` a binary diff, in mercurial's bdiff format, between the
+ * buffers `a` and `b`. */
+extern void hg_bdiff(const char *a, size_t a_len, const char *b, size_t b_len,
+                     struct strbuf *out);
+
+#endif
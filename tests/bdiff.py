@@ -0,0 +1,102 @@
+import random
+import struct
+import unittest
+from cinnabar.bdiff import (
+    _bdiff,
+    HELPER_BDIFF_THRESHOLD,
+)
+from cinnabar.helper import (
+    GitHgHelper,
+    HelperClosedException,
+    NoHelperException,
+)
+from cinnabar.hg.changegroup import RevDiff
+
+
+class TestBdiff(unittest.TestCase):
+    def check(self, a, b):
+        self.assertEquals(RevDiff(_bdiff(a, b)).apply(a), b)
+
+    def test_bdiff(self):
+        self.assertEquals(_bdiff('', ''), '')
+        self.assertEquals(_bdiff('a\nb\n', 'a\nb\n'), '')
+        self.check('', 'a\nb\n')
+        self.check('a\nb\n', '')
+        self.check('a\nb\nc\n', 'a\nc\n')
+        self.check('a\nb\nc\n', 'a\nb\nd\nc\n')
+        self.check('a\nb\nc', 'a\nb\nc\n')
+        self.check('a\na\na\nb\n', 'b\na\na\na\n')
+
+
+class TestHelperBdiff(unittest.TestCase):
+    def setUp(self):
+        try:
+            GitHgHelper._ensure_helper()
+        except (NoHelperException, HelperClosedException):
+            self.skipTest('cinnabar helper is not available')
+
+    def check(self, a, b):
+        self.assertGreaterEqual(len(a) + len(b), HELPER_BDIFF_THRESHOLD)
+        self.assertEquals(RevDiff(GitHgHelper.bdiff(a, b)).apply(a), b)
+
+    def test_bdiff(self):
+        lines = ''.join('line %d\n' % n for n in range(3000))
+        self.assertEquals(GitHgHelper.bdiff(lines, lines), '')
+        self.check('', lines)
+        self.check(lines, '')
+        self.check(lines, lines.replace('line 1000\n', 'other\n'))
+        self.check(lines, lines[:-1])
+        self.check(lines[:-1], lines)
+        self.check(lines[:-1], lines[:-1] + 'foo')
+        self.check(lines + 'foo', lines + 'bar')
+
+        repeated = 'a\n' * 10000
+        self.check(repeated, 'b\n' + repeated)
+        self.check(repeated, repeated[:10000] + 'b\n' + repeated[10000:])
+        self.check(repeated, repeated[:-1])
+        self.check(repeated + 'b\n', 'b\n' + repeated)
+        self.check('a\nb\n' * 5000, 'b\na\n' * 5000)
+
+
+class TestRevDiff(unittest.TestCase):
+    @staticmethod
+    def naive_apply(orig, parts):
+        result = ''
+        end = 0
+        for start, finish, data in parts:
+            result += orig[end:start] + data
+            end = finish
+        return result + orig[end:]
+
+    @staticmethod
+    def make_patch(parts):
+        return ''.join(struct.pack('>lll', start, end, len(data)) + data
+                       for start, end, data in parts)
+
+    def test_apply(self):
+        rng = random.Random(42)
+        for _ in range(200):
+            orig = ''.join(chr(rng.randint(0, 255))
+                           for _ in range(rng.randint(0, 200)))
+            points = sorted(rng.randint(0, len(orig))
+                            for _ in range(rng.randint(0, 5) * 2))
+            parts = [
+                (start, end, 'x' * rng.randint(0, 20))
+                for start, end in zip(points[::2], points[1::2])
+            ]
+            diff = RevDiff(self.make_patch(parts))
+            expected = self.naive_apply(orig, parts)
+            self.assertEqual(diff.apply(orig), expected)
+            buf = diff.apply_buffer(orig)
+            self.assertIsInstance(buf, (str, bytearray))
+            self.assertEqual(str(buf), expected)
+
+    def test_apply_noop(self):
+        orig = 'foo\nbar\n'
+        self.assertIs(RevDiff('').apply(orig), orig)
+        self.assertIs(RevDiff(self.make_patch([(0, 0, '')])).apply(orig),
+                      orig)
+        self.assertIs(RevDiff(self.make_patch([(3, 3, '')])).apply_buffer(
+            orig), orig)
+        self.assertEqual(
+            RevDiff(self.make_patch([(0, len(orig), '')])).apply(orig), '')
@@ -1,3 +1,4 @@
+import random
 import unittest
 from cinnabar.dag import gitdag
 
@@ -83,3 +84,86 @@ class TestDag(unittest.TestCase):
         self.assertEqual(set(self.dag.heads('bar')), set('EGH'))
         self.assertEqual(set(self.dag.roots()), set())
         self.assertEqual(set(self.dag.heads()), set())
+
+    def test_order(self):
+        self.assertEqual(list(self.dag.heads()), list('EGHIJ'))
+        self.assertEqual(list(self.dag.all_heads(with_tags=False)),
+                         list('EGHIJ'))
+        self.dag.tag_nodes_and_children('F', 'foo')
+        self.assertEqual(list(self.dag.all_heads()), [
+            (None, 'C'), (None, 'E'), (None, 'G'), (None, 'H'),
+            ('foo', 'I'), ('foo', 'J'),
+        ])
+
+    def test_tag(self):
+        self.dag.tag_nodes_and_parents('D', 'foo')
+        self.assertEqual(self.dag.tag('A'), 'foo')
+        self.assertEqual(self.dag.tag('B'), 'foo')
+        self.assertEqual(self.dag.tag('C'), None)
+        self.assertEqual(self.dag.tag('Z'), None)
+        self.assertEqual(self.dag.tags(), set(['foo']))
+
+        self.dag.clear_tags()
+        self.assertEqual(self.dag.tag('B'), None)
+        self.assertEqual(self.dag.tags(), set())
+        self.assertEqual(set(self.dag.roots()), set('BC'))
+        self.assertEqual(set(self.dag.heads()), set('EGHIJ'))
+        self.assertEqual(set(self.dag.heads('foo')), set())
+
+    def test_add(self):
+        # Nodes can be added after their children, and more parents can be
+        # given to existing nodes.
+        dag = gitdag([('C', ('B',)), ('B', ('A',))])
+        self.assertEqual(set(dag.roots()), set('B'))
+        self.assertEqual(set(dag.heads()), set('C'))
+        dag.add('A', (), 'foo')
+        self.assertEqual(set(dag.roots()), set('B'))
+        self.assertEqual(set(dag.roots('foo')), set('A'))
+        self.assertEqual(set(dag.heads('foo')), set('A'))
+        dag.add('C', ('A',))
+        self.assertEqual(set(dag.parents('C')), set('AB'))
+        self.assertEqual(set(dag.children('A')), set('BC'))
+        self.assertEqual(len(dag), 3)
+        self.assertIn('A', dag)
+        self.assertNotIn('D', dag)
+
+
+class TestDagRandom(unittest.TestCase):
+    def check(self, dag, revs):
+        parents = dict((n, set(p)) for n, p in revs)
+        children = dict((n, set()) for n in parents)
+        for n, p in revs:
+            for p in p:
+                if p in children:
+                    children[p].add(n)
+        for tag in dag.tags() | set([None]):
+            nodes = set(n for n in parents if dag.tag(n) == tag)
+            self.assertEqual(
+                set(dag.heads(tag)),
+                set(n for n in nodes if not children[n] & nodes))
+            self.assertEqual(
+                set(dag.roots(tag)),
+                set(n for n in nodes if not parents[n] & nodes))
+
+    def test_random(self):
+        rand = random.Random(42)
+        revs = []
+        for n in range(200):
+            revs.append((n, tuple(set(rand.randrange(n) for _ in range(2)))
+                         if n else ()))
+        rand.shuffle(revs)
+        dag = gitdag()
+        for i, (n, p) in enumerate(revs):
+            dag.add(n, p, rand.choice((None, None, 'a', 'b')))
+            if i % 20 == 0:
+                self.check(dag, revs[:i + 1])
+        for i in range(20):
+            nodes = rand.sample(range(200), 5)
+            tag = rand.choice(('a', 'b', 'c'))
+            if i % 2:
+                dag.tag_nodes_and_parents(nodes, tag)
+            else:
+                dag.tag_nodes_and_children(nodes, tag)
+            self.check(dag, revs)
+        dag.clear_tags()
+        self.check(dag, revs)
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+from cinnabar.diskcache import DiskCache
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_disk_cache(self):
+        cache = DiskCache(self.path, 100)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.size(), 0)
+
+        cache.put('foo', 'a' * 10)
+        self.assertEqual(cache.get('foo'), 'a' * 10)
+        self.assertEqual(cache.size(), 10)
+
+        cache = DiskCache(self.path, 100)
+        self.assertEqual(cache.get('foo'), 'a' * 10)
+        self.assertEqual(cache.size(), 10)
+
+        with self.assertRaises(RuntimeError):
+            with cache.writer('bar') as fh:
+                fh.write('b' * 10)
+                raise RuntimeError()
+        self.assertEqual(cache.get('bar'), None)
+        self.assertEqual(os.listdir(self.path), ['foo'])
+
+        cache.clear()
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.size(), 0)
+
+    def test_disk_cache_eviction(self):
+        cache = DiskCache(self.path, 100)
+        for n in range(5):
+            cache.put(str(n), str(n) * 30)
+            # Make the modification times distinct and in order.
+            os.utime(cache.path(str(n)), (n * 10, n * 10))
+            if n == 2:
+                # Using an entry makes it the most recently used.
+                cache.get('0')
+        self.assertLessEqual(cache.size(), 90)
+        self.assertEqual(sorted(os.listdir(self.path)), ['0', '3', '4'])
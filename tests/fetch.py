@@ -0,0 +1,100 @@
+import importlib
+import os
+import unittest
+
+# cinnabar.cmd.fetch is shadowed by the fetch function in cinnabar.cmd.
+fetch = importlib.import_module('cinnabar.cmd.fetch')
+
+
+def download_bundle(args):
+    # This runs in the worker processes, so it needs to be a module-level
+    # function.
+    name, url, directory = args
+    if name == 'd':
+        # Nothing to fetch from this one.
+        return None
+    path = os.path.join(directory, name.replace('/', '_'))
+    with open(path, 'wb') as fh:
+        fh.write('bundle for %s' % url)
+    return path
+
+
+class FakeStore(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestFetchAllRemotes(unittest.TestCase):
+    REMOTES = [('a', 'hg::http://a/'), ('b/c', 'hg::http://b/'),
+               ('d', 'hg::http://d/'), ('e', 'hg::http://e/')]
+
+    def setUp(self):
+        self.applied = []
+        self.fetched = []
+        self.stores = []
+        self.directories = []
+        test = self
+
+        def mkdtemp(prefix):
+            path = test.orig_mkdtemp(prefix=prefix)
+            test.directories.append(path)
+            return path
+
+        class FakeBundleApplier(object):
+            def __init__(self, bundle, skip_known=False):
+                self.bundle = bundle
+                self.skip_known = skip_known
+
+            def __call__(self, store):
+                test.assertIs(store, test.stores[-1])
+                test.assertFalse(store.closed)
+                test.applied.append((self.bundle, self.skip_known))
+
+        class FakeProcess(object):
+            def __init__(self, *args, **kwargs):
+                test.fetched.append(args)
+
+            def wait(self):
+                return 1 if test.fetched[-1][1] == 'e' else 0
+
+        def store():
+            test.stores.append(FakeStore())
+            return test.stores[-1]
+
+        self.orig = (fetch.hg_remotes, fetch.download_bundle,
+                     fetch.tempfile.mkdtemp, fetch.BundleApplier,
+                     fetch.GitHgStore, fetch.GitProcess, fetch.unbundle_fh,
+                     fetch.unbundler)
+        self.orig_mkdtemp = fetch.tempfile.mkdtemp
+        fetch.hg_remotes = lambda: iter(self.REMOTES)
+        fetch.download_bundle = download_bundle
+        fetch.tempfile.mkdtemp = mkdtemp
+        fetch.BundleApplier = FakeBundleApplier
+        fetch.GitHgStore = store
+        fetch.GitProcess = FakeProcess
+        fetch.unbundle_fh = lambda fh, path: fh.read()
+        fetch.unbundler = lambda bundle: bundle
+
+    def tearDown(self):
+        (fetch.hg_remotes, fetch.download_bundle,
+         fetch.tempfile.mkdtemp, fetch.BundleApplier,
+         fetch.GitHgStore, fetch.GitProcess, fetch.unbundle_fh,
+         fetch.unbundler) = self.orig
+
+    def test_fetch_all_remotes(self):
+        self.assertEqual(fetch.fetch_all_remotes(2), 1)
+        # Bundles are applied in the order of the remotes, in a single
+        # store, skipping what was already imported.
+        self.assertEqual(self.applied, [
+            ('bundle for hg::http://a/', True),
+            ('bundle for hg::http://b/', True),
+            ('bundle for hg::http://e/', True),
+        ])
+        self.assertEqual(len(self.stores), 1)
+        self.assertTrue(self.stores[0].closed)
+        self.assertEqual(self.fetched, [('fetch', name)
+                                        for name, url in self.REMOTES])
+        self.assertEqual(len(self.directories), 1)
+        self.assertFalse(os.path.exists(self.directories[0]))
@@ -0,0 +1,172 @@
+import importlib
+import os
+import shutil
+import tempfile
+import unittest
+from cinnabar.cmd.fsck import (
+    check_manifests,
+    FsckCheckpoint,
+    incremental_base,
+    manifest_tasks,
+    record_validated,
+)
+from cinnabar.git import Git
+from cinnabar.helper import GitHgHelper
+
+# cinnabar.cmd.fsck is shadowed by the fsck function in cinnabar.cmd.
+fsck = importlib.import_module('cinnabar.cmd.fsck')
+
+
+class TestFsckCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.git_dir = Git._git_dir
+        Git._git_dir = self.tmpdir
+        self.path = os.path.join(self.tmpdir, 'cinnabar', 'fsck-checkpoint')
+
+    def tearDown(self):
+        Git._git_dir = self.git_dir
+        shutil.rmtree(self.tmpdir)
+
+    def test_checkpoint(self):
+        checkpoint = FsckCheckpoint('key')
+        self.assertEqual(checkpoint.done, set())
+        checkpoint.add('1' * 40)
+        checkpoint.add('2' * 40)
+
+        # A truncated entry, as would be left by an interrupted fsck.
+        with open(self.path, 'a') as fh:
+            fh.write('3' * 20)
+
+        checkpoint = FsckCheckpoint('key')
+        self.assertEqual(checkpoint.done, set(['1' * 40, '2' * 40]))
+        checkpoint.add('4' * 40)
+        checkpoint = FsckCheckpoint('key')
+        self.assertEqual(checkpoint.done,
+                         set(['1' * 40, '2' * 40, '4' * 40]))
+
+        # The checkpoint is ignored for different metadata or options.
+        self.assertEqual(FsckCheckpoint('other key').done, set())
+
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(FsckCheckpoint('key').done, set())
+
+
+class TestIncrementalBase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.git_dir = Git._git_dir
+        Git._git_dir = self.tmpdir
+        self.orig = Git.resolve_ref, fsck.metadata_history
+        # Metadata history, from the most recent metadata commit.
+        self.history = ['3' * 40, '2' * 40, '1' * 40]
+        Git.resolve_ref = classmethod(lambda cls, ref: self.history[0])
+        fsck.metadata_history = lambda metadata: iter(self.history)
+
+    def tearDown(self):
+        Git._git_dir = self.git_dir
+        Git.resolve_ref, fsck.metadata_history = self.orig
+        shutil.rmtree(self.tmpdir)
+
+    def test_incremental_base(self):
+        self.assertEqual(incremental_base([]), None)
+
+        record_validated('2' * 40, ['manifests'])
+        self.assertEqual(incremental_base([]), '2' * 40)
+        self.assertEqual(incremental_base(['manifests']), '2' * 40)
+        # Files were not checked in the recorded fsck.
+        self.assertEqual(incremental_base(['files']), None)
+        self.assertEqual(incremental_base(['manifests', 'files']), None)
+
+        # The recorded metadata is not in the history anymore, e.g. after
+        # a rollback.
+        self.history = ['4' * 40, '1' * 40]
+        self.assertEqual(incremental_base([]), None)
+
+
+class FakeCommit(object):
+    def __init__(self, parents, tree):
+        self.parents = parents
+        self.tree = tree
+
+
+class TestCheckManifests(unittest.TestCase):
+    def setUp(self):
+        # Manifest n changes files n to n + 4. The fake helper only checks
+        # files it saw before, and file 7 is corrupted. Manifest 5 is
+        # corrupted, and manifest 9 has a mismatched tree.
+        self.manifests = []
+        self.changes = {}
+        self.commits = {}
+        self.trees = {}
+        for n in range(12):
+            manifest, ref, tree = ('%02d' % n) * 20, ('%02x' % n) * 20, \
+                ('a%d' % (n % 10)) * 20
+            parents = (self.manifests[-1][1],) if self.manifests else ()
+            self.manifests.append((manifest, ref, parents, 'c' * 40, tree))
+            self.changes[ref] = [
+                ('file%d' % f, ('f%d' % (f % 10)) * 20, ())
+                for f in range(n, n + 5)]
+            self.commits[ref] = FakeCommit(parents, tree)
+            self.trees[ref] = tree if n != 9 else 'b' * 40
+        self.seen = set()
+        test = self
+
+        def seen(cls, typ, sha1):
+            if sha1 in test.seen:
+                return True
+            test.seen.add(sha1)
+            return False
+
+        def ls_tree(cls, treeish, path='', recursive=False):
+            yield '040000', 'tree', test.trees[treeish], path
+
+        self.orig = (GitHgHelper.seen, GitHgHelper.check_file,
+                     GitHgHelper.check_manifest, Git.ls_tree,
+                     fsck.get_changes, fsck.GitCommit)
+        GitHgHelper.seen = classmethod(seen)
+        GitHgHelper.check_file = classmethod(
+            lambda cls, sha1, *parents: sha1 != 'f7' * 20)
+        GitHgHelper.check_manifest = classmethod(
+            lambda cls, sha1: sha1 != '05' * 20)
+        Git.ls_tree = classmethod(ls_tree)
+        fsck.get_changes = lambda ref, parents, base: test.changes[ref]
+        fsck.GitCommit = lambda sha1: test.commits[sha1]
+
+    def tearDown(self):
+        (GitHgHelper.seen, GitHgHelper.check_file,
+         GitHgHelper.check_manifest, Git.ls_tree,
+         fsck.get_changes, fsck.GitCommit) = self.orig
+
+    def check(self, jobs, done=()):
+        self.seen = set()
+        return list(check_manifests(
+            manifest_tasks(self.manifests, done, files=True), jobs,
+            manifests=True))
+
+    def test_check_manifests(self):
+        serial = self.check(1)
+        self.assertEqual([p for m, problems in serial for p in problems], [
+            'Sha1 mismatch for file %s in manifest %s' % ('f7' * 20,
+                                                          '04' * 20),
+            'Sha1 mismatch for manifest %s' % ('05' * 20),
+            'Sha1 mismatch for file %s in manifest %s' % ('f7' * 20,
+                                                          '05' * 20),
+            'Sha1 mismatch for file %s in manifest %s' % ('f7' * 20,
+                                                          '06' * 20),
+            'Sha1 mismatch for file %s in manifest %s' % ('f7' * 20,
+                                                          '07' * 20),
+            'Tree mismatch between manifest commit %s and commit %s'
+            % ('09' * 20, 'c' * 40),
+        ])
+        self.assertEqual([m for m, p in serial],
+                         [m[0] for m in self.manifests])
+        for jobs in (2, 3):
+            self.assertEqual(self.check(jobs), serial)
+
+        # Manifests that were already checked are skipped.
+        done = set(m[0] for m in self.manifests[:6])
+        self.assertEqual(self.check(3, done), [
+            (m, problems if m not in done else [])
+            for m, problems in serial])
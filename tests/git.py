@@ -0,0 +1,74 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from cinnabar.git import Git
+from cinnabar.util import VersionedDict
+
+
+class TestGitRefs(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        env = dict(os.environ, GIT_AUTHOR_NAME='Foo', GIT_COMMITTER_NAME='Foo',
+                   GIT_AUTHOR_EMAIL='foo@bar', GIT_COMMITTER_EMAIL='foo@bar')
+        with open(os.devnull, 'w') as null:
+            subprocess.check_call(['git', 'init', self.tmpdir], stdout=null)
+            os.chdir(self.tmpdir)
+            subprocess.check_call(['git', 'commit', '--allow-empty', '-q',
+                                   '-m', 'foo'], env=env)
+            subprocess.check_call(['git', 'commit', '--allow-empty', '-q',
+                                   '-m', 'bar'], env=env)
+        self.head = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD']).strip()
+        self.parent = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD^']).strip()
+        subprocess.check_call(['git', 'update-ref', 'refs/foo/bar', 'HEAD^'])
+        subprocess.check_call(['git', 'update-ref', 'refs/foobar', 'HEAD'])
+        self.state = (Git._refs, Git._initial_refs, Git._refs_loaded,
+                      Git._git_dir)
+        Git._refs = VersionedDict()
+        Git._initial_refs = Git._refs._previous
+        Git._refs_loaded = False
+        Git._git_dir = None
+
+    def tearDown(self):
+        Git._close_cat_file_check()
+        (Git._refs, Git._initial_refs, Git._refs_loaded,
+         Git._git_dir) = self.state
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_resolve_ref(self):
+        self.assertEqual(Git.resolve_ref('HEAD'), self.head)
+        self.assertEqual(Git.resolve_ref('HEAD^'), self.parent)
+        self.assertEqual(Git.resolve_ref('refs/foo/bar'), self.parent)
+        self.assertEqual(Git.resolve_ref('refs/foo/qux'), None)
+        self.assertEqual(Git.resolve_ref('0' * 40), '0' * 40)
+        # All the lookups above went through the same process.
+        proc = Git._cat_file_check
+        self.assertEqual(Git.resolve_ref('refs/foobar'), self.head)
+        self.assertIs(Git._cat_file_check, proc)
+
+    def test_for_each_ref(self):
+        self.assertEqual(list(Git.for_each_ref('refs/foo')),
+                         [(self.parent, 'refs/foo/bar')])
+        self.assertEqual(list(Git.for_each_ref('refs/foo/')),
+                         [(self.parent, 'refs/foo/bar')])
+        self.assertEqual(list(Git.for_each_ref('refs/foo*')),
+                         [(self.head, 'refs/foobar')])
+        self.assertEqual(
+            [ref for sha1, ref in Git.for_each_ref('refs/')],
+            ['refs/foo/bar', 'refs/foobar',
+             'refs/heads/%s' % os.path.basename(subprocess.check_output(
+                 ['git', 'symbolic-ref', 'HEAD']).strip())])
+
+        # Refs are read once, and kept up-to-date in the session.
+        subprocess.check_call(['git', 'update-ref', 'refs/foo/baz', 'HEAD'])
+        Git.update_ref('refs/foo/qux', self.head)
+        Git.delete_ref('refs/foo/bar')
+        self.assertEqual(list(Git.for_each_ref('refs/foo')),
+                         [(self.head, 'refs/foo/qux')])
+        self.assertEqual(Git.resolve_ref('refs/foo/baz'), None)
+        Git._close_update_ref()
@@ -1,10 +1,20 @@
+import hashlib
 import unittest
+from binascii import unhexlify
+from cinnabar import util
+from cinnabar.bdiff import _bdiff
 from cinnabar.git import NULL_NODE_ID
 from cinnabar.githg import (
     Changeset,
     ChangesetPatcher,
     GitCommit,
+    GitHgStore,
+    GraftIndex,
+    ManifestInfo,
+    TagSet,
 )
+from cinnabar.helper import GitHgHelper
+from cinnabar.hg.changegroup import RawRevChunk02
 
 
 class FakeGitCommit(GitCommit):
@@ -254,3 +264,349 @@ class TestChangesetPatcher(unittest.TestCase):
         changeset.body += '\0'
         changeset2 = patcher.apply(changeset)
         self.assertEqual(changeset2.sha1, changeset2.node)
+
+
+class TestManifestInfo(unittest.TestCase):
+    @staticmethod
+    def manifest(files):
+        return ''.join('%s\0%s%s\n' % (path, node, attr)
+                       for path, (node, attr) in sorted(files.iteritems()))
+
+    @staticmethod
+    def chunk(node, parent, data, previous_data):
+        chunk = RawRevChunk02()
+        chunk.node = node
+        chunk.parent1 = parent
+        chunk.parent2 = NULL_NODE_ID
+        chunk.delta_node = parent
+        chunk.changeset = node
+        chunk.data = _bdiff(previous_data, data)
+        return ManifestInfo(chunk)
+
+    def test_manifest_info(self):
+        files = {
+            'foo/%d' % n: ('%040x' % n, '')
+            for n in range(100)
+        }
+        revisions = [
+            ({'foo/10': ('1' * 40, 'x'), 'foo/50': ('2' * 40, '')},
+             set(['foo/20', 'foo/99'])),
+            ({'bar': ('3' * 40, 'l')}, set(['foo/0'])),
+            ({'foo/10': ('4' * 40, '')}, set()),
+        ]
+
+        data = self.manifest(files)
+        node = '1' * 40
+        previous = self.chunk(node, NULL_NODE_ID, data, '')
+        previous.init(())
+        self.assertEqual(previous.data, data)
+        self.assertEqual(previous.removed, set())
+        self.assertEqual(previous.modified, files)
+
+        for n, (modified, removed) in enumerate(revisions):
+            for path in removed:
+                del files[path]
+            files.update(modified)
+            new_data = self.manifest(files)
+            parent = node
+            node = '%040x' % (n + 10)
+            instance = self.chunk(node, parent, new_data, data)
+            instance.init(previous)
+            self.assertEqual(instance.data, new_data)
+            self.assertEqual(instance.removed, removed)
+            self.assertEqual(instance.modified, modified)
+            p1 = unhexlify(parent)
+            p2 = unhexlify(NULL_NODE_ID)
+            self.assertEqual(
+                instance.sha1,
+                hashlib.sha1(min(p1, p2) + max(p1, p2) + new_data)
+                .hexdigest())
+            previous = instance
+            data = new_data
+
+
+class TestLoadHgtags(unittest.TestCase):
+    def setUp(self):
+        self.blobs = {
+            # A .hgtags file.
+            '1' * 40: '%s foo\n%s bar\ninvalid\n%s foo\n' % (
+                'a' * 40, 'b' * 40, 'c' * 40),
+            # A cached tags file.
+            '2' * 40: 'baz\0%s %s\n' % ('d' * 40, 'e' * 40),
+        }
+        self.requested = []
+        self.orig = GitHgHelper.cat_file_many
+
+        def cat_file_many(cls, typ, sha1s):
+            for sha1 in sha1s:
+                self.requested.append(sha1)
+                yield sha1, 'blob', self.blobs[sha1]
+
+        GitHgHelper.cat_file_many = classmethod(cat_file_many)
+        # Avoid the store initialization, which needs a git repository.
+        self.store = object.__new__(GitHgStore)
+        self.store._tags = {NULL_NODE_ID: TagSet()}
+        self.store._tagfiles = {'3' * 40: '2' * 40}
+        self.store._tagsets = {}
+        self.store._tagbases = {}
+        self.store._tagcache = {}
+        self.resolved = []
+
+        def changeset_ref_many(nodes):
+            for node in nodes:
+                self.resolved.append(node)
+                yield node.upper()
+
+        self.store.changeset_ref_many = changeset_ref_many
+
+    def tearDown(self):
+        GitHgHelper.cat_file_many = self.orig
+
+    def test_load_hgtags(self):
+        self.store._load_hgtags(['1' * 40, NULL_NODE_ID, '3' * 40, '1' * 40])
+        self.assertEqual(sorted(self.requested), ['1' * 40, '2' * 40])
+        self.assertEqual(sorted(self.store._tags['1' * 40]), [
+            ('bar', 'B' * 40), ('foo', 'C' * 40)])
+        self.assertEqual(self.store._tags['1' * 40].hist('foo'),
+                         set(['A' * 40]))
+        self.assertEqual(sorted(self.store._tags['3' * 40]), [
+            ('baz', 'd' * 40)])
+        self.assertEqual(self.store._tags['3' * 40].hist('baz'),
+                         set(['e' * 40]))
+
+        # Already loaded tags files are not requested again.
+        self.requested = []
+        self.store._load_hgtags(['1' * 40, '3' * 40])
+        self.assertEqual(self.requested, [])
+
+    def test_incremental(self):
+        self.store._load_hgtags(['1' * 40])
+        self.assertEqual(len(self.resolved), 3)
+        # Only the tag sets of heads are used as bases.
+        self.store._tagcache['a' * 40] = '1' * 40
+        self.blobs['4' * 40] = self.blobs['1' * 40] + '%s qux\n%s bar\n' % (
+            'f' * 40, '9' * 40)
+        self.resolved = []
+        self.store._load_hgtags(['4' * 40])
+        # Only the added lines were parsed.
+        self.assertEqual(self.resolved, ['f' * 40, '9' * 40])
+        self.assertEqual(sorted(self.store._tags['4' * 40]), [
+            ('bar', '9' * 40), ('foo', 'C' * 40), ('qux', 'F' * 40)])
+        self.assertEqual(self.store._tags['4' * 40].hist('bar'),
+                         set(['B' * 40]))
+        # The base tag set is left untouched.
+        self.assertEqual(sorted(self.store._tags['1' * 40]), [
+            ('bar', 'B' * 40), ('foo', 'C' * 40)])
+
+        # Content not extending a known .hgtags file is parsed entirely.
+        self.blobs['5' * 40] = '%s foo\n' % ('8' * 40)
+        self.resolved = []
+        self.store._load_hgtags(['5' * 40])
+        self.assertEqual(self.resolved, ['8' * 40])
+
+    def test_cache_format(self):
+        self.store._load_hgtags(['1' * 40, '3' * 40])
+        tags = self.store._tags['1' * 40]
+        length, digest = self.store._tagbases['1' * 40]
+        self.assertEqual(length, len(self.blobs['1' * 40]))
+        data = tags.to_cache(length, digest)
+        self.assertTrue(data.startswith(TagSet.CACHE_MAGIC))
+        tags2, length2, digest2 = TagSet.from_cache(data)
+        self.assertEqual((length2, digest2), (length, digest))
+        # The fake changeset_ref_many returns uppercase sha1s, which come
+        # back lowercase from the binary form.
+        self.assertEqual(sorted(tags2),
+                         [(t, n.lower()) for t, n in sorted(tags)])
+        for tag, node in tags:
+            self.assertEqual(tags2.hist(tag),
+                             set(n.lower() for n in tags.hist(tag)))
+
+        # Tag sets loaded from the cache are used as bases.
+        self.store._tags = {NULL_NODE_ID: TagSet()}
+        self.store._tagbases = {}
+        self.store._tagsets = {'1' * 40: '6' * 40}
+        self.store._tagcache = {'a' * 40: '1' * 40}
+        self.blobs['6' * 40] = data
+        self.blobs['4' * 40] = self.blobs['1' * 40] + '%s qux\n' % ('f' * 40)
+        self.resolved = []
+        self.store._load_hgtags(['4' * 40])
+        self.assertEqual(self.resolved, ['f' * 40])
+        self.assertEqual(sorted(self.store._tags['4' * 40]), [
+            ('bar', 'b' * 40), ('foo', 'c' * 40), ('qux', 'F' * 40)])
+
+    def test_load_head_bases_only(self):
+        self.store._tagsets = {'6' * 40: '2' * 40, '7' * 40: '2' * 40}
+        self.store._tagfiles = {}
+        self.store._tagcache = {'a' * 40: '6' * 40}
+        self.blobs['4' * 40] = '%s qux\n' % ('f' * 40)
+        self.store._load_hgtags(['4' * 40])
+        # The cached tag set of the head was loaded, but not the other one.
+        self.assertEqual(sorted(self.requested), ['2' * 40, '4' * 40])
+        self.assertIn('6' * 40, self.store._tags)
+        self.assertNotIn('7' * 40, self.store._tags)
+
+    def test_unresolved_base(self):
+        self.blobs['1' * 40] = '%s foo\n%s bar\n' % ('a' * 40, 'b' * 40)
+        resolve = self.store.changeset_ref_many
+        known = set(['a' * 40])
+
+        def changeset_ref_many(nodes):
+            nodes = list(nodes)
+            for node, ref in zip(nodes, resolve(nodes)):
+                yield ref if node in known else None
+
+        self.store.changeset_ref_many = changeset_ref_many
+        self.store._tagcache['a' * 40] = '1' * 40
+        self.store._load_hgtags(['1' * 40])
+        self.assertEqual(sorted(self.store._tags['1' * 40]), [
+            ('foo', 'A' * 40)])
+        # A tag set with unresolved tags is not used as a base.
+        self.assertNotIn('1' * 40, self.store._tagbases)
+
+        known.add('b' * 40)
+        self.blobs['4' * 40] = self.blobs['1' * 40] + '%s qux\n' % ('c' * 40)
+        known.add('c' * 40)
+        self.store._tagcache['b' * 40] = '4' * 40
+        self.store._load_hgtags(['4' * 40])
+        self.assertEqual(sorted(self.store._tags['4' * 40]), [
+            ('bar', 'B' * 40), ('foo', 'A' * 40), ('qux', 'C' * 40)])
+        self.assertIn('4' * 40, self.store._tagbases)
+
+    def test_find_hgtags_base(self):
+        data = 'foo\nbar\nbaz\n'
+        bases = sorted((
+            (len(data[:n]), hashlib.sha1(data[:n]).digest(), str(n) * 40)
+            for n in (4, 8)), reverse=True)
+        self.assertEqual(GitHgStore._find_hgtags_base(data, bases),
+                         ('8' * 40, 8))
+        self.assertEqual(GitHgStore._find_hgtags_base('foo\nqux\n', bases),
+                         ('4' * 40, 4))
+        self.assertEqual(GitHgStore._find_hgtags_base('qux\n', bases),
+                         (None, 0))
+
+
+class TestGraftIndex(unittest.TestCase):
+    def setUp(self):
+        # Commits are '<n>' * 40, with tree '<n % 2>' * 40, timestamp n, and
+        # the given parents.
+        self.commits = {}
+        self.orig = (GitHgHelper.rev_list, GitHgHelper.cat_file_many,
+                     GitHgHelper.cat_file)
+        self.loaded = []
+        test = self
+
+        def reachable(tips):
+            result = set()
+            tips = list(tips)
+            while tips:
+                c = tips.pop()
+                if c not in result:
+                    result.add(c)
+                    tips.extend(test.commits[c][1])
+            return result
+
+        def rev_list(cls, *args):
+            args = list(args)
+            assert args.pop(0) == '--full-history'
+            if '--not' in args:
+                pos = args.index('--not')
+                args, exclude = args[:pos], args[pos + 1:]
+            else:
+                exclude = []
+            for c in reachable(args) - reachable(exclude):
+                yield c, test.commits[c][0], list(test.commits[c][1])
+
+        def commit_data(sha1):
+            tree, parents, timestamp, subject = test.commits[sha1]
+            return (
+                'tree %s\n%sauthor Foo <foo@bar> %d +0000\n'
+                'committer Foo <foo@bar> %d +0000\n\n%s\n' % (
+                    tree, ''.join('parent %s\n' % p for p in parents),
+                    timestamp, timestamp, subject))
+
+        def cat_file(cls, typ, sha1):
+            assert typ == 'commit'
+            test.loaded.append(sha1)
+            return commit_data(sha1)
+
+        def cat_file_many(cls, typ, sha1s):
+            for sha1 in sha1s:
+                if sha1 in test.commits:
+                    yield sha1, 'commit', commit_data(sha1)
+                else:
+                    yield sha1, 'missing', None
+
+        GitHgHelper.rev_list = classmethod(rev_list)
+        GitHgHelper.cat_file_many = classmethod(cat_file_many)
+        GitHgHelper.cat_file = classmethod(cat_file)
+        self.progress = util.progress
+        util.progress = False
+
+    def tearDown(self):
+        (GitHgHelper.rev_list, GitHgHelper.cat_file_many,
+         GitHgHelper.cat_file) = self.orig
+        util.progress = self.progress
+
+    def add_commits(self, start, end):
+        for n in range(start, end):
+            self.commits[str(n % 10) * 40] = (
+                str(n % 2) * 40, (str(n % 10 - 1) * 40,) if n else (), n,
+                'Commit %d' % n)
+
+    def test_update(self):
+        self.add_commits(0, 4)
+        index = GraftIndex()
+        index.update(['3' * 40])
+        self.assertTrue(index.changed)
+        self.assertEqual(len(self.loaded), 4)
+        self.assertEqual(sorted(index.get('1' * 40)), [
+            (1, GraftIndex.subject_hash('Commit 1'), '1' * 40),
+            (3, GraftIndex.subject_hash('Commit 3'), '3' * 40),
+        ])
+
+        # Round-trip through the serialized form.
+        index2 = GraftIndex.from_data(index.to_data())
+        for tree in ('0' * 40, '1' * 40):
+            self.assertEqual(sorted(index2.get(tree)),
+                             sorted(index.get(tree)))
+        index2.tips = index.tips
+
+        # Only new commits are loaded.
+        self.add_commits(4, 6)
+        self.loaded = []
+        index2.update(['5' * 40])
+        self.assertEqual(sorted(self.loaded), ['4' * 40, '5' * 40])
+        self.assertEqual(len(index2.get('0' * 40)), 3)
+        self.assertEqual(len(index2.get('1' * 40)), 3)
+
+        # Commits that are not reachable anymore are removed.
+        self.loaded = []
+        index2.update(['2' * 40])
+        self.assertEqual(self.loaded, [])
+        self.assertEqual([c for t, s, c in sorted(index2.get('1' * 40))],
+                         ['1' * 40])
+        self.assertEqual(index2.tips, set(['2' * 40]))
+
+        # Excluded commits are not added.
+        index3 = GraftIndex()
+        index3.update(['3' * 40], exclude=['1' * 40])
+        self.assertEqual([c for t, s, c in index3.get('1' * 40)],
+                         ['3' * 40])
+        self.assertEqual(index3.get('0' * 40), [(2, GraftIndex.subject_hash(
+            'Commit 2'), '2' * 40)])
+
+    def test_missing_tip(self):
+        self.add_commits(0, 4)
+        index = GraftIndex()
+        index.update(['3' * 40])
+        index.changed = False
+        # When a previous tip doesn't exist anymore, the index is rebuilt.
+        del self.commits['3' * 40]
+        self.loaded = []
+        index.update(['2' * 40])
+        self.assertTrue(index.changed)
+        self.assertEqual(sorted(self.loaded), ['0' * 40, '1' * 40, '2' * 40])
+        self.assertEqual(len(index.get('1' * 40)), 1)
+
+    def test_bad_data(self):
+        self.assertEqual(len(GraftIndex.from_data('foo')), 0)
@@ -0,0 +1,89 @@
+import unittest
+from cinnabar.git import NULL_NODE_ID
+from cinnabar.helper import GitHgHelper
+from cinnabar.hg.bundle import PushStore
+from cinnabar.hg.objects import File
+
+
+class TestCreateFiles(unittest.TestCase):
+    def setUp(self):
+        self.blobs = dict(('%040x' % n, 'content %d\n' % n)
+                          for n in range(100))
+        # Some blobs need metadata escaping, which the helper doesn't
+        # handle.
+        for n in range(0, 100, 7):
+            self.blobs['%040x' % n] = '\1\ncontent %d\n' % n
+        self.set = []
+        self.cat_files = []
+        self.orig = (GitHgHelper.cat_file_many, GitHgHelper.file_node_many,
+                     GitHgHelper.set_many)
+
+        def cat_file_many(cls, typ, sha1s):
+            assert typ == 'blob'
+            sha1s = list(sha1s)
+            self.cat_files.extend(sha1s)
+            return ((s, 'blob', self.blobs[s]) for s in sha1s)
+
+        def file_node_many(cls, items):
+            for sha1, parent1, parent2 in items:
+                if self.blobs[sha1].startswith('\1\n'):
+                    yield NULL_NODE_ID
+                else:
+                    yield self.expected(
+                        sha1, tuple(p for p in (parent1, parent2)
+                                    if p != NULL_NODE_ID))
+
+        def set_many(cls, what, items):
+            self.set.extend((what,) + i for i in items)
+
+        GitHgHelper.cat_file_many = classmethod(cat_file_many)
+        GitHgHelper.file_node_many = classmethod(file_node_many)
+        GitHgHelper.set_many = classmethod(set_many)
+        # Avoid the store initialization, which needs a git repository.
+        self.store = object.__new__(PushStore)
+        self.store._pushed = set()
+
+    def tearDown(self):
+        (GitHgHelper.cat_file_many, GitHgHelper.file_node_many,
+         GitHgHelper.set_many) = self.orig
+
+    def expected(self, sha1, parents):
+        f = File()
+        f.content = self.blobs[sha1]
+        if parents:
+            f.parent1 = parents[0]
+        return f.sha1
+
+    def check(self, batch_size, threshold):
+        self.store.CREATE_FILES_BATCH_SIZE = batch_size
+        self.store.CREATE_FILES_POOL_THRESHOLD = threshold
+        files = [(sha1, ('%040x' % (n + 1000),) if n % 2 else (), ('0' * 40,),
+                  'file%d' % n)
+                 for n, sha1 in enumerate(sorted(self.blobs))]
+        # Files needing metadata escaping can't be created with a parent
+        # outside merges.
+        files = [(sha1, () if self.blobs[sha1].startswith('\1\n') else
+                  parents, gmp, path)
+                 for sha1, parents, gmp, path in files]
+        nodes = self.store.create_files(files)
+        expected = [self.expected(sha1, parents)
+                    for sha1, parents, _, _ in files]
+        self.assertEqual(nodes, expected)
+        self.assertEqual(self.set, [('file', node, sha1)
+                                    for node, (sha1, _, _, _)
+                                    in zip(expected, files)])
+        self.assertEqual(self.store._pushed, set(expected))
+        self.assertNotIn(NULL_NODE_ID, nodes)
+        # Only the blobs the helper couldn't handle were retrieved.
+        self.assertEqual(self.cat_files, [
+            s for s in sorted(self.blobs)
+            if self.blobs[s].startswith('\1\n')])
+
+    def test_create_files(self):
+        self.check(1000, 1000)
+
+    def test_create_files_batched(self):
+        self.check(30, 1000)
+
+    def test_create_files_pool(self):
+        self.check(1000, 5)
@@ -0,0 +1,442 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from BaseHTTPServer import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+)
+from cStringIO import StringIO
+from threading import (
+    current_thread,
+    Thread,
+)
+from cinnabar.dag import gitdag
+from cinnabar.git import NULL_NODE_ID
+from cinnabar.helper import GitHgHelper
+from cinnabar.hg.changegroup import (
+    RawRevChunk01,
+    RawRevChunk01Inline,
+    RawRevChunk02,
+)
+from cinnabar.hg.repo import (
+    BundleApplier,
+    CachingReader,
+    ChunksCollection,
+    ClonebundleCache,
+    ChunksSpool,
+    chunks_in_changegroup,
+    discover,
+    iter_initialized,
+    open_clonebundle,
+    raw_changegroup,
+    write_bundle,
+)
+from cinnabar.util import check_enabled
+
+
+class TestChunksCollection(unittest.TestCase):
+    RevChunk = RawRevChunk01
+
+    def chunks(self):
+        for n in range(10):
+            chunk = self.RevChunk()
+            chunk.node = ('%02d' % n) * 20
+            chunk.parent1 = ('%02d' % (n - 1)) * 20 if n else NULL_NODE_ID
+            chunk.parent2 = NULL_NODE_ID
+            chunk.delta_node = chunk.parent1
+            chunk.changeset = chunk.node
+            chunk.data = 'data %d' % n * n
+            yield chunk
+
+    def check(self, collection):
+        result = list(collection)
+        expected = list(self.chunks())
+        self.assertEqual(result, expected)
+        self.assertEqual([c.delta_node for c in result],
+                         [c.delta_node for c in expected])
+        for chunk in result:
+            self.assertIsInstance(chunk, self.RevChunk)
+        # Iterating consumes the collection.
+        self.assertEqual(list(collection), [])
+
+    def test_in_memory(self):
+        collection = ChunksCollection(self.chunks(), spool_threshold=10000)
+        self.assertNotIsInstance(collection._chunks, ChunksSpool)
+        self.check(collection)
+
+    def test_spool(self):
+        collection = ChunksCollection(self.chunks(), spool_threshold=0)
+        self.assertIsInstance(collection._chunks, ChunksSpool)
+        self.assertEqual(len(collection._chunks), 10)
+        self.check(collection)
+
+    def test_spool_late(self):
+        collection = ChunksCollection(self.chunks(), spool_threshold=500)
+        self.assertIsInstance(collection._chunks, ChunksSpool)
+        self.check(collection)
+
+
+class TestChunksCollectionCG02(TestChunksCollection):
+    RevChunk = RawRevChunk02
+
+
+class TestChunksCollectionCG01Inline(TestChunksCollection):
+    RevChunk = RawRevChunk01Inline
+
+
+class TestChunksInChangegroup(unittest.TestCase):
+    def test_cg1(self):
+        chunks = []
+        for n in range(1, 5):
+            chunk = RawRevChunk01()
+            chunk.node = ('%02d' % n) * 20
+            chunk.parent1 = ('%02d' % (n - 1)) * 20 if n > 1 \
+                else NULL_NODE_ID
+            chunk.parent2 = NULL_NODE_ID
+            chunk.changeset = chunk.node
+            chunk.data = 'data %d' % n
+            chunks.append(chunk)
+        # The third chunk comes from another branch.
+        chunks[2].parent1 = '10' * 20
+        cg = StringIO(''.join(
+            struct.pack('>l', len(c) + 4) + str(c) for c in chunks
+        ) + struct.pack('>l', 0))
+
+        result = list(chunks_in_changegroup(cg))
+        for chunk in result:
+            self.assertIsInstance(chunk, RawRevChunk01Inline)
+        self.assertEqual([c.node for c in result], [c.node for c in chunks])
+        self.assertEqual([c.parent1 for c in result],
+                         [c.parent1 for c in chunks])
+        self.assertEqual([c.changeset for c in result],
+                         [c.changeset for c in chunks])
+        self.assertEqual([c.data for c in result], [c.data for c in chunks])
+        # The first chunk is a delta against its first parent, the following
+        # ones against the previous chunk.
+        self.assertEqual([c.delta_node for c in result],
+                         [NULL_NODE_ID, '01' * 20, '02' * 20, '03' * 20])
+
+
+class FakeInstance(object):
+    def __init__(self, node, sha1, delta_node=NULL_NODE_ID):
+        self.node = node
+        self.sha1 = sha1
+        self.parent1 = self.parent2 = NULL_NODE_ID
+        self.delta_node = delta_node
+        self.previous = None
+
+    def init(self, previous):
+        self.previous = previous
+
+
+class TestIterInitialized(unittest.TestCase):
+    def setUp(self):
+        self._check_config = check_enabled._config
+        check_enabled._config = set(['nodeid'])
+
+    def tearDown(self):
+        check_enabled._config = self._check_config
+
+    def instances(self, bad=None):
+        for n in range(1, 100):
+            node = ('%02d' % n) * 20
+            delta_node = ('%02d' % (n - 1)) * 20 if n > 1 else NULL_NODE_ID
+            yield FakeInstance(node, node if n != bad else NULL_NODE_ID,
+                               delta_node)
+
+    def test_iter_initialized(self):
+        result = list(iter_initialized(None, self.instances()))
+        self.assertEqual([i.node for i in result],
+                         [i.node for i in self.instances()])
+        for previous, instance in zip(result, result[1:]):
+            self.assertIs(instance.previous, previous)
+
+    def test_iter_initialized_mismatch(self):
+        result = []
+        with self.assertRaises(Exception) as cm:
+            for instance in iter_initialized(None, self.instances(bad=50)):
+                result.append(instance.node)
+        self.assertEqual(len(result), 49)
+        self.assertEqual(
+            str(cm.exception),
+            'sha1 mismatch for node %s with parents %s %s and previous %s'
+            % ('50' * 20, NULL_NODE_ID, NULL_NODE_ID, '49' * 20))
+
+    def test_iter_initialized_get_missing(self):
+        # A delta against something else than the previous instance needs
+        # all the pending instances to have been consumed.
+        consumed = []
+
+        def get_missing(node):
+            self.assertIn(node, consumed)
+            return 'missing %s' % node
+
+        instances = list(self.instances())
+        instances[60].delta_node = '10' * 20
+        for instance in iter_initialized(get_missing, instances):
+            consumed.append(instance.node)
+        self.assertEqual(instances[60].previous, 'missing %s' % ('10' * 20))
+
+
+class TestRawChangegroup(unittest.TestCase):
+    @staticmethod
+    def chunk(data):
+        return struct.pack('>l', len(data) + 4) + data
+
+    def changegroup(self):
+        empty = '\0' * 4
+        return ''.join((
+            self.chunk('changeset 1'), self.chunk('changeset 2'), empty,
+            self.chunk('manifest'), empty,
+            self.chunk('foo'), self.chunk('foo 1'), self.chunk('foo 2'),
+            empty,
+            self.chunk('bar'), self.chunk('bar 1'), empty,
+            empty,
+        ))
+
+    def test_raw_changegroup(self):
+        cg = self.changegroup()
+        stream = StringIO(cg + 'trailing')
+        self.assertEqual(''.join(raw_changegroup(stream)), cg)
+        self.assertEqual(stream.read(), 'trailing')
+
+    def test_write_bundle(self):
+        cg = self.changegroup()
+        out = StringIO()
+        write_bundle(StringIO(cg), out)
+        self.assertEqual(out.getvalue(), 'HG10UN' + cg)
+
+
+class TestDiscover(unittest.TestCase):
+    def test_discover(self):
+        # A history with many branches, where the remote has two of them,
+        # up to some point.
+        revs = [(0, ())]
+        for n in range(1, 2000):
+            revs.append((n, (n - 100 if n % 100 == 0 and n > 100 else n - 1,)))
+        parents = dict(revs)
+        remote = set()
+        queue = [999, 1150]
+        while queue:
+            n = queue.pop()
+            if n not in remote:
+                remote.add(n)
+                queue.extend(parents[n])
+        queries = []
+
+        def known(nodes):
+            queries.append(nodes)
+            return [n in remote for n in nodes]
+
+        dag = gitdag(revs)
+        self.assertEqual(sorted(discover(dag, known, sample_size=10)),
+                         [999, 1150])
+        self.assertLess(len(queries), 40)
+        for q in queries:
+            self.assertLessEqual(len(q), 10)
+
+
+class TestClonebundleCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = ClonebundleCache(self.tmpdir, 1000)
+        self.key = ClonebundleCache.key('http://example.com/bundle', '"etag"')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, reader, size=7):
+        result = []
+        while True:
+            buf = reader.read(size)
+            if not buf:
+                return ''.join(result)
+            result.append(buf)
+
+    def test_caching_reader(self):
+        data = 'bundle data ' * 10
+        self.assertEqual(self.cache.open_bundle(self.key), None)
+
+        reader = CachingReader(self.cache, self.key, StringIO(data),
+                               len(data))
+        self.assertEqual(reader.read(10), data[:10])
+        # Nothing is cached until the whole bundle was read.
+        self.assertEqual(self.cache.open_bundle(self.key), None)
+        self.assertEqual(self.read(reader), data[10:])
+        self.assertEqual(self.cache.open_bundle(self.key).read(), data)
+
+        # A download that ends before the expected length is not cached.
+        other_key = ClonebundleCache.key('http://example.com/bundle', 'foo')
+        reader = CachingReader(self.cache, other_key, StringIO(data[:50]),
+                               len(data))
+        self.assertEqual(self.read(reader), data[:50])
+        reader.close()
+        self.assertEqual(self.cache.open_bundle(other_key), None)
+
+    def test_incomplete(self):
+        data = 'bundle data ' * 10
+        reader = CachingReader(self.cache, self.key, StringIO(data),
+                               len(data))
+        reader.read(10)
+        reader.close()
+        self.assertEqual(self.cache.open_bundle(self.key), None)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_corrupted(self):
+        data = 'bundle data ' * 10
+        reader = CachingReader(self.cache, self.key, StringIO(data),
+                               len(data))
+        self.read(reader)
+        with open(self.cache.path(self.key), 'r+b') as fh:
+            fh.write('corrupted')
+        self.assertEqual(self.cache.open_bundle(self.key), None)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+
+class BundleHTTPHandler(BaseHTTPRequestHandler):
+    DATA = 'bundle data ' * 100
+    send_length = True
+    requests = []
+
+    def do_HEAD(self):
+        self.requests.append('HEAD')
+        self.send_headers()
+
+    def do_GET(self):
+        self.requests.append('GET')
+        self.send_headers()
+        self.wfile.write(self.DATA)
+
+    def send_headers(self):
+        self.send_response(200)
+        self.send_header('ETag', '"etag"')
+        if self.send_length:
+            self.send_header('Content-Length', str(len(self.DATA)))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestOpenClonebundle(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = ClonebundleCache(self.tmpdir, 100000)
+        self.server = HTTPServer(('127.0.0.1', 0), BundleHTTPHandler)
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/bundle' % self.server.server_port
+        BundleHTTPHandler.requests = []
+        BundleHTTPHandler.send_length = True
+        import cinnabar.util
+        self.saved_progress = cinnabar.util.progress
+        cinnabar.util.progress = False
+
+    def tearDown(self):
+        import cinnabar.util
+        cinnabar.util.progress = self.saved_progress
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, fh):
+        data = fh.read(100000)
+        fh.close()
+        return data
+
+    def test_open_clonebundle(self):
+        data = BundleHTTPHandler.DATA
+        self.assertEqual(self.read(open_clonebundle(self.url, self.cache)),
+                         data)
+        self.assertEqual(BundleHTTPHandler.requests, ['HEAD', 'GET'])
+
+        # The cached bundle is used without starting a download.
+        BundleHTTPHandler.requests = []
+        self.assertEqual(self.read(open_clonebundle(self.url, self.cache)),
+                         data)
+        self.assertEqual(BundleHTTPHandler.requests, ['HEAD'])
+
+    def test_no_length(self):
+        BundleHTTPHandler.send_length = False
+        data = BundleHTTPHandler.DATA
+        self.assertEqual(self.read(open_clonebundle(self.url, self.cache)),
+                         data)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+        BundleHTTPHandler.requests = []
+        self.assertEqual(self.read(open_clonebundle(self.url, self.cache)),
+                         data)
+        self.assertEqual(BundleHTTPHandler.requests, ['HEAD', 'GET'])
+
+
+class FakeStore(object):
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append((name,) + args)
+
+
+class TestBundleApplier(unittest.TestCase):
+    def setUp(self):
+        self.known = set()
+        self.stored = []
+        self.threads = set()
+        test = self
+
+        def hg2git_many(cls, nodes):
+            test.threads.add(current_thread())
+            for node in nodes:
+                sha1 = 'git %s' % node if node in test.known \
+                    else NULL_NODE_ID
+                cls.hg2git.cache[cls, node] = sha1
+                yield sha1
+
+        def store_files(cls, chunks):
+            for chunk in chunks:
+                test.threads.add(current_thread())
+                test.stored.append(chunk.node)
+
+        self.orig = (GitHgHelper.hg2git_many, GitHgHelper.store_files)
+        GitHgHelper.hg2git_many = classmethod(hg2git_many)
+        GitHgHelper.store_files = classmethod(store_files)
+        import cinnabar.util
+        self.saved_progress = cinnabar.util.progress
+        cinnabar.util.progress = False
+
+    def tearDown(self):
+        GitHgHelper.hg2git_many, GitHgHelper.store_files = self.orig
+        import cinnabar.util
+        cinnabar.util.progress = self.saved_progress
+
+    @staticmethod
+    def chunks(nodes):
+        for node in nodes:
+            chunk = RawRevChunk01()
+            chunk.node = node
+            yield chunk
+
+    def test_skip_known(self):
+        changesets = ['c%d' % n * 20 for n in range(5)]
+        manifests = ['a%d' % n * 20 for n in range(5)]
+        files = ['f%d' % n * 20 for n in range(10)]
+        self.known = set(changesets + manifests + files[::3])
+        bundle = iter([self.chunks(changesets), self.chunks(manifests),
+                       self.chunks(files)])
+        store = FakeStore()
+        BundleApplier(bundle, skip_known=True)(store)
+
+        # Known changesets and manifests are not imported.
+        self.assertEqual(store.calls, [])
+        self.assertEqual(self.stored,
+                         [f for f in files if f not in self.known])
+        # The helper is only used from the main thread.
+        self.assertEqual(self.threads, set([current_thread()]))
+        # Lookups for the files that were stored are not cached.
+        for node in files:
+            self.assertEqual((GitHgHelper, node) in
+                             GitHgHelper.hg2git.cache._cache,
+                             node in self.known)
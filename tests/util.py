@@ -1,7 +1,25 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
 import unittest
+from BaseHTTPServer import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+)
+from threading import Thread
 from cinnabar.util import (
     byte_diff,
+    format_size,
+    HTTPReader,
     lrucache,
+    PerfReport,
+    PieceTable,
+    parse_size,
+    Prefetcher,
+    Process,
+    progress_iter,
     sorted_merge,
     VersionedDict,
 )
@@ -427,3 +445,315 @@ class TestLRUCache(unittest.TestCase):
         self.assertEquals(len(cache), 2)
 
         foo.invalidate(3)
+
+        self.assertEquals(cache.hits, 5)
+        self.assertEquals(cache.misses, 5)
+        self.assertEquals(cache.name, 'foo')
+
+    def test_lru_cache_bytes(self):
+        cache = lrucache(10, max_bytes=10)
+
+        @cache
+        def foo(value):
+            return 'a' * value
+
+        self.assertEquals(foo(4), 'aaaa')
+        self.assertEquals(foo(5), 'aaaaa')
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.bytes, 9)
+
+        self.assertEquals(foo(3), 'aaa')
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.bytes, 8)
+        self.assertEquals(cache.misses, 3)
+
+        foo(5)
+        self.assertEquals(cache.hits, 1)
+        foo(4)
+        self.assertEquals(cache.misses, 4)
+
+        # An entry larger than the byte budget is still kept on its own.
+        self.assertEquals(foo(20), 'a' * 20)
+        self.assertEquals(len(cache), 1)
+        self.assertEquals(cache.bytes, 20)
+
+        foo.invalidate(20)
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.bytes, 0)
+
+
+class TestPrefetcher(unittest.TestCase):
+    def test_prefetcher(self):
+        self.assertEquals(list(Prefetcher(xrange(100), size=10)),
+                          range(100))
+        self.assertEquals(list(Prefetcher(())), [])
+
+    def test_prefetcher_exception(self):
+        def gen():
+            yield 1
+            yield 2
+            raise RuntimeError('foo')
+
+        result = []
+        with self.assertRaises(RuntimeError):
+            for item in Prefetcher(gen()):
+                result.append(item)
+        self.assertEquals(result, [1, 2])
+
+    def test_prefetcher_early_stop(self):
+        prefetcher = Prefetcher(xrange(100), size=2)
+        for item in prefetcher:
+            if item == 5:
+                break
+        self.assertFalse(prefetcher.is_alive())
+
+
+class TestParseSize(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEquals(parse_size('42'), 42)
+        self.assertEquals(parse_size('2k'), 2048)
+        self.assertEquals(parse_size('3M'), 3 * 1024 * 1024)
+        self.assertEquals(parse_size('1g'), 1024 * 1024 * 1024)
+        for value in ('', 'k', 'foo', '-1', '1t'):
+            with self.assertRaises(ValueError):
+                parse_size(value)
+
+
+class TestPieceTable(unittest.TestCase):
+    class Diff(object):
+        def __init__(self, start, end, text_data):
+            self.start = start
+            self.end = end
+            self.text_data = text_data
+
+    def patch(self, data, diffs):
+        result = []
+        end = 0
+        for diff in diffs:
+            result.append(data[end:diff.start])
+            result.append(diff.text_data)
+            end = diff.end
+        result.append(data[end:])
+        return ''.join(result)
+
+    def check(self, table, data):
+        self.assertEqual(str(table), data)
+        self.assertEqual(len(table), len(data))
+        self.assertEqual(''.join(str(b) for b in table), data)
+        for start in range(len(data) + 1):
+            self.assertEqual(table[start:], data[start:])
+            self.assertEqual(table[:start], data[:start])
+            self.assertEqual(table.find('\n', start), data.find('\n', start))
+            self.assertEqual(table.rfind('\n', 0, start),
+                             data.rfind('\n', 0, start))
+            if start < len(data):
+                self.assertEqual(table[start], data[start])
+
+    def test_piece_table(self):
+        data = 'foo\nbar\nbaz\nqux\n'
+        table = PieceTable(data)
+        self.check(table, data)
+        self.assertIs(str(table), data)
+
+        for diffs in (
+            [self.Diff(4, 8, 'hoge\nfuga\n')],
+            [self.Diff(0, 0, 'a'), self.Diff(2, 5, ''),
+             self.Diff(11, 11, 'b\nc')],
+            [self.Diff(0, 5, '')],
+        ):
+            new_data = self.patch(data, diffs)
+            table = table.patch(diffs)
+            self.check(table, new_data)
+            data = new_data
+
+        self.check(PieceTable(), '')
+        self.check(PieceTable().patch([self.Diff(0, 0, 'a\n')]), 'a\n')
+
+    def test_piece_table_compaction(self):
+        table = PieceTable('a' * 100)
+        data = 'a' * 100
+        compacted = False
+        for n in range(PieceTable.MAX_PIECES):
+            diffs = [self.Diff(n, n, 'b')]
+            data = self.patch(data, diffs)
+            table = table.patch(diffs)
+            self.assertLessEqual(len(table._pieces), PieceTable.MAX_PIECES)
+            if n and len(table._pieces) == 1:
+                compacted = True
+        self.assertTrue(compacted)
+        self.assertEqual(str(table), data)
+
+
+class TestFormatSize(unittest.TestCase):
+    def test_format_size(self):
+        self.assertEqual(format_size(42), '42 bytes')
+        self.assertEqual(format_size(1536), '1.5 KiB')
+        self.assertEqual(format_size(5 * 1024 * 1024), '5.0 MiB')
+        self.assertEqual(format_size(3 * 1024 ** 4), '3072.0 GiB')
+
+
+class FlakyHTTPHandler(BaseHTTPRequestHandler):
+    DATA = ''.join(chr(i % 251) for i in range(100000))
+    # Number of bytes sent before dropping the connection, for each
+    # successive request.
+    drop_after = []
+    ranges = []
+
+    def do_GET(self):
+        start = 0
+        range_header = self.headers.getheader('Range')
+        self.ranges.append(range_header)
+        if range_header:
+            start = int(range_header[len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(self.DATA) - 1, len(self.DATA)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(self.DATA) - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        data = self.DATA[start:]
+        if self.drop_after:
+            data = data[:self.drop_after.pop(0)]
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPReader(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FlakyHTTPHandler)
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/bundle' % self.server.server_port
+        FlakyHTTPHandler.ranges = []
+        HTTPReader.RETRY_DELAY = 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def read_all(self, reader):
+        result = []
+        while True:
+            buf = reader.read(4096)
+            if not buf:
+                return ''.join(result)
+            result.append(buf)
+
+    def test_no_interruption(self):
+        FlakyHTTPHandler.drop_after = []
+        reader = HTTPReader(self.url)
+        self.assertEqual(self.read_all(reader), FlakyHTTPHandler.DATA)
+        self.assertEqual(FlakyHTTPHandler.ranges, [None])
+
+    def test_resume(self):
+        FlakyHTTPHandler.drop_after = [30000, 20000]
+        reader = HTTPReader(self.url)
+        self.assertEqual(self.read_all(reader), FlakyHTTPHandler.DATA)
+        self.assertEqual(FlakyHTTPHandler.ranges,
+                         [None, 'bytes=30000-', 'bytes=50000-'])
+
+    def test_resume_with_progress(self):
+        drops = HTTPReader.RETRIES * 2
+        FlakyHTTPHandler.drop_after = [10] * drops
+        reader = HTTPReader(self.url)
+        self.assertEqual(self.read_all(reader), FlakyHTTPHandler.DATA)
+        self.assertEqual(FlakyHTTPHandler.ranges, [None] + [
+            'bytes=%d-' % (10 * n) for n in range(1, drops + 1)])
+
+    def test_too_many_retries(self):
+        FlakyHTTPHandler.drop_after = [10] + [0] * HTTPReader.RETRIES
+        reader = HTTPReader(self.url)
+        with self.assertRaises(IOError):
+            self.read_all(reader)
+
+
+class TestPerfReport(unittest.TestCase):
+    ATTRS = ('_path', '_start', '_phases', '_current', '_pipes', '_peak_rss',
+             '_processes')
+
+    def setUp(self):
+        self.saved = {a: getattr(PerfReport, a) for a in self.ATTRS}
+        self.tmpdir = tempfile.mkdtemp()
+        PerfReport._path = os.path.join(self.tmpdir, 'report')
+        PerfReport._start = 0
+        PerfReport._phases = []
+        PerfReport._current = []
+        PerfReport._pipes = {}
+        PerfReport._peak_rss = {}
+        PerfReport._processes = {}
+        import cinnabar.util
+        self.saved_progress = cinnabar.util.progress
+        cinnabar.util.progress = False
+
+    def tearDown(self):
+        for a, v in self.saved.iteritems():
+            setattr(PerfReport, a, v)
+        import cinnabar.util
+        cinnabar.util.progress = self.saved_progress
+        shutil.rmtree(self.tmpdir)
+
+    def test_report(self):
+        with PerfReport.phase('outer'):
+            with PerfReport.phase('inner'):
+                for _ in progress_iter('%d', range(42)):
+                    pass
+            for _ in progress_iter('%d', range(10)):
+                pass
+
+        proc = Process('cat', stdin=subprocess.PIPE, logger='cat')
+        proc.stdin.write('foo\nbar\n')
+        proc.stdin.flush()
+        self.assertEqual(proc.stdout.readline(), 'foo\n')
+        self.assertEqual(proc.stdout.read(4), 'bar\n')
+        proc.wait()
+
+        PerfReport.write()
+        PerfReport.write()
+        with open(PerfReport._path) as fh:
+            reports = [json.loads(l) for l in fh]
+        self.assertEqual(len(reports), 2)
+        report = reports[0]
+
+        self.assertEqual([p['name'] for p in report['phases']],
+                         ['outer', 'inner'])
+        self.assertEqual([p['items'] for p in report['phases']], [10, 42])
+        for phase in report['phases']:
+            self.assertGreaterEqual(phase['wall_time'], 0)
+            self.assertIn('items_per_sec', phase)
+            self.assertIn('peak_rss', phase)
+        self.assertEqual(report['pipes'], {'cat': {'in': 8, 'out': 8}})
+        if os.path.exists('/proc/self/status'):
+            self.assertGreater(report['peak_rss']['python'], 0)
+            self.assertGreater(report['peak_rss']['cat'], 0)
+
+    def test_init_from_environment(self):
+        import cinnabar.util
+        registered = []
+        register = cinnabar.util.atexit.register
+        cinnabar.util.atexit.register = registered.append
+        path = PerfReport._path
+        os.environ['GIT_CINNABAR_PERF_REPORT'] = path
+        try:
+            PerfReport._path = None
+            PerfReport.init()
+        finally:
+            del os.environ['GIT_CINNABAR_PERF_REPORT']
+            cinnabar.util.atexit.register = register
+        self.assertTrue(PerfReport.enabled())
+        self.assertEqual(PerfReport._path, path)
+        self.assertEqual(registered, [PerfReport.write])
+
+    def test_disabled(self):
+        PerfReport._path = None
+        with PerfReport.phase('phase'):
+            for _ in progress_iter('%d', range(10)):
+                pass
+        self.assertEqual(PerfReport._phases, [])
+        proc = Process('true', logger='true')
+        self.assertNotIn(proc, PerfReport._processes)
+        proc.wait()